@@ -0,0 +1,86 @@
+import numpy as np
+from numba import njit
+
+# Rules the trade engine checks at the end of each period, aborting the backtest as soon as one is decided
+# Trade count: more trades than the threshold
+ABORT_RULE_TRADE_COUNT = 0
+# Tradable weeks rate: the share of weeks with a trade can no longer reach the threshold
+ABORT_RULE_TRADABLE_WEEKS_RATE = 1
+# Drawdown: the summed trade returns fell more than the threshold from their peak after any trade, even one in the
+# middle of a period that later trades recovered from
+ABORT_RULE_DRAWDOWN = 2
+
+# Columns of the abort rules array passed to the trade engine
+ABORT_RULE_CODE = 0
+ABORT_RULE_THRESHOLD = 1
+ABORT_RULE_COLUMNS = 2
+
+ABORT_RULE_NONE = -1
+
+abort_rule_registry = {}
+
+def register_abort_rule(name, rule_code):
+    abort_rule_registry[name] = rule_code
+
+register_abort_rule('trade_count0', ABORT_RULE_TRADE_COUNT)
+register_abort_rule('tradable_weeks_rate0', ABORT_RULE_TRADABLE_WEEKS_RATE)
+register_abort_rule('max_drawdown', ABORT_RULE_DRAWDOWN)
+
+
+def create_abort_rules(rule_thresholds):
+    # rule_thresholds maps registered rule names to their thresholds, the way settings.requirements and limits do
+    # Returns the rules array for the trade engine and the rule names in the same order
+    abort_rule_names = list(rule_thresholds)
+    abort_rules = np.zeros((len(abort_rule_names), ABORT_RULE_COLUMNS), dtype=np.float64)
+    for rule_index, rule_name in enumerate(abort_rule_names):
+        if rule_name not in abort_rule_registry:
+            raise Exception(f'Unknown abort rule {rule_name}')
+        abort_rules[rule_index, ABORT_RULE_CODE] = abort_rule_registry[rule_name]
+        abort_rules[rule_index, ABORT_RULE_THRESHOLD] = rule_thresholds[rule_name]
+
+    return abort_rules, abort_rule_names
+
+
+def create_empty_abort_rules(period_count):
+    return np.zeros((0, ABORT_RULE_COLUMNS), dtype=np.float64), np.zeros(period_count, dtype=np.int64)
+
+
+def create_period_weeks_after(period_week_ids):
+    # Number of weeks after the week of each period, periods are in time order so a new id starts a new week
+    if len(period_week_ids) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    new_weeks = np.ones(len(period_week_ids), dtype=np.int64)
+    new_weeks[1:] = period_week_ids[1:] != period_week_ids[:-1]
+    week_numbers = np.cumsum(new_weeks) - 1
+
+    return week_numbers[-1] - week_numbers
+
+
+@njit(cache=True, nogil=True)
+def find_abort_rule(abort_rules, period_index, period_week_ids, period_weeks_after,
+                    trade_count, traded_weeks, last_traded_week, max_drawdown):
+    # Returns the index of the first rule that is decided at the end of period_index, or ABORT_RULE_NONE
+    # max_drawdown is the largest drawdown after any trade so far, not only the drawdown at the end of the period
+    for rule_index in range(len(abort_rules)):
+        rule_code = int(abort_rules[rule_index, ABORT_RULE_CODE])
+        threshold = abort_rules[rule_index, ABORT_RULE_THRESHOLD]
+
+        if rule_code == ABORT_RULE_TRADE_COUNT:
+            if trade_count > threshold:
+                return rule_index
+
+        elif rule_code == ABORT_RULE_TRADABLE_WEEKS_RATE:
+            # At best every later week trades, and so does this week if it has periods left without a trade yet
+            possible_weeks = traded_weeks + period_weeks_after[period_index]
+            if last_traded_week != period_week_ids[period_index] and period_index + 1 < len(period_week_ids) and \
+                    period_week_ids[period_index + 1] == period_week_ids[period_index]:
+                possible_weeks += 1
+            if possible_weeks < threshold * (period_weeks_after[0] + 1):
+                return rule_index
+
+        elif rule_code == ABORT_RULE_DRAWDOWN:
+            if max_drawdown > threshold:
+                return rule_index
+
+    return ABORT_RULE_NONE
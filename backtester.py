@@ -5,34 +5,133 @@ import time
 from numba import njit
 from functools import reduce
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 
-from constants import BarTypes, OHLC, DayOfWeek, MINUTES_PER_DAY, IndicatorReset, Session, enum_decoder, ExitReason, \
+from constants import BarTypes, OHLC, DayOfWeek, MINUTES_PER_DAY, IndicatorReset, Session, enum_decoder, \
+    enum_encoder, ExitReason, \
     EXIT_REASON_UNKNOWN, EXIT_REASON_STOPLOSS, EXIT_REASON_PROFIT_TARGET, \
     EXIT_REASON_TIMED_EXIT, EXIT_REASON_MAX_LENGTH, EXIT_REASON_NEXT_ENTRY, \
-    DECISON_NONE, DECISON_FLAT, DECISON_LONG, DECISON_SHORT, DECISON_UNKNOWN, TRADING_DAY_COUNT, DEFAULT_DATETIME
-from database_reference import get_holidays, get_database_data
+    DECISON_NONE, DECISON_FLAT, DECISON_LONG, DECISON_SHORT, DECISON_UNKNOWN, TRADING_DAY_COUNT, DEFAULT_EPOCH_MINUTE, BarLayout, \
+    ReturnBucket, DecisionCombiner
+from database_reference import get_holidays, get_database_data, get_period_count
 from database_strategies import get_strategy
-from trade_timing import create_all_exits, create_allowed_entries, create_before_timed_entries, get_start_of_week
+from trade_timing import create_all_exits, create_allowed_entries, create_before_timed_entries, \
+    create_next_exits, create_period_next_exits, calculate_period_week_ids
+from entry_cache import create_entry_cache_key, get_cached_entries, store_cached_entries, get_dataset_lookup
 from market_reference import market_slippage, market_contract_size
 from indicator_registry import indicator_registry, calculate_max_lookback
-from shared_memory import attach_shared_indicator_cache, detach_indicator_cache, close_shared_data, \
-    attach_shared_bars, attach_shared_timed_exits, attach_shared_allowed_sessions, attach_shared_allowed_days
+from shared_memory import attach_shared_indicator_cache, detach_indicator_cache, attach_shared_dataset, \
+    create_shared_dataset, cleanup_shared_memory, create_shared_result_blocks
+from first_passage import create_first_passage_tables, find_first_passage
+from dataset_store import get_dataset_store_path, load_dataset_store, create_dataset_store_layout
+from ragged_periods import is_period_ragged, unwrap_ragged_periods, get_period_values
+from strategy_trace import open_strategy_trace, append_strategy_trace, close_strategy_trace, \
+    get_strategy_trace_filename
+from profiling import start_profile_phase, end_profile_phase, get_indicator_phase, PROFILE_PHASE_MASKS, \
+    PROFILE_PHASE_DECISIONS, PROFILE_PHASE_TRADES, PROFILE_PHASE_RETURNS, PROFILE_PHASE_TRADE_FRAME, \
+    take_profile_counters, merge_profile_counters, reset_profile_counters, write_profile_counters, \
+    check_profile_allocations_threads
+from trade_statistics import create_period_statistics, add_period_statistic
+from abort_rules import create_abort_rules, create_empty_abort_rules, create_period_weeks_after, find_abort_rule, \
+    ABORT_RULE_NONE, ABORT_RULE_COLUMNS
+from strategy_returns import create_trade_spans, TRADE_SPAN_START, TRADE_SPAN_END, TRADE_SPAN_DIRECTION, \
+    TRADE_SPAN_ENTRY_PRICE, TRADE_SPAN_EXIT_PRICE, create_return_bucket_offsets, aggregate_bucket_returns, \
+    fill_empty_bucket_returns
 import settings
 
-def create_trade_df(trades, all_datetimes, trade_entry_datetimes_np, trade_returns_np):
+# Columns of the trade engine's integer and price output arrays
+ENGINE_TRADE_PERIOD = 0
+ENGINE_TRADE_ENTRY_INDEX = 1
+ENGINE_TRADE_EXIT_INDEX = 2
+ENGINE_TRADE_ALL_EXIT_INDEX = 3
+ENGINE_TRADE_NEXT_ENTRY_INDEX = 4
+ENGINE_TRADE_DIRECTION = 5
+ENGINE_TRADE_REASON = 6
+ENGINE_TRADE_INDEX_COLUMNS = 7
+
+ENGINE_TRADE_RETURN = 0
+ENGINE_TRADE_ENTRY_PRICE = 1
+ENGINE_TRADE_EXIT_PRICE = 2
+ENGINE_TRADE_PROFIT_TARGET_PRICE = 3
+ENGINE_TRADE_STOP_LOSS_PRICE = 4
+ENGINE_TRADE_PRICE_COLUMNS = 5
+
+# Columns of the trade engine's per period counts, cumulative in the same way as signal_counts
+ENGINE_PERIOD_PROCESSED = 0
+ENGINE_PERIOD_SIGNAL_COUNT = 1
+ENGINE_PERIOD_PROFIT_TARGET_COUNT = 2
+ENGINE_PERIOD_STOPLOSS_COUNT = 3
+ENGINE_PERIOD_COLUMNS = 4
+
+# State carried between trade engine calls
+ENGINE_STATE_TRADE_COUNT = 0
+ENGINE_STATE_LAST_WEEK = 1
+ENGINE_STATE_FAIL = 2
+ENGINE_STATE_SIGNAL_COUNT = 3
+ENGINE_STATE_PROFIT_TARGET_COUNT = 4
+ENGINE_STATE_STOPLOSS_COUNT = 5
+ENGINE_STATE_TRADED_WEEKS = 6
+ENGINE_STATE_LAST_TRADED_WEEK = 7
+ENGINE_STATE_ABORT_RULE = 8
+ENGINE_STATE_COLUMNS = 9
+
+ENGINE_EXTREME_BEST_PROFIT = 0
+ENGINE_EXTREME_WORST_LOSS = 1
+ENGINE_EXTREME_EQUITY = 2
+ENGINE_EXTREME_PEAK_EQUITY = 3
+# Largest fall of the summed trade returns from their peak after any trade so far
+ENGINE_EXTREME_MAX_DRAWDOWN = 4
+ENGINE_EXTREME_COLUMNS = 5
+
+ENGINE_NO_WEEK = -1
+
+# Columns of the per strategy result block filled by run_population
+POPULATION_TRADE_COUNT = 0
+POPULATION_TOTAL_RETURN = 1
+POPULATION_BEST_PROFIT = 2
+POPULATION_WORST_LOSS = 3
+POPULATION_SIGNAL_COUNT = 4
+POPULATION_PROFIT_TARGET_COUNT = 5
+POPULATION_STOPLOSS_COUNT = 6
+POPULATION_FAIL = 7
+POPULATION_RESULT_COLUMNS = 8
+
+# Fields of the trade records filled when calculate_trade_dataframe is set
+# Entry and exit indexes are into all_datetimes, reason is one of the EXIT_REASON codes
+TRADE_RECORD_DTYPE = np.dtype([
+    ('direction', np.int64),
+    ('entry_index', np.int64),
+    ('exit_index', np.int64),
+    ('entry_price', np.float64),
+    ('exit_price', np.float64),
+    ('reason', np.int64),
+    ('profit_target', np.float64),
+    ('stoploss', np.float64),
+    ('entry_price_before_slippage', np.float64),
+    ('exit_price_before_slippage', np.float64),
+])
+
+EXIT_REASON_NAMES = np.array([reason.name for reason in ExitReason], dtype=object)
+
+
+def create_trade_records(trade_count):
+    return np.zeros(trade_count, dtype=TRADE_RECORD_DTYPE)
+
+
+def create_trade_df(trade_records, all_datetimes, trade_entry_datetimes_np, trade_returns_np):
     trade_df = pd.DataFrame(
         {
-            "Direction": np.array([trade[0] for trade in trades]),
+            "Direction": trade_records['direction'],
             "Entry DateTime": trade_entry_datetimes_np,
-            "Exit DateTime": np.array([all_datetimes[trade[1]] for trade in trades]),
-            "Entry Price": np.array([trade[2] for trade in trades]),
-            "Exit Price": np.array([trade[3] for trade in trades]),
+            "Exit DateTime": all_datetimes[trade_records['exit_index']],
+            "Entry Price": trade_records['entry_price'],
+            "Exit Price": trade_records['exit_price'],
             "Return": trade_returns_np,
-            "Reason": np.array([trade[4] for trade in trades]),
-            "Profit Target": np.array([trade[5] for trade in trades]),
-            "Stoploss": np.array([trade[6] for trade in trades]),
-            "Entry Price Before Slippage": np.array([trade[7] for trade in trades]),
-            "Exit Price Before Slippage": np.array([trade[8] for trade in trades]),
+            "Reason": EXIT_REASON_NAMES[trade_records['reason']],
+            "Profit Target": trade_records['profit_target'],
+            "Stoploss": trade_records['stoploss'],
+            "Entry Price Before Slippage": trade_records['entry_price_before_slippage'],
+            "Exit Price Before Slippage": trade_records['exit_price_before_slippage'],
         }
     )
     trade_df["Direction"] = trade_df["Direction"].replace({1: "Long", -1: "Short"})
@@ -52,108 +151,559 @@ def run_strategy(strategy, market, calculate_trade_dataframe,
                  pool=None,
                  buffer_returns_array=None,
                  limit_trade_count=0,
-                 write_strategy_trace=False):
+                 write_strategy_trace=False,
+                 shared_dataset_layout=None,
+                 first_passage_tables=None,
+                 next_exits=None,
+                 sparse_returns=False,
+                 backtest_report=None,
+                 use_entry_cache=None,
+                 stream_periods=None,
+                 abort_rules=None,
+                 pool_processes=None):
+    # backtest_report is an optional dict that is filled with outputs beyond the returned tuple
+    # With sparse_returns no minute returns array is made and the returns are only kept as
+    # backtest_report['trade_spans'], see strategy_returns for materialising them
+    # use_entry_cache of None follows settings.use_entry_cache, hits are reported as backtest_report['entry_cache_hit']
+    # With calculate_trade_dataframe the structured trades the DataFrame is built from are kept as
+    # backtest_report['trade_records'], see TRADE_RECORD_DTYPE
+    # abort_rules maps abort rule names to thresholds, see abort_rules. A rule that fires fails the strategy and
+    # its name is reported as backtest_report['abort_rule']
+    # stream_periods of None follows settings.stream_periods, streamed entries are not added to the entry cache
+    # With write_strategy_trace the signals and decisions of every period are written to one file, see strategy_trace
+    # pool_processes is the process count of pool, as create_backtest_pool returns it, and of None assumes the
+    # default pool size of get_default_pool_processes
+    if use_entry_cache is None:
+        use_entry_cache = settings.use_entry_cache
+    if stream_periods is None:
+        stream_periods = settings.stream_periods
+
     trade_entry_datetimes = []
     trade_returns = []
     returns_array = buffer_returns_array
-    if buffer_returns_array is None:
+    if sparse_returns:
+        if backtest_report is None or not is_engine_layout(bars_open, timed_exits):
+            raise Exception(f'Sparse returns for {market} need a backtest_report and bars loaded with BarLayout.Matrix or Ragged')
+        returns_array = np.zeros(0, dtype=np.float64)
+    elif buffer_returns_array is None:
         returns_array = np.zeros(len(all_datetimes), dtype=np.float64)
 
-    # Calculates all trades and produces returns and optionally trade list
-    trades, signal_counts, profit_target_counts, stoploss_counts, trade_indexes, best_profit, worst_loss, fail_strategy = calculate_trades(
-        strategy, market, 
-        bars_datetime, bars_open, bars_high, bars_low, bars_close, bars_volume,
-        timed_exits, allowed_entry_days, allowed_entry_sessions,
-        period_offsets, period_lengths, slippage,
-        returns_array, trade_entry_datetimes, trade_returns, limit_trade_count, calculate_trade_dataframe,
-        indicator_cache_lookup, write_strategy_trace, all_datetimes, pool,
-        pid, allowed_minutes_per_period, period_count)
+    strategy_trace = None
+    if write_strategy_trace:
+        strategy_trace = open_strategy_trace(get_strategy_trace_filename(), strategy, bars_datetime)
+
+    # Calculates all trades and produces returns and optionally trade records
+    try:
+        trade_records, signal_counts, profit_target_counts, stoploss_counts, trade_indexes, best_profit, worst_loss, fail_strategy = calculate_trades(
+            strategy, market,
+            bars_datetime, bars_open, bars_high, bars_low, bars_close, bars_volume,
+            timed_exits, allowed_entry_days, allowed_entry_sessions,
+            period_offsets, period_lengths, slippage,
+            returns_array, trade_entry_datetimes, trade_returns, limit_trade_count, calculate_trade_dataframe,
+            indicator_cache_lookup, strategy_trace, all_datetimes, pool,
+            pid, allowed_minutes_per_period, period_count, shared_dataset_layout, first_passage_tables, next_exits,
+            backtest_report, use_entry_cache, stream_periods, abort_rules, pool_processes)
+    finally:
+        if strategy_trace is not None:
+            close_strategy_trace(strategy_trace)
 
     trade_entry_datetimes_np = np.fromiter(trade_entry_datetimes, dtype=object)
     trade_returns_np = np.fromiter(trade_returns, dtype=np.float64)
 
     trade_df = None
     if calculate_trade_dataframe:
-        trade_df = create_trade_df(trades, all_datetimes, trade_entry_datetimes_np, trade_returns_np)
-        del trades
+        phase_start = start_profile_phase()
+        trade_df = create_trade_df(trade_records, all_datetimes, trade_entry_datetimes_np, trade_returns_np)
+        end_profile_phase(PROFILE_PHASE_TRADE_FRAME, phase_start)
+        if backtest_report is not None:
+            backtest_report['trade_records'] = trade_records
 
-    del trade_entry_datetimes, trade_returns
+    del trade_records, trade_entry_datetimes, trade_returns
+
+    if sparse_returns:
+        returns_array = None
 
     return returns_array, trade_entry_datetimes_np, trade_returns_np, trade_df, signal_counts, profit_target_counts, stoploss_counts, trade_indexes, best_profit, worst_loss, fail_strategy
 
+
+def create_population_result_block(population_size):
+    return np.zeros((population_size, POPULATION_RESULT_COLUMNS), dtype=np.float64)
+
+
+def fill_population_result(result_row, engine_state, engine_extremes, trade_price_values):
+    # Summary of one strategy from the trade engine buffers, a failed strategy has no trade returns
+    fail_strategy = engine_state[ENGINE_STATE_FAIL] == 1
+    total_return = 0.0
+    if not fail_strategy:
+        total_return = np.sum(trade_price_values[:engine_state[ENGINE_STATE_TRADE_COUNT], ENGINE_TRADE_RETURN])
+
+    result_row[POPULATION_TRADE_COUNT] = engine_state[ENGINE_STATE_TRADE_COUNT]
+    result_row[POPULATION_TOTAL_RETURN] = total_return
+    result_row[POPULATION_BEST_PROFIT] = engine_extremes[ENGINE_EXTREME_BEST_PROFIT]
+    result_row[POPULATION_WORST_LOSS] = engine_extremes[ENGINE_EXTREME_WORST_LOSS]
+    result_row[POPULATION_SIGNAL_COUNT] = engine_state[ENGINE_STATE_SIGNAL_COUNT]
+    result_row[POPULATION_PROFIT_TARGET_COUNT] = engine_state[ENGINE_STATE_PROFIT_TARGET_COUNT]
+    result_row[POPULATION_STOPLOSS_COUNT] = engine_state[ENGINE_STATE_STOPLOSS_COUNT]
+    result_row[POPULATION_FAIL] = fail_strategy
+
+
+# Function that can backtest a whole population of strategies on one market
+def run_population(strategies, market, calculate_trade_dataframe,
+                   bars_datetime, bars_open, bars_high, bars_low, bars_close, bars_volume,
+                   timed_exits, allowed_entry_days, allowed_entry_sessions,
+                   period_offsets, period_lengths, all_datetimes, slippage,
+                   period_count,
+                   limit_trade_count=0,
+                   result_block=None,
+                   buffer_returns_block=None,
+                   first_passage_tables=None,
+                   next_exits=None):
+    # Entry masks and indicator signals are calculated once per period and shared by every strategy using them
+    # Each strategy's summary is written to its row of result_block, and its returns to buffer_returns_block if given
+    # Returns the result block and a list with the same results as run_strategy for each strategy
+    if not is_engine_layout(bars_open, timed_exits):
+        raise Exception(f'run_population needs bars loaded with BarLayout.Matrix or Ragged for {market}')
+
+    population_size = len(strategies)
+    if result_block is None:
+        result_block = create_population_result_block(population_size)
+    if first_passage_tables is None:
+        first_passage_tables = get_first_passage_tables(bars_high, bars_low)
+    if next_exits is None:
+        next_exits = get_next_exits(timed_exits)
+
+    allowed_entry_session_indexes = [get_strategy_session_index(strategy) for strategy in strategies]
+    allowed_entry_day_indexes = [calculate_allowed_entry_day_indexes(strategy) for strategy in strategies]
+    strategy_max_lookbacks = [calculate_max_lookback(strategy) for strategy in strategies]
+    population_period_results = [np.empty(period_count, dtype=object) for _ in strategies]
+
+    for period_index in range(period_count):
+        period_allowed_entries = {}
+        period_indicator_signals = {}
+        period_length = period_lengths[period_index]
+
+        for strategy_index, strategy in enumerate(strategies):
+            max_trade_length = strategy.get('max_trade_length', None)
+            allowed_entries_key = (allowed_entry_session_indexes[strategy_index],
+                                   tuple(allowed_entry_day_indexes[strategy_index]), max_trade_length)
+            shared_allowed_entries = period_allowed_entries.get(allowed_entries_key, None)
+            if shared_allowed_entries is None:
+                shared_allowed_entries = calculate_allowed_entries(timed_exits, next_exits[period_index],
+                                                                   allowed_entry_days, allowed_entry_sessions,
+                                                                   period_index,
+                                                                   allowed_entry_session_indexes[strategy_index],
+                                                                   allowed_entry_day_indexes[strategy_index],
+                                                                   max_trade_length)
+                period_allowed_entries[allowed_entries_key] = shared_allowed_entries
+
+            # Can not enter for the first minutes of length max lookback of the indicators
+            allowed_entries = shared_allowed_entries.copy()
+            strategy_max_lookback = min(strategy_max_lookbacks[strategy_index], len(allowed_entries))
+            if strategy_max_lookback > 0:
+                allowed_entries[:strategy_max_lookback] = False
+
+            long_signals = np.empty((len(strategy['indicators']), len(bars_open[period_index])), dtype=bool)
+            short_signals = np.empty((len(strategy['indicators']), len(bars_open[period_index])), dtype=bool)
+
+            for array_index, (indicator_name, params) in enumerate(strategy['indicators']):
+                indicator_parameters = f'{indicator_name},{params}'
+                indicator_signals = period_indicator_signals.get(indicator_parameters, None)
+                if indicator_signals is None:
+                    indicator_signals = calculate_indicator_signals(strategy, indicator_name, params,
+                                                                    bars_open, bars_high, bars_low, bars_close,
+                                                                    bars_volume, period_index)
+                    period_indicator_signals[indicator_parameters] = indicator_signals
+
+                long_signals[array_index] = indicator_signals[0]
+                short_signals[array_index] = indicator_signals[1]
+
+            combined_entries = combine_strategy_decisions(get_strategy_decision_combiner(strategy), allowed_entries,
+                                                          long_signals, short_signals, period_length)
+            entry_indices = np.where(combined_entries != 0)[0]
+            population_period_results[strategy_index][period_index] = (
+                entry_indices, combined_entries[entry_indices], np.count_nonzero(combined_entries))
+
+            del allowed_entries, long_signals, short_signals, combined_entries
+
+        del period_allowed_entries, period_indicator_signals
+
+    # Without a returns block every strategy reuses one scratch returns array
+    scratch_returns_array = None
+    if buffer_returns_block is None:
+        scratch_returns_array = np.zeros(len(all_datetimes), dtype=np.float64)
+
+    population_results = []
+    for strategy_index, strategy in enumerate(strategies):
+        take_every_signal, max_trade_length, one_trade_per_week, indicator_reset = get_strategy_trade_settings(strategy)
+
+        entry_offsets, entry_indices, entry_directions, period_signal_counts = pack_period_entries(
+            population_period_results[strategy_index])
+        population_period_results[strategy_index] = None
+
+        period_week_ids = None
+        if one_trade_per_week and indicator_reset == IndicatorReset.Daily:
+            period_week_ids = calculate_period_week_ids(bars_datetime, period_count)
+
+        returns_array = scratch_returns_array
+        if buffer_returns_block is not None:
+            returns_array = buffer_returns_block[strategy_index]
+
+        engine_state, engine_extremes, trade_index_values, trade_price_values, period_values, period_statistics = execute_trade_engine(
+            bars_open, bars_high, bars_low, bars_close, next_exits,
+            period_offsets, period_lengths, period_week_ids,
+            entry_offsets, entry_indices, entry_directions, period_signal_counts,
+            returns_array, max_trade_length, strategy['stoploss'], strategy['profit_target'], take_every_signal,
+            one_trade_per_week, indicator_reset == IndicatorReset.Daily, limit_trade_count, slippage,
+            first_passage_tables)
+
+        trade_entry_datetimes = []
+        trade_returns = []
+        trade_records, signal_counts, profit_target_counts, stoploss_counts, trade_indexes, best_profit, worst_loss, fail_strategy = convert_engine_results(
+            all_datetimes, period_offsets, bars_open, bars_close, engine_state, engine_extremes,
+            trade_index_values, trade_price_values, period_values,
+            trade_entry_datetimes, trade_returns, calculate_trade_dataframe)
+        del entry_offsets, entry_indices, entry_directions, period_signal_counts
+
+        trade_entry_datetimes_np = np.fromiter(trade_entry_datetimes, dtype=object)
+        trade_returns_np = np.fromiter(trade_returns, dtype=np.float64)
+
+        trade_df = None
+        if calculate_trade_dataframe:
+            trade_df = create_trade_df(trade_records, all_datetimes, trade_entry_datetimes_np, trade_returns_np)
+        del trade_records, trade_entry_datetimes, trade_returns
+
+        fill_population_result(result_block[strategy_index], engine_state, engine_extremes, trade_price_values)
+
+        strategy_returns_array = None
+        if buffer_returns_block is not None:
+            strategy_returns_array = returns_array
+        else:
+            scratch_returns_array.fill(0.0)
+
+        population_results.append((strategy_returns_array, trade_entry_datetimes_np, trade_returns_np, trade_df,
+                                   signal_counts, profit_target_counts, stoploss_counts, trade_indexes,
+                                   best_profit, worst_loss, fail_strategy))
+
+    return result_block, population_results
+
+
+# Function that can backtest the entries of a strategy over a grid of exit parameters
+def run_exit_sweep(strategy, market, stoplosses, profit_targets, max_trade_lengths,
+                   bars_datetime, bars_open, bars_high, bars_low, bars_close, bars_volume,
+                   timed_exits, allowed_entry_days, allowed_entry_sessions,
+                   period_offsets, period_lengths, slippage,
+                   period_count,
+                   limit_trade_count=0,
+                   first_passage_tables=None,
+                   next_exits=None):
+    # Indicator signals are calculated once, and decisions once per max trade length since only the allowed entries
+    # change with it. Every stoploss and profit target combination then reuses those entries
+    # A max trade length of None means no max trade length
+    # Returns a population result block with a row per combination and the (stoploss, profit_target, max_trade_length)
+    # of each row
+    if not is_engine_layout(bars_open, timed_exits):
+        raise Exception(f'run_exit_sweep needs bars loaded with BarLayout.Matrix or Ragged for {market}')
+
+    if first_passage_tables is None:
+        first_passage_tables = get_first_passage_tables(bars_high, bars_low)
+    if next_exits is None:
+        next_exits = get_next_exits(timed_exits)
+    high_tables, low_tables = first_passage_tables
+
+    take_every_signal, _, one_trade_per_week, indicator_reset = get_strategy_trade_settings(strategy)
+    allowed_entry_session_index = get_strategy_session_index(strategy)
+    allowed_entry_day_indexes = calculate_allowed_entry_day_indexes(strategy)
+    strategy_max_lookback = calculate_max_lookback(strategy)
+    decision_combiner = get_strategy_decision_combiner(strategy)
+
+    sweep_period_results = [np.empty(period_count, dtype=object) for _ in max_trade_lengths]
+    for period_index in range(period_count):
+        long_signals = np.empty((len(strategy['indicators']), len(bars_open[period_index])), dtype=bool)
+        short_signals = np.empty((len(strategy['indicators']), len(bars_open[period_index])), dtype=bool)
+        for array_index, (indicator_name, params) in enumerate(strategy['indicators']):
+            long_signals[array_index], short_signals[array_index] = calculate_indicator_signals(
+                strategy, indicator_name, params, bars_open, bars_high, bars_low, bars_close, bars_volume, period_index)
+
+        for sweep_index, max_trade_length in enumerate(max_trade_lengths):
+            allowed_entries = calculate_allowed_entries(timed_exits, next_exits[period_index],
+                                                        allowed_entry_days, allowed_entry_sessions, period_index,
+                                                        allowed_entry_session_index, allowed_entry_day_indexes,
+                                                        max_trade_length)
+
+            # Can not enter for the first minutes of length max lookback of the indicators
+            period_max_lookback = min(strategy_max_lookback, len(allowed_entries))
+            if period_max_lookback > 0:
+                allowed_entries[:period_max_lookback] = False
+
+            combined_entries = combine_strategy_decisions(decision_combiner, allowed_entries, long_signals,
+                                                          short_signals, period_lengths[period_index])
+            entry_indices = np.where(combined_entries != 0)[0]
+            sweep_period_results[sweep_index][period_index] = (
+                entry_indices, combined_entries[entry_indices], np.count_nonzero(combined_entries))
+
+            del allowed_entries, combined_entries
+
+        del long_signals, short_signals
+
+    period_week_ids = np.zeros(period_count, dtype=np.int64)
+    if one_trade_per_week and indicator_reset == IndicatorReset.Daily:
+        period_week_ids = calculate_period_week_ids(bars_datetime, period_count)
+
+    exit_grid = np.array([(stoploss, profit_target) for stoploss in stoplosses for profit_target in profit_targets],
+                         dtype=np.float64).reshape(-1, 2)
+    result_block = create_population_result_block(len(max_trade_lengths) * len(exit_grid))
+    exit_combinations = []
+
+    for sweep_index, max_trade_length in enumerate(max_trade_lengths):
+        entry_offsets, entry_indices, entry_directions, period_signal_counts = pack_period_entries(
+            sweep_period_results[sweep_index])
+        sweep_period_results[sweep_index] = None
+
+        engine_state, engine_extremes, trade_index_values, trade_price_values, period_values, period_statistics = create_engine_buffers(
+            len(entry_indices), period_count)
+
+        sweep_offset = sweep_index * len(exit_grid)
+        sweep_exit_parameters(unwrap_ragged_periods(bars_open), unwrap_ragged_periods(bars_high),
+                              unwrap_ragged_periods(bars_low), unwrap_ragged_periods(bars_close),
+                              unwrap_ragged_periods(next_exits), high_tables, low_tables,
+                              np.asarray(period_offsets, dtype=np.int64), np.asarray(period_lengths, dtype=np.int64),
+                              period_week_ids, entry_offsets, entry_indices, entry_directions, period_signal_counts,
+                              0 if max_trade_length is None else max_trade_length, exit_grid, take_every_signal,
+                              one_trade_per_week, indicator_reset == IndicatorReset.Daily, limit_trade_count, slippage,
+                              engine_state, engine_extremes, trade_index_values, trade_price_values, period_values,
+                              period_statistics, result_block[sweep_offset:sweep_offset + len(exit_grid)])
+
+        exit_combinations.extend((stoploss, profit_target, max_trade_length) for stoploss, profit_target in exit_grid)
+        del entry_offsets, entry_indices, entry_directions, period_signal_counts
+        del engine_state, engine_extremes, trade_index_values, trade_price_values, period_values, period_statistics
+
+    return result_block, exit_combinations
+
+
+# Function that can backtest many strategies on threads sharing one in-memory dataset
+def run_strategies_threaded(strategies, market, calculate_trade_dataframe,
+                            bars_datetime, bars_open, bars_high, bars_low, bars_close, bars_volume,
+                            timed_exits, allowed_entry_days, allowed_entry_sessions,
+                            period_offsets, period_lengths, all_datetimes, slippage,
+                            period_count,
+                            thread_count=None,
+                            limit_trade_count=0,
+                            sparse_returns=False,
+                            first_passage_tables=None,
+                            next_exits=None):
+    # The compiled decision and trade kernels release the GIL so strategies overlap on threads without copying
+    # the bars into each process. Returns the run_strategy results and the backtest report of each strategy
+    if thread_count is None:
+        thread_count = settings.backtest_thread_count
+    if thread_count <= 0:
+        thread_count = mp.cpu_count()
+
+    # Build the shared lookups once rather than in every thread
+    if first_passage_tables is None and (is_period_matrix(bars_high) or is_period_ragged(bars_high)):
+        first_passage_tables = get_first_passage_tables(bars_high, bars_low)
+    if next_exits is None:
+        next_exits = get_next_exits(timed_exits)
+
+    def run_threaded_strategy(strategy):
+        backtest_report = {}
+        strategy_results = run_strategy(strategy, market, calculate_trade_dataframe,
+                                        bars_datetime, bars_open, bars_high, bars_low, bars_close, bars_volume,
+                                        timed_exits, allowed_entry_days, allowed_entry_sessions,
+                                        period_offsets, period_lengths, all_datetimes, slippage,
+                                        period_count,
+                                        limit_trade_count=limit_trade_count,
+                                        first_passage_tables=first_passage_tables,
+                                        next_exits=next_exits,
+                                        sparse_returns=sparse_returns,
+                                        backtest_report=backtest_report)
+        return strategy_results, backtest_report
+
+    thread_count = min(thread_count, max(1, len(strategies)))
+    check_profile_allocations_threads(thread_count)
+    with ThreadPool(processes=thread_count) as thread_pool:
+        threaded_results = thread_pool.map(run_threaded_strategy, strategies)
+
+    return threaded_results
+
+
+def create_backtest_dataset(pid, market, tag, bars, timed_exits, allowed_entry_sessions, allowed_entry_days,
+                            period_offsets, period_lengths):
+    # Publishes everything a persistent pool worker needs to backtest whole strategies without the parent
+    bars_datetime = bars[BarTypes.Minute1.value][OHLC.DateTime.value]
+    bars_high = bars[BarTypes.Minute1.value][OHLC.High.value]
+    bars_low = bars[BarTypes.Minute1.value][OHLC.Low.value]
+    period_count = get_period_count(bars)
+
+    high_tables, low_tables = create_first_passage_tables(bars_high, bars_low)
+    extra_arrays = {
+        'high_tables': high_tables,
+        'low_tables': low_tables,
+        'period_offsets': np.asarray(period_offsets, dtype=np.int64),
+        'period_lengths': np.asarray(period_lengths, dtype=np.int64),
+        'period_week_ids': calculate_period_week_ids(bars_datetime, period_count),
+    }
+
+    return create_shared_dataset(pid, market, tag, bars, timed_exits, allowed_entry_sessions, allowed_entry_days,
+                                 create_next_exits(timed_exits), extra_arrays)
+
+
+def create_backtest_pool(pid, tag, shared_dataset_layout, population_size, returns_length=0, processes=None):
+    # Long lived pool whose workers attach the dataset and result blocks once when they start
+    # Results are written by the workers into the shared population result block, and minute returns into the
+    # shared returns block when returns_length is given
+    # Returns the pool, its result blocks and its process count, which run_population_pooled and run_strategy take
+    if processes is None:
+        processes = get_default_pool_processes()
+
+    block_shapes = {'results': (population_size, POPULATION_RESULT_COLUMNS)}
+    if returns_length > 0:
+        block_shapes['returns'] = (population_size, returns_length)
+    shared_result_layout, shared_result_blocks = create_shared_result_blocks(pid, tag, block_shapes)
+
+    backtest_pool = mp.Pool(processes=processes, initializer=initialise_backtest_worker,
+                            initargs=(shared_dataset_layout, shared_result_layout))
+
+    return backtest_pool, shared_result_blocks, processes
+
+
+# State of a persistent pool worker, set once by initialise_backtest_worker
+backtest_worker_state = {}
+
+
+def initialise_backtest_worker(shared_dataset_layout, shared_result_layout):
+    backtest_worker_state['dataset_layout'] = shared_dataset_layout
+    backtest_worker_state['dataset'] = attach_shared_dataset(shared_dataset_layout)
+    backtest_worker_state['results'] = attach_shared_dataset(shared_result_layout)
+    # A forked worker starts with a copy of the parent's counters, which the parent already holds
+    reset_profile_counters()
+
+
+def run_pooled_strategies(strategy_blobs, population_indexes, market, slippage, limit_trade_count):
+    # Persistent pool task backtesting whole strategies, each summary goes to its row of the shared result block
+    dataset = backtest_worker_state['dataset']
+    result_block = backtest_worker_state['results']['results']
+    returns_block = backtest_worker_state['results'].get('returns', None)
+    first_passage_tables = (dataset['high_tables'], dataset['low_tables'])
+    period_count = len(dataset['period_lengths'])
+    sparse_returns_array = np.zeros(0, dtype=np.float64)
+
+    for strategy_blob, population_index in zip(strategy_blobs, population_indexes):
+        strategy = decode_strategy(strategy_blob)
+        take_every_signal, max_trade_length, one_trade_per_week, indicator_reset = get_strategy_trade_settings(strategy)
+
+        entry_offsets, entry_indices, entry_directions, period_signal_counts = calculate_all_entries(
+            strategy, market,
+            dataset['open'], dataset['high'], dataset['low'], dataset['close'], dataset['volume'],
+            dataset['timed_exits'], dataset['allowed_entry_days'], dataset['allowed_entry_sessions'],
+            dataset['period_lengths'], get_strategy_session_index(strategy),
+            calculate_allowed_entry_day_indexes(strategy),
+            None, None, None, 0, 0, period_count,
+            None, dataset['next_exits'])
+
+        returns_array = sparse_returns_array
+        if returns_block is not None:
+            returns_array = returns_block[population_index]
+            returns_array.fill(0.0)
+
+        engine_state, engine_extremes, trade_index_values, trade_price_values, period_values, period_statistics = execute_trade_engine(
+            dataset['open'], dataset['high'], dataset['low'], dataset['close'], dataset['next_exits'],
+            dataset['period_offsets'], dataset['period_lengths'], dataset['period_week_ids'],
+            entry_offsets, entry_indices, entry_directions, period_signal_counts,
+            returns_array, max_trade_length, strategy['stoploss'], strategy['profit_target'], take_every_signal,
+            one_trade_per_week, indicator_reset == IndicatorReset.Daily, limit_trade_count, slippage,
+            first_passage_tables)
+
+        fill_population_result(result_block[population_index], engine_state, engine_extremes, trade_price_values)
+
+        del entry_offsets, entry_indices, entry_directions, period_signal_counts
+        del engine_state, engine_extremes, trade_index_values, trade_price_values, period_values, period_statistics
+
+    # The phases profiled in this worker go back to the parent to merge
+    return take_profile_counters()
+
+
+def run_population_pooled(backtest_pool, shared_result_blocks, strategies, market, slippage, limit_trade_count=0,
+                          generation=None, pool_processes=None):
+    # Backtests a population on a pool from create_backtest_pool with a few chunks of strategies per process
+    # Returns a copy of the population result block and the shared returns block if the pool has one
+    # With profiling on, the counters of the workers are merged and appended to settings.profile_counters_filename
+    # for the generation when it is given
+    # pool_processes is the process count create_backtest_pool returns with the pool
+    population_size = len(strategies)
+    if population_size > len(shared_result_blocks['results']):
+        raise Exception(f'Population of {population_size} is larger than the backtest pool result block for {market}')
+
+    strategy_blobs = [encode_strategy(strategy) for strategy in strategies]
+    chunk_size = calculate_pool_chunk_size(pool_processes, population_size)
+    chunk_profile_counters = backtest_pool.starmap(run_pooled_strategies,
+                                                   [(strategy_blobs[chunk_start:chunk_start + chunk_size],
+                                                     list(range(chunk_start, min(chunk_start + chunk_size,
+                                                                                 population_size))),
+                                                     market, slippage, limit_trade_count)
+                                                    for chunk_start in range(0, population_size, chunk_size)])
+    for task_counters in chunk_profile_counters:
+        merge_profile_counters(task_counters)
+    if settings.use_profiling and generation is not None:
+        write_profile_counters(settings.profile_counters_filename, generation)
+
+    returns_block = shared_result_blocks.get('returns', None)
+    if returns_block is not None:
+        returns_block = returns_block[:population_size]
+
+    return shared_result_blocks['results'][:population_size].copy(), returns_block
+
+
 def calculate_entries(strategy, market,
                       bars_open, bars_high, bars_low, bars_close, bars_volume,
                       timed_exits, allowed_entry_days, allowed_entry_sessions,
                       period_index, period_length, allowed_entry_session_index, allowed_entry_day_indexes,
-                      indicator_cache_lookup, write_strategy_trace,
-                      pid, allowed_minutes_per_period, period_count):
+                      indicator_cache_lookup, strategy_trace,
+                      pid, allowed_minutes_per_period, period_count,
+                      shared_dataset_layout=None, next_exits=None):
+    # strategy_trace is None or a trace from open_strategy_trace that the period is appended to
     indicators_cache_long = None
     indicators_cache_short = None
     if indicator_cache_lookup is not None:
         (indicators_cache_long, indicators_cache_short, indicator_long_shared_memory,
          indicator_short_shared_memory) = attach_shared_indicator_cache(
             pid, market, period_count, allowed_minutes_per_period)
-    
-    using_shared_memory = False
-    # Ensure that these variables are kept to keep the shared memory variables alive
-    bars_open_shared_memory = None
-    bars_high_shared_memory = None
-    bars_low_shared_memory = None
-    bars_close_shared_memory = None
-    bars_volume_shared_memory = None
-    timed_exits_shared_memory = None
-    allowed_entry_sessions_shared_memory = None
-    allowed_entry_days_shared_memory = None
-
-    signal_trace = None
-    if write_strategy_trace:
-        signal_trace = []
 
     if bars_open is None:
-        using_shared_memory = True
-        (bars_open, bars_open_shared_memory) = attach_shared_bars(pid, market, period_count, OHLC.Open.value)
-        (bars_high, bars_high_shared_memory) = attach_shared_bars(pid, market, period_count, OHLC.High.value)
-        (bars_low, bars_low_shared_memory) = attach_shared_bars(pid, market, period_count, OHLC.Low.value)
-        (bars_close, bars_close_shared_memory) = attach_shared_bars(pid, market, period_count, OHLC.Close.value)
-        (bars_volume, bars_volume_shared_memory) = attach_shared_bars(pid, market, period_count, OHLC.Volume.value)
-        (timed_exits, timed_exits_shared_memory) = attach_shared_timed_exits(pid, market, period_count)
-        (allowed_entry_sessions, allowed_entry_sessions_shared_memory) = attach_shared_allowed_sessions(pid, market, period_count)
-        (allowed_entry_days, allowed_entry_days_shared_memory) = attach_shared_allowed_days(pid, market, period_count)
-
-    period_exits = timed_exits[period_index]
-
-    day_entries = None
-    if len(allowed_entry_day_indexes) == TRADING_DAY_COUNT:
-        # if strategy can trade every day of the week, then only consider the session
-        day_session_entries = allowed_entry_sessions[period_index][allowed_entry_session_index]
+        # Worker processes attach to the shared dataset once and reuse the cached arrays for every period
+        dataset = attach_shared_dataset(shared_dataset_layout)
+        bars_open = dataset['open']
+        bars_high = dataset['high']
+        bars_low = dataset['low']
+        bars_close = dataset['close']
+        bars_volume = dataset['volume']
+        timed_exits = dataset['timed_exits']
+        allowed_entry_sessions = dataset['allowed_entry_sessions']
+        allowed_entry_days = dataset['allowed_entry_days']
+        next_exits = dataset.get('next_exits', None)
+
+    if next_exits is not None:
+        period_next_exits = next_exits[period_index]
     else:
-        # Combine which days of the week can be traded on
-        day_entries = reduce(np.logical_or, [allowed_entry_days[period_index][i] for i in allowed_entry_day_indexes])
-        # Combine with which sessions can be traded on
-        day_session_entries = np.logical_and(allowed_entry_sessions[period_index][allowed_entry_session_index], day_entries)
-
-    day_session_entries_without_exits = np.logical_and(day_session_entries, np.logical_not(period_exits))
+        period_next_exits = create_period_next_exits(timed_exits[period_index])
 
-    allowed_entries_before_timed_exits = None
-    if 'max_trade_length' in strategy:
-        allowed_entries_before_timed_exits = create_before_timed_entries(period_exits, strategy['max_trade_length'])
-        allowed_entries = np.logical_and(allowed_entries_before_timed_exits, day_session_entries_without_exits)
-    else:
-        allowed_entries = day_session_entries_without_exits
+    phase_start = start_profile_phase()
+    allowed_entries = calculate_allowed_entries(timed_exits, period_next_exits, allowed_entry_days, allowed_entry_sessions,
+                                                period_index,
+                                                allowed_entry_session_index, allowed_entry_day_indexes,
+                                                strategy.get('max_trade_length', None))
 
     # Can not enter for the first minutes of length max lookback of the indicators
     strategy_max_lookback = min(calculate_max_lookback(strategy), len(allowed_entries))
     if strategy_max_lookback > 0:
         allowed_entries[:strategy_max_lookback] = False
-
-    if write_strategy_trace:
-        signal_trace.append(allowed_entries)
+    end_profile_phase(PROFILE_PHASE_MASKS, phase_start)
 
     long_signals = np.empty((len(strategy['indicators']), len(bars_open[period_index])), dtype=bool)
     short_signals = np.empty((len(strategy['indicators']), len(bars_open[period_index])), dtype=bool)
 
     array_index = 0
     for indicator_name, params in strategy['indicators']:
+        phase_start = start_profile_phase()
         long_indicator_signals = None
         short_indicator_signals = None
 
@@ -162,56 +712,84 @@ def calculate_entries(strategy, market,
             indicator_index = indicator_cache_lookup.get(indicator_parameters, None)
             del indicator_parameters
             if indicator_index is not None:
-                long_indicator_signals = indicators_cache_long[indicator_index][period_index]
-                short_indicator_signals = indicators_cache_short[indicator_index][period_index]
+                # Cached signals are as long as the longest period so cut them to the period of ragged bars
+                long_indicator_signals = indicators_cache_long[indicator_index][period_index][:long_signals.shape[1]]
+                short_indicator_signals = indicators_cache_short[indicator_index][period_index][:short_signals.shape[1]]
 
         if long_indicator_signals is None:
-            long_indicator_signals, short_indicator_signals = indicator_registry[indicator_name](
-                bars_open, bars_high, bars_low, bars_close, bars_volume, period_index, params)
-
-        if len(long_indicator_signals) != len(short_indicator_signals):
-            raise Exception(
-                f'Indicator had different length long and short signals. Indicator was {indicator_name},{params} for {strategy}')
+            long_indicator_signals, short_indicator_signals = calculate_indicator_signals(
+                strategy, indicator_name, params, bars_open, bars_high, bars_low, bars_close, bars_volume, period_index)
 
         long_signals[array_index] = long_indicator_signals
         short_signals[array_index] = short_indicator_signals
-
-        if write_strategy_trace:
-            signal_trace.append(long_indicator_signals)
-            signal_trace.append(short_indicator_signals)
+        end_profile_phase(get_indicator_phase(indicator_name), phase_start)
 
         array_index += 1
 
-    combined_entries = calculate_strategy_decisions(allowed_entries, long_signals, short_signals, period_length)
+    phase_start = start_profile_phase()
+    combined_entries = combine_strategy_decisions(get_strategy_decision_combiner(strategy), allowed_entries,
+                                                  long_signals, short_signals, period_length)
     entry_indices = np.where(combined_entries != 0)[0]
     signal_count = np.count_nonzero(combined_entries)
-    decisions = {}
-    for entry_index in entry_indices:
-        decisions[entry_index] = combined_entries[entry_index]
+    entry_directions = combined_entries[entry_indices]
+    end_profile_phase(PROFILE_PHASE_DECISIONS, phase_start)
 
-    if write_strategy_trace:
-        signal_trace.append(combined_entries)
-        calculate_period_strategy_trace(strategy, bars, signal_trace, period_index)
+    if strategy_trace is not None:
+        append_strategy_trace(strategy_trace, period_index, period_length, allowed_entries, long_signals, short_signals,
+                              combined_entries)
 
-    del long_signals, short_signals, day_entries, day_session_entries, allowed_entries_before_timed_exits, day_session_entries_without_exits, combined_entries
+    del long_signals, short_signals, combined_entries
 
     # Clean up process
     if indicator_cache_lookup is not None:
         detach_indicator_cache(indicator_long_shared_memory, indicator_short_shared_memory)
-    if using_shared_memory:
-        close_shared_data(bars_open_shared_memory)
-        close_shared_data(bars_high_shared_memory)
-        close_shared_data(bars_low_shared_memory)
-        close_shared_data(bars_close_shared_memory)
-        close_shared_data(bars_volume_shared_memory)
-        close_shared_data(timed_exits_shared_memory)
-        close_shared_data(allowed_entry_sessions_shared_memory)
-        close_shared_data(allowed_entry_days_shared_memory)
 
-    return (entry_indices, decisions, signal_count)
+    return (entry_indices, entry_directions, signal_count)
+
+
+def calculate_allowed_entries(timed_exits, period_next_exits, allowed_entry_days, allowed_entry_sessions, period_index,
+                              allowed_entry_session_index, allowed_entry_day_indexes, max_trade_length):
+    # Minutes of the period where the session and days allow an entry, without timed exits
+    # max_trade_length of None means the strategy has no max trade length
+    period_exits = timed_exits[period_index]
+
+    day_entries = None
+    if len(allowed_entry_day_indexes) == TRADING_DAY_COUNT:
+        # if strategy can trade every day of the week, then only consider the session
+        day_session_entries = allowed_entry_sessions[period_index][allowed_entry_session_index]
+    else:
+        # Combine which days of the week can be traded on
+        day_entries = reduce(np.logical_or, [allowed_entry_days[period_index][i] for i in allowed_entry_day_indexes])
+        # Combine with which sessions can be traded on
+        day_session_entries = np.logical_and(allowed_entry_sessions[period_index][allowed_entry_session_index], day_entries)
+
+    day_session_entries_without_exits = np.logical_and(day_session_entries, np.logical_not(period_exits))
+
+    allowed_entries_before_timed_exits = None
+    if max_trade_length is not None:
+        allowed_entries_before_timed_exits = create_before_timed_entries(period_next_exits, max_trade_length)
+        allowed_entries = np.logical_and(allowed_entries_before_timed_exits, day_session_entries_without_exits)
+    else:
+        allowed_entries = day_session_entries_without_exits
+
+    del day_entries, day_session_entries, allowed_entries_before_timed_exits
+
+    return allowed_entries
+
+
+def calculate_indicator_signals(strategy, indicator_name, params,
+                                bars_open, bars_high, bars_low, bars_close, bars_volume, period_index):
+    long_indicator_signals, short_indicator_signals = indicator_registry[indicator_name](
+        bars_open, bars_high, bars_low, bars_close, bars_volume, period_index, params)
 
+    if len(long_indicator_signals) != len(short_indicator_signals):
+        raise Exception(
+            f'Indicator had different length long and short signals. Indicator was {indicator_name},{params} for {strategy}')
 
-@njit(cache=True)
+    return long_indicator_signals, short_indicator_signals
+
+
+@njit(cache=True, nogil=True)
 def calculate_strategy_decisions(allowed_entries, long_signals, short_signals, period_length):
     indicator_count = len(long_signals)
 
@@ -288,6 +866,152 @@ def calculate_strategy_decisions(allowed_entries, long_signals, short_signals, p
     return decisions
 
 
+@njit(cache=True, nogil=True)
+def calculate_signal_interval_starts(allowed_entries, long_signals, short_signals, period_length):
+    # Minutes where the allowed entries or the long or short signal of any indicator changes, so every input of the
+    # decisions is the same from one interval start up to the next
+    is_interval_start = np.zeros(period_length, dtype=np.bool_)
+    if period_length == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    is_interval_start[0] = True
+    for minute_index in range(1, period_length):
+        is_interval_start[minute_index] = allowed_entries[minute_index] != allowed_entries[minute_index - 1]
+
+    for indicator_index in range(len(long_signals)):
+        indicator_long_signals = long_signals[indicator_index]
+        indicator_short_signals = short_signals[indicator_index]
+        for minute_index in range(1, period_length):
+            is_interval_start[minute_index] |= \
+                (indicator_long_signals[minute_index] != indicator_long_signals[minute_index - 1]) | \
+                (indicator_short_signals[minute_index] != indicator_short_signals[minute_index - 1])
+
+    return np.flatnonzero(is_interval_start)
+
+
+@njit(cache=True, nogil=True)
+def calculate_minute_decision(long_signals, short_signals, minute_index):
+    # The indicators of a minute combined the way calculate_strategy_decisions combines them, and whether every
+    # indicator is flat
+    all_indicators_flat = True
+    has_flat = False
+    has_long = False
+    has_short = False
+    for indicator_index in range(len(long_signals)):
+        is_long = long_signals[indicator_index][minute_index]
+        is_short = short_signals[indicator_index][minute_index]
+        if is_long or is_short:
+            all_indicators_flat = False
+        if not is_long and not is_short:
+            has_flat = True
+        elif is_long and not is_short:
+            has_long = True
+        elif is_short and not is_long:
+            has_short = True
+
+    if len(long_signals) == 0:
+        return DECISON_NONE, all_indicators_flat
+    if has_flat or (has_long and has_short):
+        return DECISON_FLAT, all_indicators_flat
+    if has_long:
+        return DECISON_LONG, all_indicators_flat
+    if has_short:
+        return DECISON_SHORT, all_indicators_flat
+    # Every indicator is both long and short
+    return DECISON_UNKNOWN, all_indicators_flat
+
+
+@njit(cache=True, nogil=True)
+def step_strategy_decision(minute_decision, all_indicators_flat, is_allowed,
+                           check_indicator_decisions, previous_decision):
+    # One minute of the state machine of calculate_strategy_decisions
+    # Returns the decision of the minute with the new check_indicator_decisions and previous_decision
+    if check_indicator_decisions and all_indicators_flat:
+        check_indicator_decisions = False
+
+    if check_indicator_decisions:
+        return DECISON_FLAT, check_indicator_decisions, DECISON_FLAT
+
+    if not is_allowed:
+        return DECISON_FLAT, check_indicator_decisions, DECISON_FLAT
+
+    current_decision = minute_decision
+    if current_decision == DECISON_FLAT:
+        return DECISON_FLAT, check_indicator_decisions, previous_decision
+
+    if current_decision == DECISON_UNKNOWN:
+        current_decision = DECISON_FLAT
+
+    if current_decision == previous_decision:
+        if current_decision == DECISON_LONG or current_decision == DECISON_SHORT:
+            current_decision = DECISON_FLAT
+    else:
+        previous_decision = current_decision
+
+    if current_decision == DECISON_LONG or current_decision == DECISON_SHORT:
+        check_indicator_decisions = True
+
+    return current_decision, check_indicator_decisions, previous_decision
+
+
+@njit(cache=True, nogil=True)
+def calculate_interval_decisions(allowed_entries, long_signals, short_signals, interval_starts, period_length):
+    # Same decisions as calculate_strategy_decisions, stepping its state machine through the intervals of
+    # calculate_signal_interval_starts instead of every minute
+    # The inputs are the same for every minute of an interval, so once a minute leaves the state as it was the rest
+    # of the interval gets the same decision as that minute
+    decisions = np.zeros(period_length, dtype=np.int32)
+
+    check_indicator_decisions = False
+    previous_decision = DECISON_FLAT
+
+    for interval_index in range(len(interval_starts)):
+        interval_start = interval_starts[interval_index]
+        interval_end = period_length
+        if interval_index + 1 < len(interval_starts):
+            interval_end = interval_starts[interval_index + 1]
+
+        minute_decision, all_indicators_flat = calculate_minute_decision(long_signals, short_signals, interval_start)
+        is_allowed = allowed_entries[interval_start]
+
+        for minute_index in range(interval_start, interval_end):
+            step_check_indicator_decisions = check_indicator_decisions
+            step_previous_decision = previous_decision
+            decision, check_indicator_decisions, previous_decision = step_strategy_decision(
+                minute_decision, all_indicators_flat, is_allowed, check_indicator_decisions, previous_decision)
+            decisions[minute_index] = decision
+
+            if check_indicator_decisions == step_check_indicator_decisions and \
+                    previous_decision == step_previous_decision:
+                if decision != DECISON_FLAT:
+                    decisions[minute_index + 1:interval_end] = decision
+                break
+
+    return decisions
+
+
+def get_strategy_decision_combiner(strategy):
+    decision_combiner = strategy.get('decision_combiner', settings.decision_combiner)
+    if isinstance(decision_combiner, int):
+        decision_combiner = DecisionCombiner(decision_combiner)
+
+    return decision_combiner
+
+
+def combine_strategy_decisions(decision_combiner, allowed_entries, long_signals, short_signals, period_length):
+    # Indicators that hold their signals for long runs suit the interval combiner, and indicators whose signals
+    # flip every few minutes suit the minute one, see DecisionCombiner. Both give the same decisions
+    if decision_combiner == DecisionCombiner.Minute:
+        return calculate_strategy_decisions(allowed_entries, long_signals, short_signals, period_length)
+
+    interval_starts = calculate_signal_interval_starts(allowed_entries, long_signals, short_signals, period_length)
+    if decision_combiner == DecisionCombiner.Auto and \
+            len(interval_starts) > settings.interval_decisions_max_density * period_length:
+        return calculate_strategy_decisions(allowed_entries, long_signals, short_signals, period_length)
+
+    return calculate_interval_decisions(allowed_entries, long_signals, short_signals, interval_starts, period_length)
+
+
 def calculate_allowed_entry_day_lookup(strategy):
     allowed_days_lookup = {}
     if strategy['monday'] == 1:
@@ -320,57 +1044,198 @@ def calculate_allowed_entry_day_indexes(strategy):
     return allowed_entry_day_indexes
 
 
-def calculate_period_strategy_trace(strategy, bars, signal_trace, period_index):
-    # strategy trace shows bar information, with indicator decisions
+def get_strategy_trade_settings(strategy):
+    take_every_signal = False
+    if 'take_every_signal' in strategy and strategy['take_every_signal']:
+        take_every_signal = True
 
-    bar_data = {
-        'datetime': bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index],
-        'open': bars[BarTypes.Minute1.value][OHLC.Open.value][period_index],
-        'high': bars[BarTypes.Minute1.value][OHLC.High.value][period_index],
-        'low': bars[BarTypes.Minute1.value][OHLC.Low.value][period_index],
-        'close': bars[BarTypes.Minute1.value][OHLC.Close.value][period_index],
-    }
-    datetimes = pd.to_datetime(bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index])
-    bar_data_df = pd.DataFrame(bar_data, index=datetimes)
+    max_trade_length = 0
+    if 'max_trade_length' in strategy:
+        max_trade_length = strategy['max_trade_length']
 
-    signal_trace_headers = []
-    signal_trace_headers.append(f'Allowed Entry')
-    for indicator_name, params in strategy['indicators']:
-        indicator_parameters = f'{indicator_name},{params}'
-        signal_trace_headers.append(f'{indicator_parameters}.Long')
-        signal_trace_headers.append(f'{indicator_parameters}.Short')
+    one_trade_per_week = False
+    if 'one_trade_per_week' in strategy:
+        one_trade_per_week = strategy['one_trade_per_week']
 
-    signal_trace_headers.append(f'Entry Decision')
-    
-    signal_trace_df = pd.DataFrame(list(zip(*signal_trace)), columns=signal_trace_headers)
-    signal_trace_df.index = bar_data_df.index
-    signal_trace_df["Entry Decision"] = signal_trace_df["Entry Decision"].replace({1: "Long", 0: "Flat", -1: "Short"})
+    indicator_reset = strategy['indicator_reset']
+    if isinstance(indicator_reset, int):
+        indicator_reset = IndicatorReset(indicator_reset)
+
+    return take_every_signal, max_trade_length, one_trade_per_week, indicator_reset
+
+
+def get_strategy_session_index(strategy):
+    session = strategy['session']
+    if isinstance(session, int):
+        session = Session(session)
+
+    return session.value
+
+
+def is_period_matrix(period_array):
+    # True when periods are rows of one contiguous numeric matrix rather than an object array of arrays
+    return isinstance(period_array, np.ndarray) and period_array.ndim == 2 and period_array.dtype != object
 
-    combined_df = pd.concat([bar_data_df, signal_trace_df], axis=1)
 
-    combined_df['Parameter.max_trade_length'] = strategy['max_trade_length']
-    combined_df['Parameter.stoploss'] = strategy['stoploss']
-    combined_df['Parameter.profit_target'] = strategy['profit_target']
+def get_first_passage_tables(bars_high, bars_low):
+    # Built once per loaded dataset and shared by every strategy backtested on it, see get_dataset_lookup
+    return get_dataset_lookup('first_passage_tables', (bars_high, bars_low), create_first_passage_tables)
 
-    write_all_strategy_trace(combined_df, period_index)
 
-def write_all_strategy_trace(combined_df, period_index):
+def get_next_exits(timed_exits):
+    return get_dataset_lookup('next_exits', (timed_exits,), create_next_exits)
 
-    initial_columns = ['datetime', 'open', 'high', 'low', 'close', \
-                       'Parameter.max_trade_length', 'Parameter.stoploss', \
-                       'Parameter.profit_target']
 
-    decision_columns = ['Entry Decision']
+def is_engine_layout(bars_open, timed_exits):
+    # True when the compiled trade engine can run on the bars, which are then matrix or ragged periods
+    return (is_period_matrix(bars_open) and is_period_matrix(timed_exits)) or \
+        (is_period_ragged(bars_open) and is_period_ragged(timed_exits))
 
-    long_columns = [col for col in combined_df.columns if col.endswith('.Long')]
-    short_columns = [col for col in combined_df.columns if col.endswith('.Short')]
 
-    new_column_order = initial_columns + long_columns + short_columns + decision_columns
-    df_rearranged = combined_df[new_column_order]
+def pack_period_entries(period_results):
+    # Packs each period's entries into flat arrays, the entries of period p are entry_offsets[p]:entry_offsets[p + 1]
+    period_count = len(period_results)
+    entry_offsets = np.zeros(period_count + 1, dtype=np.int64)
+    period_signal_counts = np.zeros(period_count, dtype=np.int64)
 
-    filename = f'{settings.write_all_path}/strategy_{period_index}.trace.csv'
-    df_rearranged.to_csv(filename, mode='w', index=False)
-    # print(f"Strategy trace written to {filename}")
+    for period_index in range(period_count):
+        (entry_indices, entry_directions, signal_count) = period_results[period_index]
+        entry_offsets[period_index + 1] = entry_offsets[period_index] + len(entry_indices)
+        period_signal_counts[period_index] = signal_count
+
+    entry_indices = np.zeros(entry_offsets[-1], dtype=np.int64)
+    entry_directions = np.zeros(entry_offsets[-1], dtype=np.int32)
+    for period_index in range(period_count):
+        entry_indices[entry_offsets[period_index]:entry_offsets[period_index + 1]] = period_results[period_index][0]
+        entry_directions[entry_offsets[period_index]:entry_offsets[period_index + 1]] = period_results[period_index][1]
+
+    return entry_offsets, entry_indices, entry_directions, period_signal_counts
+
+
+def calculate_all_entries(strategy, market,
+                          bars_open, bars_high, bars_low, bars_close, bars_volume,
+                          timed_exits, allowed_entry_days, allowed_entry_sessions,
+                          period_lengths, allowed_entry_session_index, allowed_entry_day_indexes,
+                          indicator_cache_lookup, strategy_trace, pool,
+                          pid, allowed_minutes_per_period, period_count,
+                          shared_dataset_layout, next_exits, period_start=0, period_end=None, pool_processes=None):
+    # Calculates the entries of periods period_start to period_end, in the pool if given, and returns them packed
+    # with entry offsets relative to period_start
+    if period_end is None:
+        period_end = period_count
+
+    period_results = np.empty(period_end - period_start, dtype=object)
+    if pool is None:
+        for period_index in range(period_start, period_end):
+            entry_indices, entry_directions, signal_count = calculate_entries(strategy, market,
+                                                                       bars_open, bars_high, bars_low, bars_close, bars_volume,
+                                                                       timed_exits, allowed_entry_days, allowed_entry_sessions,
+                                                                       period_index,
+                                                                       period_lengths[period_index],
+                                                                       allowed_entry_session_index,
+                                                                       allowed_entry_day_indexes,
+                                                                       indicator_cache_lookup, strategy_trace,
+                                                                       pid, allowed_minutes_per_period, period_count,
+                                                                       next_exits=next_exits)
+            period_results[period_index - period_start] = (entry_indices, entry_directions, signal_count)
+    else:
+        if shared_dataset_layout is None:
+            raise Exception(f'Backtesting with a pool needs a shared dataset from create_shared_dataset for {market}')
+        if strategy_trace is not None:
+            raise Exception(f'Strategy traces of {market} are written by the process backtesting the strategy so need no pool')
+
+        # Send the strategy once per chunk of periods, the workers load the bars from shared memory
+        strategy_blob = encode_strategy(strategy)
+        chunk_size = calculate_pool_chunk_size(pool_processes, period_end - period_start)
+        packed_chunks = pool.starmap(calculate_entries_chunk,
+                                     [(strategy_blob, market, chunk_start, min(chunk_start + chunk_size, period_end),
+                                       [period_lengths[period_index] for period_index in
+                                        range(chunk_start, min(chunk_start + chunk_size, period_end))],
+                                       allowed_entry_session_index, allowed_entry_day_indexes,
+                                       indicator_cache_lookup,
+                                       pid, allowed_minutes_per_period, period_count,
+                                       shared_dataset_layout
+                                       ) for chunk_start in range(period_start, period_end, chunk_size)])
+        del period_results
+        for _, chunk_profile_counters in packed_chunks:
+            merge_profile_counters(chunk_profile_counters)
+        return concatenate_packed_entries([packed_entries for packed_entries, _ in packed_chunks])
+
+    packed_entries = pack_period_entries(period_results)
+    del period_results
+
+    return packed_entries
+
+
+def calculate_entries_chunk(strategy_blob, market, period_start, period_end, chunk_period_lengths,
+                            allowed_entry_session_index, allowed_entry_day_indexes,
+                            indicator_cache_lookup,
+                            pid, allowed_minutes_per_period, period_count,
+                            shared_dataset_layout):
+    # Pool task calculating the entries of periods period_start to period_end from the shared dataset
+    strategy = decode_strategy(strategy_blob)
+
+    period_results = np.empty(period_end - period_start, dtype=object)
+    for period_index in range(period_start, period_end):
+        # Pass None for all bars, timed exits and entries to force loading from shared memory
+        period_results[period_index - period_start] = calculate_entries(strategy, market,
+                                                                        None, None, None, None, None,
+                                                                        None, None, None,
+                                                                        period_index,
+                                                                        chunk_period_lengths[period_index - period_start],
+                                                                        allowed_entry_session_index,
+                                                                        allowed_entry_day_indexes,
+                                                                        indicator_cache_lookup, None,
+                                                                        pid, allowed_minutes_per_period, period_count,
+                                                                        shared_dataset_layout)
+
+    packed_entries = pack_period_entries(period_results)
+    del period_results
+
+    # The phases profiled in this worker go back with the entries for the parent to merge
+    return packed_entries, take_profile_counters()
+
+
+def concatenate_packed_entries(packed_chunks):
+    # Joins packed entries of consecutive chunks of periods into one set of packed entries
+    entry_offsets = [np.zeros(1, dtype=np.int64)]
+    entry_count = 0
+    for chunk_offsets, chunk_indices, chunk_directions, chunk_signal_counts in packed_chunks:
+        entry_offsets.append(chunk_offsets[1:] + entry_count)
+        entry_count += chunk_offsets[-1]
+
+    return (np.concatenate(entry_offsets),
+            np.concatenate([np.zeros(0, dtype=np.int64)] + [chunk[1] for chunk in packed_chunks]),
+            np.concatenate([np.zeros(0, dtype=np.int32)] + [chunk[2] for chunk in packed_chunks]),
+            np.concatenate([np.zeros(0, dtype=np.int64)] + [chunk[3] for chunk in packed_chunks]))
+
+
+def get_default_pool_processes():
+    return min(settings.data_process_count, mp.cpu_count())
+
+
+def calculate_pool_chunk_size(pool_processes, task_count):
+    # Splits the work into a few tasks per process so per task overhead stays small next to the work it wraps
+    if pool_processes is None:
+        pool_processes = get_default_pool_processes()
+    return max(1, -(-task_count // (pool_processes * settings.pool_tasks_per_process)))
+
+
+def encode_strategy(strategy):
+    # Compact form of a strategy for sending to pool workers
+    return json.dumps(strategy, cls=enum_encoder, separators=(',', ':')).encode('utf-8')
+
+
+def decode_strategy(strategy_blob):
+    return json.loads(strategy_blob, object_hook=enum_decoder)
+
+
+def unpack_period_entries(packed_entries, period_index):
+    entry_offsets, entry_indices, entry_directions, period_signal_counts = packed_entries
+    period_start = entry_offsets[period_index]
+    period_end = entry_offsets[period_index + 1]
+    return (entry_indices[period_start:period_end], entry_directions[period_start:period_end],
+            period_signal_counts[period_index])
 
 
 def calculate_trades(strategy, market, 
@@ -378,22 +1243,20 @@ def calculate_trades(strategy, market,
                      timed_exits, allowed_entry_days, allowed_entry_sessions,
                      period_offsets, period_lengths, slippage,
                      returns_array, trade_entry_datetimes, trade_returns, limit_trade_count, calculate_trade_dataframe,
-                     indicator_cache_lookup, write_strategy_trace, all_datetimes, pool,
-                     pid, allowed_minutes_per_period, period_count):
+                     indicator_cache_lookup, strategy_trace, all_datetimes, pool,
+                     pid, allowed_minutes_per_period, period_count, shared_dataset_layout=None,
+                     first_passage_tables=None, next_exits=None, backtest_report=None, use_entry_cache=False,
+                     stream_periods=False, abort_rules=None, pool_processes=None):
     # Calculates the results of all trades
 
-    session = strategy['session']
-    if isinstance(session, int):
-        session = Session(session)
+    if next_exits is None and timed_exits is not None:
+        next_exits = get_next_exits(timed_exits)
 
-    allowed_entry_session_index = session.value
+    allowed_entry_session_index = get_strategy_session_index(strategy)
     allowed_entry_day_indexes = calculate_allowed_entry_day_indexes(strategy)
     
-    trades = None
-    if calculate_trade_dataframe:
-        trades = []
-    if write_strategy_trace:
-        all_strategy_traces = []
+    trade_records = None
+    trade_record_count = 0
 
     signal_counts = {}
     signal_count_cumulative = 0
@@ -407,69 +1270,119 @@ def calculate_trades(strategy, market,
     worst_loss = 0.0
     best_profit = 0.0
 
-    take_every_signal = False
-    if 'take_every_signal' in strategy and strategy['take_every_signal']:
-        take_every_signal = True
-
-    max_trade_length = 0
-    if 'max_trade_length' in strategy:
-        max_trade_length = strategy['max_trade_length']
-
-    one_trade_per_week = False
-    if 'one_trade_per_week' in strategy:
-        one_trade_per_week = strategy['one_trade_per_week']
-    last_processed_start_of_week = None
+    take_every_signal, max_trade_length, one_trade_per_week, indicator_reset = get_strategy_trade_settings(strategy)
+    last_processed_week_id = None
+
+    # Entries only depend on part of the strategy so reuse them when they were calculated before
+    # A strategy trace needs calculate_entries to run so it is never served from the cache
+    entry_cache_key = None
+    packed_entries = None
+    if use_entry_cache and strategy_trace is None:
+        entry_cache_key = create_entry_cache_key(strategy, market, all_datetimes)
+        packed_entries = get_cached_entries(entry_cache_key)
+        if backtest_report is not None:
+            backtest_report['entry_cache_hit'] = packed_entries is not None
+
+    is_engine = is_engine_layout(bars_open, timed_exits)
+
+    abort_rule_names = []
+    if abort_rules:
+        if not is_engine:
+            raise Exception(f'Abort rules for {market} need bars loaded with BarLayout.Matrix or Ragged')
+        abort_rules, abort_rule_names = create_abort_rules(abort_rules)
+    if backtest_report is not None:
+        backtest_report['abort_rule'] = None
+
+    if packed_entries is None and stream_periods and is_engine:
+        # Entries of each chunk of periods are simulated and released before the next chunk is calculated
+        period_week_ids = None
+        if (one_trade_per_week and indicator_reset == IndicatorReset.Daily) or len(abort_rule_names) > 0:
+            period_week_ids = calculate_period_week_ids(bars_datetime, period_count)
+
+        period_chunk_size = 1 if pool is None else settings.stream_period_chunk_size
+        engine_state, engine_extremes, trade_index_values, trade_price_values, period_values, period_statistics = stream_trade_engine(
+            strategy, market, bars_open, bars_high, bars_low, bars_close, bars_volume,
+            timed_exits, next_exits, allowed_entry_days, allowed_entry_sessions,
+            period_offsets, period_lengths, period_week_ids,
+            allowed_entry_session_index, allowed_entry_day_indexes,
+            indicator_cache_lookup, strategy_trace, pool, pid, allowed_minutes_per_period,
+            period_count, shared_dataset_layout, period_chunk_size, returns_array, max_trade_length, take_every_signal,
+            one_trade_per_week, indicator_reset == IndicatorReset.Daily, limit_trade_count, slippage,
+            first_passage_tables, abort_rules, pool_processes)
+
+        if backtest_report is not None:
+            backtest_report['trade_spans'] = create_engine_trade_spans(engine_state, trade_index_values,
+                                                                       trade_price_values, period_offsets)
+            backtest_report['period_statistics'] = period_statistics
+            backtest_report['abort_rule'] = get_engine_abort_rule(engine_state, abort_rule_names)
+
+        return convert_engine_results(all_datetimes, period_offsets, bars_open, bars_close, engine_state,
+                                      engine_extremes, trade_index_values, trade_price_values, period_values,
+                                      trade_entry_datetimes, trade_returns, calculate_trade_dataframe)
+
+    if packed_entries is None:
+        packed_entries = calculate_all_entries(strategy, market,
+                                               bars_open, bars_high, bars_low, bars_close, bars_volume,
+                                               timed_exits, allowed_entry_days, allowed_entry_sessions,
+                                               period_lengths, allowed_entry_session_index, allowed_entry_day_indexes,
+                                               indicator_cache_lookup, strategy_trace, pool,
+                                               pid, allowed_minutes_per_period, period_count,
+                                               shared_dataset_layout, next_exits, pool_processes=pool_processes)
+        if entry_cache_key is not None:
+            store_cached_entries(entry_cache_key, packed_entries)
+
+    if is_engine:
+        # Simulate the whole history in one compiled call
+        entry_offsets, entry_indices, entry_directions, period_signal_counts = packed_entries
+
+        period_week_ids = None
+        if (one_trade_per_week and indicator_reset == IndicatorReset.Daily) or len(abort_rule_names) > 0:
+            period_week_ids = calculate_period_week_ids(bars_datetime, period_count)
+
+        return run_trade_engine(all_datetimes, bars_open, bars_high, bars_low, bars_close, next_exits,
+                                period_offsets, period_lengths, period_week_ids,
+                                entry_offsets, entry_indices, entry_directions, period_signal_counts,
+                                returns_array, trade_entry_datetimes, trade_returns,
+                                max_trade_length, strategy['stoploss'], strategy['profit_target'], take_every_signal,
+                                one_trade_per_week, indicator_reset == IndicatorReset.Daily, limit_trade_count, slippage,
+                                calculate_trade_dataframe, first_passage_tables, backtest_report,
+                                abort_rules, abort_rule_names)
+
+    # Bars by period are not in matrices so search highs and lows without first passage tables
+    empty_first_passage_table = np.empty((0, 0), dtype=np.float64)
+
+    period_week_ids = None
+    if one_trade_per_week and indicator_reset == IndicatorReset.Daily:
+        period_week_ids = calculate_period_week_ids(bars_datetime, period_count)
+
+    # A trade needs an entry so the entry count bounds the number of trade records
+    if calculate_trade_dataframe:
+        trade_records = create_trade_records(len(packed_entries[1]))
+    period_statistics = create_period_statistics(period_count)
+    if backtest_report is not None:
+        backtest_report['period_statistics'] = period_statistics
 
-    indicator_reset = strategy['indicator_reset']
-    if isinstance(indicator_reset, int):
-        indicator_reset = IndicatorReset(indicator_reset)
+    # Trades are simulated and their returns written period by period so both count as the trades phase
+    phase_start = start_profile_phase()
 
-    period_results = np.empty(period_count, dtype=object)
-    if pool is None:
-        for period_index in range(period_count):
-            entry_indices, decisions, signal_count = calculate_entries(strategy, market,
-                                                                       bars_open, bars_high, bars_low, bars_close, bars_volume,
-                                                                       timed_exits, allowed_entry_days, allowed_entry_sessions,
-                                                                       period_index,
-                                                                       period_lengths[period_index],
-                                                                       allowed_entry_session_index,
-                                                                       allowed_entry_day_indexes,
-                                                                       indicator_cache_lookup, write_strategy_trace,
-                                                                       pid, allowed_minutes_per_period, period_count)
-            period_results[period_index] = (entry_indices, decisions, signal_count)
-    else:
-        # Pass None for all bars, timed exits and entries to force pool to load from shared memory
-        all_period_results = pool.starmap(calculate_entries,
-                                          [(strategy, market, 
-                                            None, None, None, None, None,
-                                            None, None, None,
-                                            period_index, period_lengths[period_index], allowed_entry_session_index,
-                                            allowed_entry_day_indexes,
-                                            indicator_cache_lookup, write_strategy_trace,
-                                            pid, allowed_minutes_per_period, period_count
-                                            ) for period_index in range(period_count)])
-        for period_index, result in enumerate(all_period_results):
-            period_results[period_index] = result
-
-            # Processes each period which could be day or week
+    # Processes each period which could be day or week
     for period_index in range(period_count):
-        period_exits = timed_exits[period_index]
+        period_next_exits = next_exits[period_index]
 
         if indicator_reset == IndicatorReset.Daily:           
-            if last_processed_start_of_week is not None:
+            if last_processed_week_id is not None:
                 # For daily, skip the day if the strategy has already traded once this week and is only allowed to trade once per week
-                current_start_of_week = get_start_of_week(
-                    bars_datetime[period_index][0])
-                if last_processed_start_of_week == current_start_of_week:
+                if last_processed_week_id == period_week_ids[period_index]:
                     continue
 
-        (entry_indices, decisions, signal_count) = period_results[period_index]
+        (entry_indices, entry_directions, signal_count) = unpack_period_entries(packed_entries, period_index)
 
         # Track the count of signals by first date in the period
+        period_start = pd.Timestamp(all_datetimes[period_offsets[period_index]])
         signal_count_cumulative += signal_count
-        signal_counts[bars_datetime[period_index][0]] = signal_count_cumulative
-        profit_target_counts[bars_datetime[period_index][0]] = profit_target_count_cumulative
-        stoploss_counts[bars_datetime[period_index][0]] = stoploss_count_cumulative
+        signal_counts[period_start] = signal_count_cumulative
+        profit_target_counts[period_start] = profit_target_count_cumulative
+        stoploss_counts[period_start] = stoploss_count_cumulative
 
         # Initalise last used exit_index
         last_exit_index = -1
@@ -482,10 +1395,8 @@ def calculate_trades(strategy, market,
             if entry_index < last_exit_index:
                 continue
 
-            trade_entry_datetime = bars_datetime[period_index][entry_index]            
-
             # Do not process any padding
-            if trade_entry_datetime == DEFAULT_DATETIME:
+            if bars_datetime[period_index][entry_index] == DEFAULT_EPOCH_MINUTE:
                 break
 
             # Calculate the results of the trade
@@ -498,16 +1409,18 @@ def calculate_trades(strategy, market,
                 bars_close[period_index],
                 returns_array,
                 entry_index,
-                decisions[entry_index],
+                entry_directions[trade_index],
                 max_trade_length,
                 strategy['stoploss'],
                 strategy['profit_target'],
                 take_every_signal,
                 slippage,
-                period_exits,
+                period_next_exits,
                 period_offsets[period_index],
                 trade_index,
-                entry_indices)
+                entry_indices,
+                empty_first_passage_table,
+                empty_first_passage_table)
 
             # Track profit targets and stoplosses used in particular scores
             profit_target_count_cumulative += is_profit_target
@@ -516,26 +1429,27 @@ def calculate_trades(strategy, market,
                 worst_loss = trade_return
             if trade_return > best_profit:
                 best_profit = trade_return
+            add_period_statistic(period_statistics[period_index], trade_return, is_profit_target, is_stoploss)
             trade_indexes.append((period_index, entry_price, next_entry_index, exit_index))
 
             last_exit_index = exit_index
 
             # Record the trade datetime and return, with optionally the full trade details
-            trade_entry_datetimes.append(trade_entry_datetime)
+            trade_entry_datetimes.append(pd.Timestamp(all_datetimes[period_offsets[period_index] + entry_index]))
             trade_returns.append(trade_return)
             if calculate_trade_dataframe:
-                reason = ExitReason(reason_value)
-                entry_price_before_slippage = bars_open[period_index][
-                    next_entry_index]
                 exit_price_before_slippage = bars_close[period_index][exit_index]
-                if reason == ExitReason.Stoploss:
+                if reason_value == EXIT_REASON_STOPLOSS:
                     exit_price_before_slippage = stop_loss_price
-                elif reason == ExitReason.ProfitTarget:
+                elif reason_value == EXIT_REASON_PROFIT_TARGET:
                     exit_price_before_slippage = profit_target_price
-                trade_details = (decisions[entry_index], all_exit_index, entry_price, exit_price, reason.name,
-                                 profit_target_price, stop_loss_price, entry_price_before_slippage,
-                                 exit_price_before_slippage)
-                trades.append(trade_details)
+                trade_records[trade_record_count] = (entry_directions[trade_index],
+                                                     period_offsets[period_index] + entry_index, all_exit_index,
+                                                     entry_price, exit_price, reason_value,
+                                                     profit_target_price, stop_loss_price,
+                                                     bars_open[period_index][next_entry_index],
+                                                     exit_price_before_slippage)
+                trade_record_count += 1
 
             if limit_trade_count > 0 and len(trade_entry_datetimes) >= limit_trade_count:
                 # Exceeded limit on allowed number of trades which is treated as a failure
@@ -544,7 +1458,7 @@ def calculate_trades(strategy, market,
 
             if one_trade_per_week:
                 if indicator_reset == IndicatorReset.Daily:
-                    last_processed_start_of_week = get_start_of_week(bars_datetime[period_index][0])
+                    last_processed_week_id = period_week_ids[period_index]
 
                 # For both daily and weekly reset, always break from processing further trades on the same period
                 break
@@ -552,21 +1466,27 @@ def calculate_trades(strategy, market,
         if fail_strategy:
             break
 
+    end_profile_phase(PROFILE_PHASE_TRADES, phase_start)
+
     if fail_strategy:
         trade_entry_datetimes.clear()
         trade_returns.clear()
+        trade_record_count = 0
 
-    del period_results
+    if trade_records is not None:
+        trade_records = trade_records[:trade_record_count]
 
-    return trades, signal_counts, profit_target_counts, stoploss_counts, trade_indexes, best_profit, worst_loss, fail_strategy
+    del packed_entries
 
+    return trade_records, signal_counts, profit_target_counts, stoploss_counts, trade_indexes, best_profit, worst_loss, fail_strategy
 
-@njit(cache=True)
+
+@njit(cache=True, nogil=True)
 def calculate_trade(
         bars_open, bars_high, bars_low, bars_close, returns_array,
         entry_index, direction, max_trade_length, stop_loss, profit_target, take_every_signal,
-        slippage, period_exits, period_offset,
-        trade_index, entry_indices):
+        slippage, period_next_exits, period_offset,
+        trade_index, entry_indices, period_high_table, period_low_table):
     # Calculate prices based on slippage
     if direction == 1:
         entry_price = bars_open[entry_index + 1] * (1 + slippage)
@@ -585,38 +1505,50 @@ def calculate_trade(
         # Max possible length of a trade is a day. Use this value without max_trade_length to find the trade exit
         max_possible_trade_exit_index = entry_index + np.minimum(MINUTES_PER_DAY, len(bars_open) - entry_index - 1)
 
-    # Get the slice of highs and lows to decide when stop and profit target would get hit
-    lows = bars_low[entry_index + 1:max_possible_trade_exit_index + 1]
-    highs = bars_high[entry_index + 1:max_possible_trade_exit_index + 1]
-
     stop_loss_hit = -1
     profit_target_hit = -1
 
-    if direction == 1:
-        stop_loss_check = lows <= stop_loss_price
-        if np.any(stop_loss_check):
-            stop_loss_hit = np.argmax(lows <= stop_loss_price)
-        profit_target_check = highs >= profit_target_price
-        if np.any(profit_target_check):
-            profit_target_hit = np.argmax(profit_target_check)
+    if period_high_table.shape[0] > 0:
+        # Search the first passage tables of the period for the first minute the stop and profit target get hit
+        stop_loss_passage = find_first_passage(bars_low if direction == 1 else bars_high,
+                                               period_low_table if direction == 1 else period_high_table,
+                                               entry_index + 1, max_possible_trade_exit_index,
+                                               stop_loss_price, direction == 1)
+        if stop_loss_passage >= 0:
+            stop_loss_hit = stop_loss_passage - entry_index - 1
+        profit_target_passage = find_first_passage(bars_high if direction == 1 else bars_low,
+                                                   period_high_table if direction == 1 else period_low_table,
+                                                   entry_index + 1, max_possible_trade_exit_index,
+                                                   profit_target_price, direction != 1)
+        if profit_target_passage >= 0:
+            profit_target_hit = profit_target_passage - entry_index - 1
     else:
-        stop_loss_check = highs >= stop_loss_price
-        if np.any(stop_loss_check):
-            stop_loss_hit = np.argmax(stop_loss_check)
-        profit_target_check = lows <= profit_target_price
-        if np.any(profit_target_check):
-            profit_target_hit = np.argmax(profit_target_check)
+        # Get the slice of highs and lows to decide when stop and profit target would get hit
+        lows = bars_low[entry_index + 1:max_possible_trade_exit_index + 1]
+        highs = bars_high[entry_index + 1:max_possible_trade_exit_index + 1]
+
+        if direction == 1:
+            stop_loss_check = lows <= stop_loss_price
+            if np.any(stop_loss_check):
+                stop_loss_hit = np.argmax(lows <= stop_loss_price)
+            profit_target_check = highs >= profit_target_price
+            if np.any(profit_target_check):
+                profit_target_hit = np.argmax(profit_target_check)
+        else:
+            stop_loss_check = highs >= stop_loss_price
+            if np.any(stop_loss_check):
+                stop_loss_hit = np.argmax(stop_loss_check)
+            profit_target_check = lows <= profit_target_price
+            if np.any(profit_target_check):
+                profit_target_hit = np.argmax(profit_target_check)
 
     # Calculate the index of when the profit target and stop are hit
     stop_loss_exit = (entry_index + 1 + stop_loss_hit) if stop_loss_hit >= 0 else np.inf
     profit_target_exit = (entry_index + 1 + profit_target_hit) if profit_target_hit >= 0 else np.inf
 
     # Calculate the index of when the timed event would trigger
-    check_exits = period_exits[entry_index:max_possible_trade_exit_index + 1]
-    check_exit_index = -1
-    if np.any(check_exits):
-        check_exit_index = np.argmax(check_exits)
-    timed_exit = (entry_index + check_exit_index) if check_exit_index >= 0 else np.inf
+    next_exit_index = period_next_exits[entry_index]
+    timed_exit = next_exit_index if next_exit_index <= max_possible_trade_exit_index else np.inf
 
     subsequent_entry_index = np.inf
     if take_every_signal and trade_index + 1 < len(entry_indices):
@@ -667,20 +1599,449 @@ def calculate_trade(
     all_entry_index = entry_index + period_offset
     all_exit_index = exit_index + period_offset
 
-    # Calculate the P&L return for all minutes using close to close
-    returns_array[all_entry_index + 1:all_exit_index + 1] += (
-                                                                     bars_close[
-                                                                     entry_index + 1:exit_index + 1] - bars_close[
-                                                                                                       entry_index:exit_index]
-                                                             ) * direction / entry_price
-    # Adjust the first minute's return by the difference of the previous close and the entry price
-    returns_array[all_entry_index + 1] -= (entry_price - bars_close[entry_index]) * direction / entry_price
-    # Adjust the last minute's return by the difference of the close and the exit price
-    returns_array[all_exit_index] -= (bars_close[exit_index] - exit_price) * direction / entry_price
+    # An empty returns array means sparse returns which are rebuilt later from the trade spans
+    if len(returns_array) > 0:
+        # Calculate the P&L return for all minutes using close to close
+        returns_array[all_entry_index + 1:all_exit_index + 1] += (
+                bars_close[entry_index + 1:exit_index + 1] - bars_close[entry_index:exit_index]
+        ) * direction / entry_price
+        # Adjust the first minute's return by the difference of the previous close and the entry price
+        returns_array[all_entry_index + 1] -= (entry_price - bars_close[entry_index]) * direction / entry_price
+        # Adjust the last minute's return by the difference of the close and the exit price
+        returns_array[all_exit_index] -= (bars_close[exit_index] - exit_price) * direction / entry_price
 
     return trade_return, reason, exit_index, all_exit_index, is_profit_target, is_stoploss, entry_index + 1, entry_price, exit_price, profit_target_price, stop_loss_price
 
 
+@njit(cache=True, nogil=True)
+def simulate_trades(bars_open, bars_high, bars_low, bars_close, next_exits, high_tables, low_tables,
+                    period_offsets, period_lengths, period_week_ids,
+                    entry_offsets, entry_indices, entry_directions, period_signal_counts,
+                    returns_array, max_trade_length, stop_loss, profit_target, take_every_signal,
+                    one_trade_per_week, daily_reset, limit_trade_count, slippage,
+                    period_start, period_end, engine_state, engine_extremes,
+                    trade_index_values, trade_price_values, period_values, period_statistics,
+                    abort_rules, period_weeks_after):
+    # Runs the trades of periods period_start to period_end with the same rules as the python loop in calculate_trades
+    # engine_state and engine_extremes carry the counters between calls so the history can be processed in pieces
+    # The rows of period_statistics for the periods are overwritten, see trade_statistics for their columns
+    # abort_rules are checked at the end of each period, a rule that fires fails the strategy and is kept in
+    # engine_state. The weeks of period_week_ids must be filled when there are abort rules
+
+    for period_index in range(period_start, period_end):
+        period_statistics[period_index, :] = 0.0
+
+        if daily_reset and engine_state[ENGINE_STATE_LAST_WEEK] != ENGINE_NO_WEEK:
+            # For daily, skip the day if the strategy has already traded once this week and is only allowed to trade once per week
+            if engine_state[ENGINE_STATE_LAST_WEEK] == period_week_ids[period_index]:
+                continue
+
+        engine_state[ENGINE_STATE_SIGNAL_COUNT] += period_signal_counts[period_index]
+        period_values[period_index, ENGINE_PERIOD_PROCESSED] = 1
+        period_values[period_index, ENGINE_PERIOD_SIGNAL_COUNT] = engine_state[ENGINE_STATE_SIGNAL_COUNT]
+        period_values[period_index, ENGINE_PERIOD_PROFIT_TARGET_COUNT] = engine_state[ENGINE_STATE_PROFIT_TARGET_COUNT]
+        period_values[period_index, ENGINE_PERIOD_STOPLOSS_COUNT] = engine_state[ENGINE_STATE_STOPLOSS_COUNT]
+
+        period_entry_indices = entry_indices[entry_offsets[period_index]:entry_offsets[period_index + 1]]
+        period_entry_directions = entry_directions[entry_offsets[period_index]:entry_offsets[period_index + 1]]
+
+        last_exit_index = -1
+        for trade_index in range(len(period_entry_indices)):
+            entry_index = period_entry_indices[trade_index]
+
+            # Can not enter before the previous exit
+            if entry_index < last_exit_index:
+                continue
+
+            # Do not process any padding
+            if entry_index >= period_lengths[period_index]:
+                break
+
+            (trade_return, reason_value, exit_index, all_exit_index, is_profit_target, is_stoploss, next_entry_index,
+             entry_price, exit_price, profit_target_price, stop_loss_price) = calculate_trade(
+                get_period_values(bars_open, period_offsets, period_lengths, period_index),
+                get_period_values(bars_high, period_offsets, period_lengths, period_index),
+                get_period_values(bars_low, period_offsets, period_lengths, period_index),
+                get_period_values(bars_close, period_offsets, period_lengths, period_index),
+                returns_array,
+                entry_index,
+                period_entry_directions[trade_index],
+                max_trade_length,
+                stop_loss,
+                profit_target,
+                take_every_signal,
+                slippage,
+                get_period_values(next_exits, period_offsets, period_lengths, period_index),
+                period_offsets[period_index],
+                trade_index,
+                period_entry_indices,
+                high_tables[period_index],
+                low_tables[period_index])
+
+            engine_state[ENGINE_STATE_PROFIT_TARGET_COUNT] += is_profit_target
+            engine_state[ENGINE_STATE_STOPLOSS_COUNT] += is_stoploss
+            if trade_return < engine_extremes[ENGINE_EXTREME_WORST_LOSS]:
+                engine_extremes[ENGINE_EXTREME_WORST_LOSS] = trade_return
+            if trade_return > engine_extremes[ENGINE_EXTREME_BEST_PROFIT]:
+                engine_extremes[ENGINE_EXTREME_BEST_PROFIT] = trade_return
+            add_period_statistic(period_statistics[period_index], trade_return, is_profit_target, is_stoploss)
+
+            # Track what the abort rules need
+            if engine_state[ENGINE_STATE_LAST_TRADED_WEEK] != period_week_ids[period_index]:
+                engine_state[ENGINE_STATE_TRADED_WEEKS] += 1
+                engine_state[ENGINE_STATE_LAST_TRADED_WEEK] = period_week_ids[period_index]
+            engine_extremes[ENGINE_EXTREME_EQUITY] += trade_return
+            if engine_extremes[ENGINE_EXTREME_EQUITY] > engine_extremes[ENGINE_EXTREME_PEAK_EQUITY]:
+                engine_extremes[ENGINE_EXTREME_PEAK_EQUITY] = engine_extremes[ENGINE_EXTREME_EQUITY]
+            if engine_extremes[ENGINE_EXTREME_PEAK_EQUITY] - engine_extremes[ENGINE_EXTREME_EQUITY] > \
+                    engine_extremes[ENGINE_EXTREME_MAX_DRAWDOWN]:
+                engine_extremes[ENGINE_EXTREME_MAX_DRAWDOWN] = engine_extremes[ENGINE_EXTREME_PEAK_EQUITY] - \
+                    engine_extremes[ENGINE_EXTREME_EQUITY]
+
+            last_exit_index = exit_index
+
+            trade_number = engine_state[ENGINE_STATE_TRADE_COUNT]
+            trade_index_values[trade_number, ENGINE_TRADE_PERIOD] = period_index
+            trade_index_values[trade_number, ENGINE_TRADE_ENTRY_INDEX] = entry_index
+            trade_index_values[trade_number, ENGINE_TRADE_EXIT_INDEX] = exit_index
+            trade_index_values[trade_number, ENGINE_TRADE_ALL_EXIT_INDEX] = all_exit_index
+            trade_index_values[trade_number, ENGINE_TRADE_NEXT_ENTRY_INDEX] = next_entry_index
+            trade_index_values[trade_number, ENGINE_TRADE_DIRECTION] = period_entry_directions[trade_index]
+            trade_index_values[trade_number, ENGINE_TRADE_REASON] = reason_value
+            trade_price_values[trade_number, ENGINE_TRADE_RETURN] = trade_return
+            trade_price_values[trade_number, ENGINE_TRADE_ENTRY_PRICE] = entry_price
+            trade_price_values[trade_number, ENGINE_TRADE_EXIT_PRICE] = exit_price
+            trade_price_values[trade_number, ENGINE_TRADE_PROFIT_TARGET_PRICE] = profit_target_price
+            trade_price_values[trade_number, ENGINE_TRADE_STOP_LOSS_PRICE] = stop_loss_price
+            engine_state[ENGINE_STATE_TRADE_COUNT] += 1
+
+            if limit_trade_count > 0 and engine_state[ENGINE_STATE_TRADE_COUNT] >= limit_trade_count:
+                # Exceeded limit on allowed number of trades which is treated as a failure
+                engine_state[ENGINE_STATE_FAIL] = 1
+                return
+
+            if one_trade_per_week:
+                if daily_reset:
+                    engine_state[ENGINE_STATE_LAST_WEEK] = period_week_ids[period_index]
+
+                # For both daily and weekly reset, always break from processing further trades on the same period
+                break
+
+        if len(abort_rules) > 0:
+            abort_rule = find_abort_rule(abort_rules, period_index, period_week_ids, period_weeks_after,
+                                         engine_state[ENGINE_STATE_TRADE_COUNT], engine_state[ENGINE_STATE_TRADED_WEEKS],
+                                         engine_state[ENGINE_STATE_LAST_TRADED_WEEK],
+                                         engine_extremes[ENGINE_EXTREME_MAX_DRAWDOWN])
+            if abort_rule != ABORT_RULE_NONE:
+                engine_state[ENGINE_STATE_ABORT_RULE] = abort_rule
+                engine_state[ENGINE_STATE_FAIL] = 1
+                return
+
+
+@njit(cache=True, nogil=True)
+def sweep_exit_parameters(bars_open, bars_high, bars_low, bars_close, next_exits, high_tables, low_tables,
+                          period_offsets, period_lengths, period_week_ids,
+                          entry_offsets, entry_indices, entry_directions, period_signal_counts,
+                          max_trade_length, exit_grid, take_every_signal,
+                          one_trade_per_week, daily_reset, limit_trade_count, slippage,
+                          engine_state, engine_extremes, trade_index_values, trade_price_values, period_values,
+                          period_statistics, sweep_results):
+    # Simulates the same entries for each (stoploss, profit_target) row of exit_grid reusing the engine buffers
+    # Only the summary of each row is kept, in the population result columns of sweep_results
+    returns_array = np.zeros(0, dtype=np.float64)
+    period_count = len(period_offsets)
+    abort_rules = np.zeros((0, ABORT_RULE_COLUMNS), dtype=np.float64)
+    period_weeks_after = np.zeros(period_count, dtype=np.int64)
+
+    for grid_index in range(len(exit_grid)):
+        reset_engine_state(engine_state, engine_extremes)
+
+        simulate_trades(bars_open, bars_high, bars_low, bars_close, next_exits, high_tables, low_tables,
+                        period_offsets, period_lengths, period_week_ids,
+                        entry_offsets, entry_indices, entry_directions, period_signal_counts,
+                        returns_array, max_trade_length, exit_grid[grid_index, 0], exit_grid[grid_index, 1],
+                        take_every_signal, one_trade_per_week, daily_reset, limit_trade_count, slippage,
+                        0, period_count, engine_state, engine_extremes,
+                        trade_index_values, trade_price_values, period_values, period_statistics,
+                        abort_rules, period_weeks_after)
+
+        fail_strategy = engine_state[ENGINE_STATE_FAIL]
+        total_return = 0.0
+        if fail_strategy == 0:
+            for trade_number in range(engine_state[ENGINE_STATE_TRADE_COUNT]):
+                total_return += trade_price_values[trade_number, ENGINE_TRADE_RETURN]
+
+        sweep_results[grid_index, POPULATION_TRADE_COUNT] = engine_state[ENGINE_STATE_TRADE_COUNT]
+        sweep_results[grid_index, POPULATION_TOTAL_RETURN] = total_return
+        sweep_results[grid_index, POPULATION_BEST_PROFIT] = engine_extremes[ENGINE_EXTREME_BEST_PROFIT]
+        sweep_results[grid_index, POPULATION_WORST_LOSS] = engine_extremes[ENGINE_EXTREME_WORST_LOSS]
+        sweep_results[grid_index, POPULATION_SIGNAL_COUNT] = engine_state[ENGINE_STATE_SIGNAL_COUNT]
+        sweep_results[grid_index, POPULATION_PROFIT_TARGET_COUNT] = engine_state[ENGINE_STATE_PROFIT_TARGET_COUNT]
+        sweep_results[grid_index, POPULATION_STOPLOSS_COUNT] = engine_state[ENGINE_STATE_STOPLOSS_COUNT]
+        sweep_results[grid_index, POPULATION_FAIL] = fail_strategy
+
+
+@njit(cache=True, nogil=True)
+def reset_engine_state(engine_state, engine_extremes):
+    engine_state[:] = 0
+    engine_state[ENGINE_STATE_LAST_WEEK] = ENGINE_NO_WEEK
+    engine_state[ENGINE_STATE_LAST_TRADED_WEEK] = ENGINE_NO_WEEK
+    engine_state[ENGINE_STATE_ABORT_RULE] = ABORT_RULE_NONE
+    engine_extremes[:] = 0.0
+
+
+def create_engine_buffers(trade_capacity, period_count):
+    engine_state = np.zeros(ENGINE_STATE_COLUMNS, dtype=np.int64)
+    engine_extremes = np.zeros(ENGINE_EXTREME_COLUMNS, dtype=np.float64)
+    reset_engine_state(engine_state, engine_extremes)
+    trade_index_values = np.zeros((trade_capacity, ENGINE_TRADE_INDEX_COLUMNS), dtype=np.int64)
+    trade_price_values = np.zeros((trade_capacity, ENGINE_TRADE_PRICE_COLUMNS), dtype=np.float64)
+    period_values = np.zeros((period_count, ENGINE_PERIOD_COLUMNS), dtype=np.int64)
+    period_statistics = create_period_statistics(period_count)
+
+    return engine_state, engine_extremes, trade_index_values, trade_price_values, period_values, period_statistics
+
+
+def execute_trade_engine(bars_open, bars_high, bars_low, bars_close, next_exits,
+                         period_offsets, period_lengths, period_week_ids,
+                         entry_offsets, entry_indices, entry_directions, period_signal_counts,
+                         returns_array, max_trade_length, stop_loss, profit_target, take_every_signal,
+                         one_trade_per_week, daily_reset, limit_trade_count, slippage,
+                         first_passage_tables=None, abort_rules=None):
+    # abort_rules are from create_abort_rules and need period_week_ids
+    period_count = len(entry_offsets) - 1
+    if period_week_ids is None:
+        period_week_ids = np.zeros(period_count, dtype=np.int64)
+    abort_rules, period_weeks_after = create_engine_abort_rules(abort_rules, period_week_ids)
+    if first_passage_tables is None:
+        first_passage_tables = get_first_passage_tables(bars_high, bars_low)
+    high_tables, low_tables = first_passage_tables
+
+    # A trade needs an entry so the entry count bounds the number of trades
+    engine_state, engine_extremes, trade_index_values, trade_price_values, period_values, period_statistics = create_engine_buffers(
+        len(entry_indices), period_count)
+
+    # The compiled engine takes the flat values of ragged periods along with the period offsets and lengths
+    phase_start = start_profile_phase()
+    simulate_trades(unwrap_ragged_periods(bars_open), unwrap_ragged_periods(bars_high), unwrap_ragged_periods(bars_low),
+                    unwrap_ragged_periods(bars_close), unwrap_ragged_periods(next_exits), high_tables, low_tables,
+                    np.asarray(period_offsets, dtype=np.int64), np.asarray(period_lengths, dtype=np.int64), period_week_ids,
+                    entry_offsets, entry_indices, entry_directions, period_signal_counts,
+                    returns_array, max_trade_length, stop_loss, profit_target, take_every_signal,
+                    one_trade_per_week, daily_reset, limit_trade_count, slippage,
+                    0, period_count, engine_state, engine_extremes,
+                    trade_index_values, trade_price_values, period_values, period_statistics,
+                    abort_rules, period_weeks_after)
+    end_profile_phase(PROFILE_PHASE_TRADES, phase_start)
+
+    return engine_state, engine_extremes, trade_index_values, trade_price_values, period_values, period_statistics
+
+
+def create_engine_abort_rules(abort_rules, period_week_ids):
+    if abort_rules is None or len(abort_rules) == 0:
+        return create_empty_abort_rules(len(period_week_ids))
+    return abort_rules, create_period_weeks_after(period_week_ids)
+
+
+def grow_engine_trade_buffers(trade_index_values, trade_price_values, trade_capacity):
+    # Copies the trades into buffers that can hold at least trade_capacity trades
+    if trade_capacity <= len(trade_index_values):
+        return trade_index_values, trade_price_values
+
+    trade_capacity = max(trade_capacity, 2 * len(trade_index_values))
+    grown_index_values = np.zeros((trade_capacity, ENGINE_TRADE_INDEX_COLUMNS), dtype=np.int64)
+    grown_price_values = np.zeros((trade_capacity, ENGINE_TRADE_PRICE_COLUMNS), dtype=np.float64)
+    grown_index_values[:len(trade_index_values)] = trade_index_values
+    grown_price_values[:len(trade_price_values)] = trade_price_values
+
+    return grown_index_values, grown_price_values
+
+
+def stream_trade_engine(strategy, market, bars_open, bars_high, bars_low, bars_close, bars_volume,
+                        timed_exits, next_exits, allowed_entry_days, allowed_entry_sessions,
+                        period_offsets, period_lengths, period_week_ids,
+                        allowed_entry_session_index, allowed_entry_day_indexes,
+                        indicator_cache_lookup, strategy_trace, pool, pid, allowed_minutes_per_period,
+                        period_count, shared_dataset_layout, period_chunk_size, returns_array, max_trade_length, take_every_signal,
+                        one_trade_per_week, daily_reset, limit_trade_count, slippage,
+                        first_passage_tables=None, abort_rules=None, pool_processes=None):
+    # Calculates the entries of period_chunk_size periods at a time and simulates them before moving on, so only
+    # one chunk of entries is alive at once. The engine state carries the counters from chunk to chunk
+    if period_week_ids is None:
+        period_week_ids = np.zeros(period_count, dtype=np.int64)
+    abort_rules, period_weeks_after = create_engine_abort_rules(abort_rules, period_week_ids)
+    if first_passage_tables is None:
+        first_passage_tables = get_first_passage_tables(bars_high, bars_low)
+    high_tables, low_tables = first_passage_tables
+    period_offsets = np.asarray(period_offsets, dtype=np.int64)
+    period_lengths = np.asarray(period_lengths, dtype=np.int64)
+
+    engine_state, engine_extremes, trade_index_values, trade_price_values, period_values, period_statistics = create_engine_buffers(
+        0, period_count)
+
+    # Offsets of the current chunk's entries, indexed by period like the packed entries of the whole history
+    entry_offsets = np.zeros(period_count + 1, dtype=np.int64)
+    period_signal_counts = np.zeros(period_count, dtype=np.int64)
+
+    for chunk_start in range(0, period_count, max(1, period_chunk_size)):
+        chunk_end = min(chunk_start + max(1, period_chunk_size), period_count)
+        chunk_offsets, chunk_indices, chunk_directions, chunk_signal_counts = calculate_all_entries(
+            strategy, market, bars_open, bars_high, bars_low, bars_close, bars_volume,
+            timed_exits, allowed_entry_days, allowed_entry_sessions,
+            period_lengths, allowed_entry_session_index, allowed_entry_day_indexes,
+            indicator_cache_lookup, strategy_trace, pool, pid, allowed_minutes_per_period, period_count,
+            shared_dataset_layout, next_exits, chunk_start, chunk_end, pool_processes)
+        entry_offsets[chunk_start:chunk_end + 1] = chunk_offsets
+        period_signal_counts[chunk_start:chunk_end] = chunk_signal_counts
+
+        # A trade needs an entry so the trades so far plus the chunk's entries bound the number of trades
+        trade_index_values, trade_price_values = grow_engine_trade_buffers(
+            trade_index_values, trade_price_values, engine_state[ENGINE_STATE_TRADE_COUNT] + len(chunk_indices))
+
+        phase_start = start_profile_phase()
+        simulate_trades(unwrap_ragged_periods(bars_open), unwrap_ragged_periods(bars_high),
+                        unwrap_ragged_periods(bars_low), unwrap_ragged_periods(bars_close),
+                        unwrap_ragged_periods(next_exits), high_tables, low_tables,
+                        period_offsets, period_lengths, period_week_ids,
+                        entry_offsets, chunk_indices, chunk_directions, period_signal_counts,
+                        returns_array, max_trade_length, strategy['stoploss'], strategy['profit_target'],
+                        take_every_signal, one_trade_per_week, daily_reset, limit_trade_count, slippage,
+                        chunk_start, chunk_end, engine_state, engine_extremes,
+                        trade_index_values, trade_price_values, period_values, period_statistics,
+                        abort_rules, period_weeks_after)
+        end_profile_phase(PROFILE_PHASE_TRADES, phase_start)
+
+        del chunk_offsets, chunk_indices, chunk_directions, chunk_signal_counts
+
+        if engine_state[ENGINE_STATE_FAIL] == 1:
+            break
+
+    return engine_state, engine_extremes, trade_index_values, trade_price_values, period_values, period_statistics
+
+
+def run_trade_engine(all_datetimes, bars_open, bars_high, bars_low, bars_close, next_exits,
+                     period_offsets, period_lengths, period_week_ids,
+                     entry_offsets, entry_indices, entry_directions, period_signal_counts,
+                     returns_array, trade_entry_datetimes, trade_returns,
+                     max_trade_length, stop_loss, profit_target, take_every_signal,
+                     one_trade_per_week, daily_reset, limit_trade_count, slippage,
+                     calculate_trade_dataframe, first_passage_tables=None, backtest_report=None,
+                     abort_rules=None, abort_rule_names=None):
+    # Runs simulate_trades over the whole history and converts its arrays to the outputs of calculate_trades
+    engine_state, engine_extremes, trade_index_values, trade_price_values, period_values, period_statistics = execute_trade_engine(
+        bars_open, bars_high, bars_low, bars_close, next_exits,
+        period_offsets, period_lengths, period_week_ids,
+        entry_offsets, entry_indices, entry_directions, period_signal_counts,
+        returns_array, max_trade_length, stop_loss, profit_target, take_every_signal,
+        one_trade_per_week, daily_reset, limit_trade_count, slippage, first_passage_tables, abort_rules)
+
+    if backtest_report is not None:
+        backtest_report['trade_spans'] = create_engine_trade_spans(engine_state, trade_index_values,
+                                                                   trade_price_values, period_offsets)
+        backtest_report['period_statistics'] = period_statistics
+        backtest_report['abort_rule'] = get_engine_abort_rule(engine_state, abort_rule_names)
+
+    return convert_engine_results(all_datetimes, period_offsets, bars_open, bars_close, engine_state, engine_extremes,
+                                  trade_index_values, trade_price_values, period_values,
+                                  trade_entry_datetimes, trade_returns, calculate_trade_dataframe)
+
+
+def get_engine_abort_rule(engine_state, abort_rule_names):
+    # Name of the abort rule that stopped the trade engine, None when no rule fired
+    if engine_state[ENGINE_STATE_ABORT_RULE] == ABORT_RULE_NONE:
+        return None
+    return abort_rule_names[engine_state[ENGINE_STATE_ABORT_RULE]]
+
+
+def create_engine_trade_spans(engine_state, trade_index_values, trade_price_values, period_offsets):
+    # Trade spans hold what is needed to rebuild the minute returns of the trades
+    trade_count = engine_state[ENGINE_STATE_TRADE_COUNT]
+    trade_index_values = trade_index_values[:trade_count]
+    trade_offsets = np.asarray(period_offsets, dtype=np.int64)[trade_index_values[:, ENGINE_TRADE_PERIOD]]
+
+    span_indices, span_prices = create_trade_spans(trade_count)
+    span_indices[:, TRADE_SPAN_START] = trade_offsets + trade_index_values[:, ENGINE_TRADE_ENTRY_INDEX]
+    span_indices[:, TRADE_SPAN_END] = trade_index_values[:, ENGINE_TRADE_ALL_EXIT_INDEX]
+    span_indices[:, TRADE_SPAN_DIRECTION] = trade_index_values[:, ENGINE_TRADE_DIRECTION]
+    span_prices[:, TRADE_SPAN_ENTRY_PRICE] = trade_price_values[:trade_count, ENGINE_TRADE_ENTRY_PRICE]
+    span_prices[:, TRADE_SPAN_EXIT_PRICE] = trade_price_values[:trade_count, ENGINE_TRADE_EXIT_PRICE]
+
+    return span_indices, span_prices
+
+
+def get_bar_timestamps(all_datetimes, bar_indexes):
+    # The bars keep their datetimes as epoch minutes so reported datetimes are looked up in all_datetimes,
+    # which keeps the resolution the bars were loaded with
+    return pd.DatetimeIndex(np.asarray(all_datetimes)[bar_indexes])
+
+
+def convert_engine_results(all_datetimes, period_offsets, bars_open, bars_close, engine_state, engine_extremes,
+                           trade_index_values, trade_price_values, period_values,
+                           trade_entry_datetimes, trade_returns, calculate_trade_dataframe):
+    phase_start = start_profile_phase()
+    trade_count = engine_state[ENGINE_STATE_TRADE_COUNT]
+    trade_index_values = trade_index_values[:trade_count]
+    trade_price_values = trade_price_values[:trade_count]
+
+    trade_periods = trade_index_values[:, ENGINE_TRADE_PERIOD]
+    trade_entry_indexes = trade_index_values[:, ENGINE_TRADE_ENTRY_INDEX]
+    trade_exit_indexes = trade_index_values[:, ENGINE_TRADE_EXIT_INDEX]
+    trade_next_entry_indexes = trade_index_values[:, ENGINE_TRADE_NEXT_ENTRY_INDEX]
+    trade_entry_prices = trade_price_values[:, ENGINE_TRADE_ENTRY_PRICE]
+
+    period_offsets = np.asarray(period_offsets, dtype=np.int64)
+    fail_strategy = engine_state[ENGINE_STATE_FAIL] == 1
+    if not fail_strategy:
+        trade_entry_datetimes.extend(get_bar_timestamps(all_datetimes, period_offsets[trade_periods] + trade_entry_indexes))
+        trade_returns.extend(trade_price_values[:, ENGINE_TRADE_RETURN].tolist())
+
+    trade_indexes = list(zip(trade_periods.tolist(), trade_entry_prices.tolist(),
+                             trade_next_entry_indexes.tolist(), trade_exit_indexes.tolist()))
+
+    trade_records = None
+    if calculate_trade_dataframe:
+        # A failed strategy has no trade returns so it has no trade records either
+        record_count = 0 if fail_strategy else trade_count
+        trade_records = create_trade_records(record_count)
+        trade_periods = trade_periods[:record_count]
+        trade_index_values = trade_index_values[:record_count]
+        trade_price_values = trade_price_values[:record_count]
+        trade_reasons = trade_index_values[:, ENGINE_TRADE_REASON]
+
+        trade_records['direction'] = trade_index_values[:, ENGINE_TRADE_DIRECTION]
+        trade_records['entry_index'] = period_offsets[trade_periods] + \
+            trade_index_values[:, ENGINE_TRADE_ENTRY_INDEX]
+        trade_records['exit_index'] = trade_index_values[:, ENGINE_TRADE_ALL_EXIT_INDEX]
+        trade_records['entry_price'] = trade_price_values[:, ENGINE_TRADE_ENTRY_PRICE]
+        trade_records['exit_price'] = trade_price_values[:, ENGINE_TRADE_EXIT_PRICE]
+        trade_records['reason'] = trade_reasons
+        trade_records['profit_target'] = trade_price_values[:, ENGINE_TRADE_PROFIT_TARGET_PRICE]
+        trade_records['stoploss'] = trade_price_values[:, ENGINE_TRADE_STOP_LOSS_PRICE]
+        trade_records['entry_price_before_slippage'] = bars_open[
+            trade_periods, trade_index_values[:, ENGINE_TRADE_NEXT_ENTRY_INDEX]]
+        trade_records['exit_price_before_slippage'] = np.where(
+            trade_reasons == EXIT_REASON_STOPLOSS, trade_records['stoploss'],
+            np.where(trade_reasons == EXIT_REASON_PROFIT_TARGET, trade_records['profit_target'],
+                     bars_close[trade_periods, trade_index_values[:, ENGINE_TRADE_EXIT_INDEX]]))
+
+    # Track the counts by first date in the period
+    signal_counts = {}
+    profit_target_counts = {}
+    stoploss_counts = {}
+    processed_periods = np.flatnonzero(period_values[:, ENGINE_PERIOD_PROCESSED])
+    for period_index, period_start in zip(processed_periods,
+                                          get_bar_timestamps(all_datetimes, period_offsets[processed_periods])):
+        signal_counts[period_start] = period_values[period_index, ENGINE_PERIOD_SIGNAL_COUNT]
+        profit_target_counts[period_start] = period_values[period_index, ENGINE_PERIOD_PROFIT_TARGET_COUNT]
+        stoploss_counts[period_start] = period_values[period_index, ENGINE_PERIOD_STOPLOSS_COUNT]
+
+    best_profit = engine_extremes[ENGINE_EXTREME_BEST_PROFIT]
+    worst_loss = engine_extremes[ENGINE_EXTREME_WORST_LOSS]
+    end_profile_phase(PROFILE_PHASE_RETURNS, phase_start)
+
+    return trade_records, signal_counts, profit_target_counts, stoploss_counts, trade_indexes, best_profit, worst_loss, fail_strategy
+
+
 def write_outputs(strategy_id, trade_df, returns_array, all_datetimes):
     trades_filename = f'{settings.write_all_path}/strategy_{strategy_id}.trades.csv'
     trade_df.to_csv(trades_filename, mode='w', index=False)
@@ -691,8 +2052,11 @@ def write_outputs(strategy_id, trade_df, returns_array, all_datetimes):
     returns_series.to_csv(minutely_returns_filename, mode='w', index=True)
     print(f"Minutely returns written to {minutely_returns_filename}")
 
-    hourly_returns = returns_series.resample('1h').sum()
-    cumulative_hourly_returns = hourly_returns.cumsum()
+    # Sum the minutes of each hour and add back the hours with no bars so every calendar hour is written
+    hour_starts, hour_datetimes = create_return_bucket_offsets(all_datetimes, ReturnBucket.Hour)
+    hourly_returns, hour_datetimes = fill_empty_bucket_returns(
+        aggregate_bucket_returns(returns_array, hour_starts), hour_datetimes, np.timedelta64(1, 'h'))
+    cumulative_hourly_returns = pd.Series(np.cumsum(hourly_returns), index=hour_datetimes)
 
     custom_headers = [f'Strategy_{strategy_id}']
     hourly_returns_filename = f'{settings.write_all_path}/strategy_{strategy_id}.returns.csv'
@@ -782,19 +2146,41 @@ if __name__ == "__main__":
     if isinstance(indicator_reset, int):
         indicator_reset = IndicatorReset(indicator_reset)
 
-    holidays_df = get_holidays(settings.host, settings.strategies_database, settings.user, settings.password)
-    bars, period_lookup, period_offsets, period_lengths, all_datetimes, all_closes, day_of_week_lookup = get_database_data(
-        settings.host, settings.user, settings.password, market, settings.start, settings.end, "all", holidays_df,
-        indicator_reset)
-    timed_exits = create_all_exits(settings.host, settings.strategies_database, settings.user, settings.password, bars, market, period_lookup,
-                                   indicator_reset)
-    allowed_entry_sessions, allowed_entry_days = create_allowed_entries(bars, indicator_reset)
-    period_count = bars.shape[2]
+    dataset_store_path = None
+    if settings.use_dataset_store:
+        dataset_store_path = get_dataset_store_path(market, indicator_reset)
+        (bars, period_lookup, period_offsets, period_lengths, all_datetimes, all_closes, day_of_week_lookup,
+         timed_exits, allowed_entry_sessions, allowed_entry_days, next_exits,
+         first_passage_tables) = load_dataset_store(dataset_store_path)
+    else:
+        holidays_df = get_holidays(settings.host, settings.strategies_database, settings.user, settings.password)
+        bars, period_lookup, period_offsets, period_lengths, all_datetimes, all_closes, day_of_week_lookup = get_database_data(
+            settings.host, settings.user, settings.password, market, settings.start, settings.end, "all", holidays_df,
+            indicator_reset, settings.bar_layout)
+        timed_exits = create_all_exits(settings.host, settings.strategies_database, settings.user, settings.password, bars, market, period_lookup,
+                                       indicator_reset)
+        next_exits = create_next_exits(timed_exits)
+        allowed_entry_sessions, allowed_entry_days = create_allowed_entries(bars, indicator_reset)
+
+        first_passage_tables = None
+        if settings.bar_layout in (BarLayout.Matrix, BarLayout.Ragged):
+            first_passage_tables = create_first_passage_tables(bars[BarTypes.Minute1.value][OHLC.High.value],
+                                                               bars[BarTypes.Minute1.value][OHLC.Low.value])
+    period_count = get_period_count(bars)
 
     pool_size = min(settings.population_size, mp.cpu_count())
     # pool = mp.Pool(processes=pool_size)
     pool = None
 
+    shared_dataset_layout = None
+    if pool is not None:
+        if dataset_store_path is not None:
+            # Workers map the store files rather than a copy of the bars in shared memory
+            shared_dataset_layout = create_dataset_store_layout(dataset_store_path)
+        else:
+            shared_dataset_layout = create_shared_dataset(0, market, indicator_reset.name, bars, timed_exits,
+                                                          allowed_entry_sessions, allowed_entry_days, next_exits)
+
     start_backtest_time = time.time()
     (returns_array, trade_entry_datetimes, trade_returns, trade_df, signal_counts,
      profit_target_counts, stoploss_counts, trade_indexes, best_profit, worst_loss, fail_strategy) = run_strategy(
@@ -814,10 +2200,15 @@ if __name__ == "__main__":
         slippage,
         period_count,
         write_strategy_trace=write_strategy_trace, 
-        pool=pool)
+        pool=pool,
+        shared_dataset_layout=shared_dataset_layout,
+        first_passage_tables=first_passage_tables,
+        next_exits=next_exits)
     end_backtest_time = time.time()
 
     write_outputs(strategy_id, trade_df, returns_array, all_datetimes)
+    if write_strategy_trace:
+        print(f"Strategy trace written to {get_strategy_trace_filename()}")
 
     backtester_time_ms = (end_backtest_time - start_backtest_time) * 1000
     print(f"Backtester Time: {backtester_time_ms:.2f}ms")
@@ -825,5 +2216,6 @@ if __name__ == "__main__":
     if pool != None:
         pool.close()
         pool.join()
+        cleanup_shared_memory()
 
     print(f'Finished')
@@ -0,0 +1,436 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from constants import BarTypes, OHLC, IndicatorReset, BarLayout, Session, DecisionCombiner, START_DAY_TRADING_HOUR
+from database_reference import get_database_data, get_period_count
+from trade_timing import create_end_of_day_exits, create_event_exits, create_session_end_exits, \
+    create_allowed_entries, create_next_exits
+from first_passage import create_first_passage_tables
+from indicator_registry import calculate_max_lookback
+from epoch_minutes import MINUTES_PER_HOUR, MINUTES_PER_CALENDAR_DAY
+from backtester import run_strategy, calculate_indicator_signals, calculate_allowed_entries, \
+    combine_strategy_decisions, calculate_trade, calculate_allowed_entry_day_indexes, get_strategy_session_index
+import settings
+
+# Times the kernels and whole strategies of the backtester on synthetic minute bars, so they can be measured without
+# the bars database, and checks their results bit for bit against a stored baseline so a speed up comes with proof
+# that the backtests are unchanged
+# The baseline holds the run_strategy results of every reset, which do not depend on the layout. The checked in
+# benchmark_baseline.npz was written by the backtester from before the bar layouts and the trade engine, loading these
+# synthetic bars and events in place of get_bars and the database events
+
+BENCHMARK_MARKET = 'BENCHMARK'
+# A Sunday, the first synthetic bars are of the week starting that evening
+BENCHMARK_START = '2023-01-01'
+BENCHMARK_START_PRICE = 100.0
+BENCHMARK_TICK_SIZE = 0.01
+BENCHMARK_SLIPPAGE = 0.0001
+BENCHMARK_MAX_TRADE_LENGTH = 60
+
+# The week trades from Sunday START_DAY_TRADING_HOUR + 1 to Friday START_DAY_TRADING_HOUR in minutes after Sunday 00:00
+WEEK_OPEN_MINUTE = (START_DAY_TRADING_HOUR + 1) * MINUTES_PER_HOUR
+WEEK_CLOSE_MINUTE = 5 * MINUTES_PER_CALENDAR_DAY + START_DAY_TRADING_HOUR * MINUTES_PER_HOUR
+
+# Volatility of a minute's return and mean volume by hour of the day, quiet in Asia and busiest after the US open
+session_volatility = np.array([0.00012] * 2 + [0.00018] * 7 + [0.00030] * 7 + [0.00015] * 2 + [0.00010] * 6)
+session_volume = np.array([40.0] * 2 + [120.0] * 7 + [400.0] * 7 + [80.0] * 2 + [30.0] * 6)
+
+# Indicators of the benchmark strategies, a strategy of n indicators uses the first n
+# After an entry a strategy waits for every indicator to be flat, which the RSIs are between their thresholds but the
+# moving averages never are, so the RSIs come first to give the one and two indicator strategies many trades
+benchmark_indicators = [
+    ['RSI_TA_With', {'bar_type': 1, 'timeperiod': 14, 'upper_threshold': 60, 'lower_threshold': 40}],
+    ['RSI_TA_With', {'bar_type': 1, 'timeperiod': 30, 'upper_threshold': 55, 'lower_threshold': 45}],
+    ['SMA_With', {'bar_type': 1, 'timeperiod': 30}],
+    ['EMA_With', {'bar_type': 1, 'timeperiod': 120}],
+]
+benchmark_indicator_counts = [1, 2, 4]
+
+
+def create_synthetic_bars(start, week_count, seed=0):
+    # Minute bars the way get_bars returns them, each stamped at the end of its minute
+    # The market trades from Sunday evening to Friday afternoon with a daily break of an hour
+    rng = np.random.default_rng(seed)
+    week_start = pd.Timestamp(start).normalize()
+
+    minute_offsets = np.arange(1, week_count * 7 * MINUTES_PER_CALENDAR_DAY + 1, dtype=np.int64)
+    minute_of_week = minute_offsets % (7 * MINUTES_PER_CALENDAR_DAY)
+    minute_of_day = minute_offsets % MINUTES_PER_CALENDAR_DAY
+    trading = (minute_of_week > WEEK_OPEN_MINUTE - MINUTES_PER_HOUR) & (minute_of_week <= WEEK_CLOSE_MINUTE) & \
+        ~((minute_of_day > START_DAY_TRADING_HOUR * MINUTES_PER_HOUR) &
+          (minute_of_day <= (START_DAY_TRADING_HOUR + 1) * MINUTES_PER_HOUR))
+    minute_offsets = minute_offsets[trading]
+    datetimes = week_start + pd.to_timedelta(minute_offsets, unit='min')
+
+    hours = ((minute_offsets - 1) % MINUTES_PER_CALENDAR_DAY) // MINUTES_PER_HOUR
+    minute_returns = rng.standard_normal(len(minute_offsets)) * session_volatility[hours]
+    # The first minute after the daily break and the weekend opens with a gap
+    gaps = np.ones(len(minute_offsets), dtype=bool)
+    gaps[1:] = np.diff(minute_offsets) > 1
+    minute_returns[gaps] *= 10
+
+    closes = np.round(BENCHMARK_START_PRICE * np.exp(np.cumsum(minute_returns)) / BENCHMARK_TICK_SIZE) * BENCHMARK_TICK_SIZE
+    opens = np.empty(len(closes), dtype=np.float64)
+    opens[0] = BENCHMARK_START_PRICE
+    opens[1:] = closes[:-1]
+    wicks = np.abs(rng.standard_normal((2, len(closes)))) * session_volatility[hours] * closes
+    highs = np.maximum(opens, closes) + np.round(wicks[0] / BENCHMARK_TICK_SIZE) * BENCHMARK_TICK_SIZE
+    lows = np.minimum(opens, closes) - np.round(wicks[1] / BENCHMARK_TICK_SIZE) * BENCHMARK_TICK_SIZE
+    volumes = rng.poisson(session_volume[hours]).astype(np.float64) + 1
+
+    bars_df = pd.DataFrame({'datetime': datetimes, 'symbol': BENCHMARK_MARKET, 'open': opens, 'high': highs,
+                            'low': lows, 'close': closes, 'volume': volumes})
+    bars_df.set_index('datetime', inplace=True, drop=False)
+
+    return bars_df
+
+
+def create_synthetic_holidays(start, week_count):
+    # Holidays the way get_holidays returns them, a Monday closed every sixth week and a Friday that closes
+    # early every fifth week
+    week_start = pd.Timestamp(start).normalize()
+    holidays = []
+    for week_index in range(week_count):
+        week_sunday = week_start + pd.Timedelta(days=7 * week_index)
+        if week_index % 6 == 2:
+            holidays.append(('Closed', week_sunday + pd.Timedelta(hours=START_DAY_TRADING_HOUR + 1),
+                             week_sunday + pd.Timedelta(days=1, hours=START_DAY_TRADING_HOUR)))
+        if week_index % 5 == 3:
+            holidays.append(('Early Close', week_sunday + pd.Timedelta(days=5, hours=12),
+                             week_sunday + pd.Timedelta(days=5, hours=START_DAY_TRADING_HOUR)))
+
+    holidays_df = pd.DataFrame(holidays, columns=['name', 'start', 'end'])
+    holidays_df['start'] = pd.to_datetime(holidays_df['start'])
+    holidays_df['end'] = pd.to_datetime(holidays_df['end'])
+
+    return holidays_df
+
+
+def create_synthetic_risk_events(start, week_count):
+    # Risk events the way get_risk_events returns them, from 5 minutes before to 15 minutes after a release
+    # every Wednesday at 14:00 and every Friday at 08:30
+    week_start = pd.Timestamp(start).normalize()
+    risk_events = []
+    for week_index in range(week_count):
+        week_sunday = week_start + pd.Timedelta(days=7 * week_index)
+        for event_code, release in (('WED', pd.Timedelta(days=3, hours=14)),
+                                    ('FRI', pd.Timedelta(days=5, hours=8, minutes=30))):
+            risk_events.append((event_code, week_sunday + release - pd.Timedelta(minutes=5),
+                                week_sunday + release + pd.Timedelta(minutes=15)))
+
+    risk_events_df = pd.DataFrame(risk_events, columns=['event_code', 'start', 'end'])
+    risk_events_df['start'] = pd.to_datetime(risk_events_df['start'])
+    risk_events_df['end'] = pd.to_datetime(risk_events_df['end'])
+
+    return risk_events_df
+
+
+def load_benchmark_dataset(indicator_reset, layout, week_count, seed=0):
+    # Bars, exits and entry masks the way the backtester loads them for a market, built from synthetic bars
+    holidays_df = create_synthetic_holidays(BENCHMARK_START, week_count)
+    bars, period_lookup, period_offsets, period_lengths, all_datetimes, all_closes, day_of_week_lookup = get_database_data(
+        None, None, None, BENCHMARK_MARKET, None, None, 'benchmark', holidays_df, indicator_reset, layout,
+        {BarTypes.Minute1: create_synthetic_bars(BENCHMARK_START, week_count, seed)})
+
+    # Same order as create_all_exits
+    timed_exits = create_end_of_day_exits(bars)
+    create_event_exits(bars, timed_exits, period_lookup, indicator_reset,
+                       create_synthetic_risk_events(BENCHMARK_START, week_count))
+    create_event_exits(bars, timed_exits, period_lookup, indicator_reset, holidays_df.copy())
+    create_session_end_exits(bars, timed_exits)
+    allowed_entry_sessions, allowed_entry_days = create_allowed_entries(bars, indicator_reset)
+
+    first_passage_tables = None
+    if layout in (BarLayout.Matrix, BarLayout.Ragged):
+        first_passage_tables = create_first_passage_tables(bars[BarTypes.Minute1.value][OHLC.High.value],
+                                                           bars[BarTypes.Minute1.value][OHLC.Low.value])
+
+    return {
+        'bars': bars,
+        'period_offsets': period_offsets,
+        'period_lengths': period_lengths,
+        'period_count': get_period_count(bars),
+        'all_datetimes': all_datetimes,
+        'timed_exits': timed_exits,
+        'next_exits': create_next_exits(timed_exits),
+        'allowed_entry_sessions': allowed_entry_sessions,
+        'allowed_entry_days': allowed_entry_days,
+        'first_passage_tables': first_passage_tables,
+    }
+
+
+def create_benchmark_strategy(indicator_reset, indicator_count, take_every_signal):
+    return {
+        'indicators': benchmark_indicators[:indicator_count],
+        'stoploss': 0.002,
+        'profit_target': 0.003,
+        'max_trade_length': BENCHMARK_MAX_TRADE_LENGTH,
+        'session': Session.All.value,
+        'monday': 1, 'tuesday': 1, 'wednesday': 1, 'thursday': 1, 'friday': 1,
+        'take_every_signal': take_every_signal,
+        'one_trade_per_week': False,
+        'indicator_reset': indicator_reset.value,
+    }
+
+
+def time_benchmark(benchmark, repeats):
+    # Runs once to compile and warm up, then returns the seconds of each timed run and the last result
+    result = benchmark()
+    run_seconds = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = benchmark()
+        run_seconds.append(time.perf_counter() - start_time)
+
+    return run_seconds, result
+
+
+def calculate_benchmark_indicator(dataset, indicator_name, params):
+    # Signals of every period the way calculate_entries gets them, as long as the period's row of the bars
+    bars = dataset['bars'][BarTypes.Minute1.value]
+    period_signals = []
+    for period_index in range(dataset['period_count']):
+        period_signals.append(calculate_indicator_signals(
+            {}, indicator_name, params, bars[OHLC.Open.value], bars[OHLC.High.value], bars[OHLC.Low.value],
+            bars[OHLC.Close.value], bars[OHLC.Volume.value], period_index))
+
+    return period_signals
+
+
+def calculate_benchmark_allowed_entries(dataset, strategy):
+    allowed_entry_session_index = get_strategy_session_index(strategy)
+    allowed_entry_day_indexes = calculate_allowed_entry_day_indexes(strategy)
+    strategy_max_lookback = calculate_max_lookback(strategy)
+
+    period_allowed_entries = []
+    for period_index in range(dataset['period_count']):
+        allowed_entries = calculate_allowed_entries(dataset['timed_exits'], dataset['next_exits'][period_index],
+                                                    dataset['allowed_entry_days'], dataset['allowed_entry_sessions'],
+                                                    period_index, allowed_entry_session_index,
+                                                    allowed_entry_day_indexes, strategy['max_trade_length'])
+        allowed_entries[:min(strategy_max_lookback, len(allowed_entries))] = False
+        period_allowed_entries.append(allowed_entries)
+
+    return period_allowed_entries
+
+
+def calculate_benchmark_decisions(dataset, decision_combiner, period_allowed_entries, indicator_signals):
+    # indicator_signals has the signals of each period for each indicator, see calculate_benchmark_indicator
+    period_decisions = []
+    for period_index in range(dataset['period_count']):
+        period_minutes = len(period_allowed_entries[period_index])
+        long_signals = np.empty((len(indicator_signals), period_minutes), dtype=bool)
+        short_signals = np.empty((len(indicator_signals), period_minutes), dtype=bool)
+        for indicator_index in range(len(indicator_signals)):
+            long_signals[indicator_index], short_signals[indicator_index] = indicator_signals[indicator_index][period_index]
+        period_decisions.append(combine_strategy_decisions(decision_combiner, period_allowed_entries[period_index],
+                                                           long_signals, short_signals,
+                                                           dataset['period_lengths'][period_index]))
+
+    return period_decisions
+
+
+def calculate_benchmark_trades(dataset, strategy, period_decisions, returns_array):
+    # Every entry of every period through calculate_trade, searching highs and lows without first passage tables
+    bars = dataset['bars'][BarTypes.Minute1.value]
+    empty_first_passage_table = np.empty((0, 0), dtype=np.float64)
+    returns_array[:] = 0.0
+    trade_values = []
+    for period_index in range(dataset['period_count']):
+        entry_indices = np.where(period_decisions[period_index] != 0)[0]
+        for trade_index in range(len(entry_indices)):
+            entry_index = entry_indices[trade_index]
+            (trade_return, reason, exit_index, all_exit_index, is_profit_target, is_stoploss, next_entry_index,
+             entry_price, exit_price, profit_target_price, stop_loss_price) = calculate_trade(
+                bars[OHLC.Open.value][period_index], bars[OHLC.High.value][period_index],
+                bars[OHLC.Low.value][period_index], bars[OHLC.Close.value][period_index], returns_array,
+                entry_index, period_decisions[period_index][entry_index], strategy['max_trade_length'],
+                strategy['stoploss'], strategy['profit_target'], strategy['take_every_signal'], BENCHMARK_SLIPPAGE,
+                dataset['next_exits'][period_index], dataset['period_offsets'][period_index],
+                trade_index, entry_indices, empty_first_passage_table, empty_first_passage_table)
+            trade_values.append((trade_return, exit_price, all_exit_index, reason))
+
+    return np.array(trade_values, dtype=np.float64).reshape(-1, 4)
+
+
+def run_benchmark_strategy(dataset, strategy, returns_array):
+    bars = dataset['bars'][BarTypes.Minute1.value]
+    backtest_report = {}
+    returns_array[:] = 0.0
+    (returns_array, trade_entry_datetimes, trade_returns, trade_df, signal_counts, profit_target_counts,
+     stoploss_counts, trade_indexes, best_profit, worst_loss, fail_strategy) = run_strategy(
+        strategy, BENCHMARK_MARKET, True,
+        bars[OHLC.DateTime.value], bars[OHLC.Open.value], bars[OHLC.High.value], bars[OHLC.Low.value],
+        bars[OHLC.Close.value], bars[OHLC.Volume.value],
+        dataset['timed_exits'], dataset['allowed_entry_days'], dataset['allowed_entry_sessions'],
+        dataset['period_offsets'], dataset['period_lengths'], dataset['all_datetimes'], BENCHMARK_SLIPPAGE,
+        dataset['period_count'],
+        buffer_returns_array=returns_array,
+        first_passage_tables=dataset['first_passage_tables'],
+        next_exits=dataset['next_exits'],
+        backtest_report=backtest_report,
+        use_entry_cache=False)
+
+    return {
+        'returns': returns_array.copy(),
+        'trade_returns': trade_returns,
+        'trade_entry_datetimes': pd.DatetimeIndex(trade_entry_datetimes).as_unit('ns').asi8,
+        'trade_records': backtest_report['trade_records'],
+    }
+
+
+def run_benchmarks(week_count=None, repeats=None, layouts=None):
+    # Returns the timings of every benchmark and the results to check against the baseline by name
+    if week_count is None:
+        week_count = settings.benchmark_weeks
+    if repeats is None:
+        repeats = settings.benchmark_repeats
+    if layouts is None:
+        layouts = settings.benchmark_layouts
+
+    timings = []
+    benchmark_results = {}
+
+    def add_timing(benchmark_name, run_seconds):
+        timings.append({'benchmark': benchmark_name, 'runs': len(run_seconds),
+                        'min_ms': min(run_seconds) * 1000, 'mean_ms': np.mean(run_seconds) * 1000})
+
+    for indicator_reset in IndicatorReset:
+        for layout in layouts:
+            dataset = load_benchmark_dataset(indicator_reset, layout, week_count)
+            dataset_name = f'{layout.name}.{indicator_reset.name}'
+            returns_array = np.zeros(len(dataset['all_datetimes']), dtype=np.float64)
+
+            indicator_signals = []
+            for indicator_index, (indicator_name, params) in enumerate(benchmark_indicators):
+                # Named by position too as an indicator can be benchmarked with different params
+                indicator_benchmark_name = f'{dataset_name}.indicator.{indicator_index}.{indicator_name}'
+                run_seconds, period_signals = time_benchmark(
+                    lambda: calculate_benchmark_indicator(dataset, indicator_name, params), repeats)
+                add_timing(indicator_benchmark_name, run_seconds)
+                benchmark_results[f'{indicator_benchmark_name}.long'] = \
+                    np.concatenate([long_signals for long_signals, _ in period_signals])
+                benchmark_results[f'{indicator_benchmark_name}.short'] = \
+                    np.concatenate([short_signals for _, short_signals in period_signals])
+                indicator_signals.append(period_signals)
+
+            # The kernels are timed on the strategy of every benchmark indicator
+            strategy = create_benchmark_strategy(indicator_reset, len(benchmark_indicators), True)
+            period_allowed_entries = calculate_benchmark_allowed_entries(dataset, strategy)
+            run_seconds, period_decisions = time_benchmark(
+                lambda: calculate_benchmark_decisions(dataset, DecisionCombiner.Minute, period_allowed_entries,
+                                                      indicator_signals), repeats)
+            add_timing(f'{dataset_name}.calculate_strategy_decisions', run_seconds)
+            benchmark_results[f'{dataset_name}.calculate_strategy_decisions'] = np.concatenate(period_decisions)
+            check_benchmark_count(f'{dataset_name}.calculate_strategy_decisions',
+                                  np.count_nonzero(benchmark_results[f'{dataset_name}.calculate_strategy_decisions']),
+                                  'entries')
+
+            # The interval combiner has to give the same decisions as the minute one
+            run_seconds, period_interval_decisions = time_benchmark(
+                lambda: calculate_benchmark_decisions(dataset, DecisionCombiner.Interval, period_allowed_entries,
+                                                      indicator_signals), repeats)
+            add_timing(f'{dataset_name}.calculate_interval_decisions', run_seconds)
+            if not is_same_result(np.concatenate(period_decisions), np.concatenate(period_interval_decisions)):
+                raise Exception(f'Interval decisions differ from the minute decisions for {dataset_name}')
+
+            run_seconds, trade_values = time_benchmark(
+                lambda: calculate_benchmark_trades(dataset, strategy, period_decisions, returns_array), repeats)
+            add_timing(f'{dataset_name}.calculate_trade', run_seconds)
+            timings[-1]['trades'] = len(trade_values)
+            check_benchmark_count(f'{dataset_name}.calculate_trade', len(trade_values), 'trades')
+            benchmark_results[f'{dataset_name}.calculate_trade'] = trade_values
+            benchmark_results[f'{dataset_name}.calculate_trade.returns'] = returns_array.copy()
+
+            for indicator_count in benchmark_indicator_counts:
+                for take_every_signal in (False, True):
+                    strategy = create_benchmark_strategy(indicator_reset, indicator_count, take_every_signal)
+                    strategy_name = f'{dataset_name}.run_strategy.{indicator_count}' \
+                                    f'.{"every_signal" if take_every_signal else "first_signal"}'
+                    run_seconds, strategy_results = time_benchmark(
+                        lambda: run_benchmark_strategy(dataset, strategy, returns_array), repeats)
+                    add_timing(strategy_name, run_seconds)
+                    timings[-1]['trades'] = len(strategy_results['trade_returns'])
+                    check_benchmark_count(strategy_name, len(strategy_results['trade_returns']), 'trades')
+                    for field, array in strategy_results.items():
+                        benchmark_results[f'{strategy_name}.{field}'] = array
+
+    # Every layout has to backtest the strategies the same, so a difference is caught before the baseline check
+    different_results = compare_benchmark_layouts(benchmark_results, layouts)
+    if len(different_results) > 0:
+        raise Exception(f'Strategy results differ between the layouts {[layout.name for layout in layouts]}: '
+                        f'{different_results}')
+
+    return pd.DataFrame(timings), benchmark_results
+
+
+def check_benchmark_count(benchmark_name, count, counted):
+    # A benchmark without entries or trades would time and check nothing
+    if count == 0:
+        raise Exception(f'{benchmark_name} has no {counted} on the synthetic bars, benchmark_indicators need to make some')
+
+
+def is_same_result(baseline_array, array):
+    # Bit for bit, so a float that differs in its last place or a NaN in a different place is a difference
+    return baseline_array.dtype == array.dtype and baseline_array.shape == array.shape and \
+        baseline_array.tobytes() == array.tobytes()
+
+
+def compare_benchmark_layouts(benchmark_results, layouts):
+    # Returns the names of the run_strategy results of each layout that differ from those of the first layout
+    # Only the strategy results line up across layouts, the signals and decisions are padded to the layout's periods
+    different_results = []
+    for name in benchmark_results:
+        if not name.startswith(f'{layouts[0].name}.') or '.run_strategy.' not in name:
+            continue
+        for layout in layouts[1:]:
+            layout_name = f'{layout.name}.{name[len(layouts[0].name) + 1:]}'
+            if layout_name not in benchmark_results or \
+                    not is_same_result(benchmark_results[name], benchmark_results[layout_name]):
+                different_results.append(layout_name)
+
+    return different_results
+
+
+def get_benchmark_baseline_results(benchmark_results, layout):
+    # The run_strategy results of the layout by their name in the baseline, which leaves out the layout
+    return {name[len(layout.name) + 1:]: array for name, array in benchmark_results.items()
+            if name.startswith(f'{layout.name}.') and '.run_strategy.' in name}
+
+
+def write_benchmark_baseline(benchmark_results, layouts, baseline_path):
+    # Every layout has the same strategy results, see compare_benchmark_layouts, so the first one is written
+    np.savez_compressed(baseline_path, **get_benchmark_baseline_results(benchmark_results, layouts[0]))
+
+
+def compare_benchmark_baseline(benchmark_results, layouts, baseline_path):
+    # Returns the names of the strategy results of each layout that differ from the baseline or are not in it
+    different_results = []
+    with np.load(baseline_path) as baseline:
+        for layout in layouts:
+            for name, array in get_benchmark_baseline_results(benchmark_results, layout).items():
+                if name not in baseline.files or not is_same_result(baseline[name], array):
+                    different_results.append(f'{layout.name}.{name}')
+
+    return different_results
+
+
+if __name__ == "__main__":
+    timings_df, benchmark_results = run_benchmarks()
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(timings_df.to_string(index=False, float_format='%.3f'))
+
+    baseline_path = settings.benchmark_baseline_path
+    if settings.benchmark_write_baseline:
+        write_benchmark_baseline(benchmark_results, settings.benchmark_layouts, baseline_path)
+        print(f'Benchmark baseline written to {baseline_path}')
+    elif not os.path.exists(baseline_path):
+        raise Exception(f'No benchmark baseline at {baseline_path}, set settings.benchmark_write_baseline to write one')
+    else:
+        different_results = compare_benchmark_baseline(benchmark_results, settings.benchmark_layouts, baseline_path)
+        if len(different_results) > 0:
+            raise Exception(f'Benchmark results differ from the baseline {baseline_path}: {different_results}')
+        print(f'Benchmark results match the baseline {baseline_path}')
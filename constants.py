@@ -9,10 +9,14 @@ MINUTES_PER_DAY = 1380
 MINUTES_PER_WEEK = 6900
 
 DEFAULT_DATETIME = np.datetime64('2006-12-31 12:00')
+# DEFAULT_DATETIME as the int64 minutes since the epoch that pad the DateTime field of the bars
+DEFAULT_EPOCH_MINUTE = int(DEFAULT_DATETIME.astype('datetime64[m]').astype(np.int64))
 
 START_DAY_TRADING_HOUR = 17
 WEEKS_PER_YEAR = 52
 DEFAULT_VOLUME = 0.000001
+# Next exit index of minutes with no timed exit left in their period
+NO_NEXT_EXIT = 2147483647
 
 class DayOfWeek(Enum):
     Monday = 0
@@ -28,6 +32,30 @@ class IndicatorReset(Enum):
     Weekly = 0
     Daily = 1
 
+# How get_database_data stores each bar field
+# Object keeps an array per period, Matrix keeps one contiguous (period_count, period_length) array per field
+# Ragged keeps one flat array per field with the periods back to back and no padding, see ragged_periods
+class BarLayout(Enum):
+    Object = 0
+    Matrix = 1
+    Ragged = 2
+
+# Buckets that minute returns can be summed into, see strategy_returns
+class ReturnBucket(Enum):
+    Hour = 0
+    TradingDay = 1
+    Week = 2
+
+# How the indicator signals of a strategy are combined into decisions, see combine_strategy_decisions
+# Minute steps through every minute, Interval only through the minutes where a signal changes, and Auto picks
+# Interval for a period when its signals change rarely enough
+class DecisionCombiner(Enum):
+    Minute = 0
+    Interval = 1
+    Auto = 2
+
+# DateTime holds int64 minutes since the epoch, see epoch_minutes, with Hour, Minute and the trade day in DayOfWeek
+# worked out from it when the bars are loaded
 class OHLC(Enum):
     Open = 0
     High = 1
@@ -38,6 +66,7 @@ class OHLC(Enum):
     Hour = 6
     DayOfWeek = 7
     Symbol = 8
+    Minute = 9
 
 class Session(Enum):
     All = 0
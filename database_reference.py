@@ -5,8 +5,11 @@ import numpy as np
 import psycopg2
 from psycopg2.extras import execute_values
 
-from constants import BarTypes, bartype_minutes, OHLC, DayOfWeek, DEFAULT_DATETIME, MINUTES_PER_WEEK, MINUTES_PER_DAY, IndicatorReset
+from constants import BarTypes, bartype_minutes, OHLC, DayOfWeek, DEFAULT_EPOCH_MINUTE, DEFAULT_VOLUME, MINUTES_PER_WEEK, MINUTES_PER_DAY, \
+    IndicatorReset, BarLayout
 from market_reference import market_disable_risk_events
+from ragged_periods import RaggedPeriods, is_period_ragged
+from epoch_minutes import to_epoch_minutes, from_epoch_minutes
 
 def calculate_trade_day(datetimes):
 
@@ -19,7 +22,24 @@ def calculate_trade_day(datetimes):
     
     return shifted_weekdays
 
-def get_database_data(host, user, password, market, start, end, tag, holidays_df, indicator_reset):
+def get_bars_layout(bars):
+    # Object layout is (BarTypes, OHLC, periods) of arrays, Matrix layout is (BarTypes, OHLC) of 2D matrices
+    # and Ragged layout is (BarTypes, OHLC) of RaggedPeriods
+    if bars.ndim == 3:
+        return BarLayout.Object
+    if is_period_ragged(bars[BarTypes.Minute1.value][OHLC.Open.value]):
+        return BarLayout.Ragged
+    return BarLayout.Matrix
+
+def get_period_count(bars):
+    if get_bars_layout(bars) == BarLayout.Object:
+        return bars.shape[2]
+    return len(bars[BarTypes.Minute1.value][OHLC.Open.value])
+
+def get_database_data(host, user, password, market, start, end, tag, holidays_df, indicator_reset, layout=BarLayout.Object,
+                      bartype_dfs=None):
+    # bartype_dfs maps bar types to bars in the form get_bars returns them, which are used instead of loading the bars
+    # from the database, such as the synthetic bars of benchmark_backtester
     
     print(f'Getting data from database for {market}')
     database_start_time = time.time()
@@ -43,7 +63,10 @@ def get_database_data(host, user, password, market, start, end, tag, holidays_df
     for bar_type in BarTypes:
         bar_length = bartype_minutes[bar_type].value
         
-        bartype_df = get_bars(host, user, password, market, start, end, bar_length)
+        if bartype_dfs is not None:
+            bartype_df = bartype_dfs[bar_type].copy()
+        else:
+            bartype_df = get_bars(host, user, password, market, start, end, bar_length)
         if bartype_df is None:
             return None, None, None, None, None, None, None
 
@@ -67,6 +90,23 @@ def get_database_data(host, user, password, market, start, end, tag, holidays_df
         bartype_df['day'] = bartype_df['day_start'].dt.to_period('D')
         
         allowed_bars = bartype_df[allowed]
+        all_datetimes = allowed_bars['datetime'].values        
+        all_closes = allowed_bars['close'].values
+
+        if layout == BarLayout.Matrix:
+            if bars is None:
+                bars = np.empty((len(BarTypes), len(OHLC)), dtype=object)
+            period_lookup, period_offsets, period_lengths, day_of_week_lookup = fill_bar_matrices(
+                bars, bar_type, allowed_bars, period_column, period_start_column, period_length, indicator_reset)
+            continue
+
+        if layout == BarLayout.Ragged:
+            if bars is None:
+                bars = np.empty((len(BarTypes), len(OHLC)), dtype=object)
+            period_lookup, period_offsets, period_lengths, day_of_week_lookup = fill_bar_ragged(
+                bars, bar_type, allowed_bars, period_column, period_start_column, indicator_reset)
+            continue
+
         period_counts = allowed_bars[period_column].value_counts()
 
         if bars is None:
@@ -75,8 +115,6 @@ def get_database_data(host, user, password, market, start, end, tag, holidays_df
         period_bars = {period: group for period, group in allowed_bars.groupby(period_column)}
 
         cumulative_week_offsets = 0
-        all_datetimes = allowed_bars['datetime'].values        
-        all_closes = allowed_bars['close'].values
 
         period_index = 0  # Initialize a period index to keep track of the current period in the array
         for period, group in period_bars.items():
@@ -89,8 +127,8 @@ def get_database_data(host, user, password, market, start, end, tag, holidays_df
             period_lengths[period_index] = group_length
             cumulative_week_offsets += group_length
         
-            bars[bar_type.value][OHLC.DateTime.value][period_index] = np.full(period_length, DEFAULT_DATETIME, dtype='object')
-            bars[bar_type.value][OHLC.DateTime.value][period_index][:group_length] = group['datetime']
+            bars[bar_type.value][OHLC.DateTime.value][period_index] = np.full(period_length, DEFAULT_EPOCH_MINUTE, dtype=np.int64)
+            bars[bar_type.value][OHLC.DateTime.value][period_index][:group_length] = to_epoch_minutes(group['datetime'])
             bars[bar_type.value][OHLC.Open.value][period_index] = np.full(period_length, 0.0, dtype=np.float64)
             bars[bar_type.value][OHLC.Open.value][period_index][:group_length] = group['open'].to_numpy()
             bars[bar_type.value][OHLC.High.value][period_index] = np.full(period_length, 0.0, dtype=np.float64)
@@ -103,6 +141,8 @@ def get_database_data(host, user, password, market, start, end, tag, holidays_df
             bars[bar_type.value][OHLC.Volume.value][period_index][:group_length] = group['volume'].to_numpy()
             bars[bar_type.value][OHLC.Hour.value][period_index] = np.full(period_length, 0, dtype=np.int64)
             bars[bar_type.value][OHLC.Hour.value][period_index][:group_length] = group['datetime'].dt.hour.to_numpy()
+            bars[bar_type.value][OHLC.Minute.value][period_index] = np.full(period_length, 0, dtype=np.int64)
+            bars[bar_type.value][OHLC.Minute.value][period_index][:group_length] = group['datetime'].dt.minute.to_numpy()
             bars[bar_type.value][OHLC.DayOfWeek.value][period_index] = np.full(period_length, DayOfWeek.Saturday.value, dtype=int)
             bars[bar_type.value][OHLC.DayOfWeek.value][period_index][:group_length] = [DayOfWeek(day).value for day in week_of_day]
 
@@ -118,6 +158,106 @@ def get_database_data(host, user, password, market, start, end, tag, holidays_df
 
     return bars, period_lookup, period_offsets, period_lengths, all_datetimes, all_closes, day_of_week_lookup
 
+def fill_bar_matrices(bars, bar_type, allowed_bars, period_column, period_start_column, period_length, indicator_reset):
+    # Scatters every bar into one contiguous (period_count, period_length) matrix per field
+    # Row is the period and column is the minute within the period, padding matches the object layout
+
+    grouped = allowed_bars.groupby(period_column)
+    row_indexes = grouped.ngroup().to_numpy()
+    column_indexes = grouped.cumcount().to_numpy()
+    period_starts = grouped[period_start_column].first()
+
+    period_lengths = grouped.size().to_numpy().astype(np.int64)
+    period_offsets = np.zeros(len(period_lengths), dtype=np.int64)
+    period_offsets[1:] = np.cumsum(period_lengths)[:-1]
+    period_count = len(period_lengths)
+    shape = (period_count, period_length)
+
+    period_lookup = {}
+    for period_index, period_start in enumerate(period_starts):
+        period_lookup[period_start] = period_index
+
+    bars_datetime = np.full(shape, DEFAULT_EPOCH_MINUTE, dtype=np.int64)
+    bars_datetime[row_indexes, column_indexes] = to_epoch_minutes(allowed_bars['datetime'])
+    bars[bar_type.value][OHLC.DateTime.value] = bars_datetime
+
+    for ohlc, column in ((OHLC.Open, 'open'), (OHLC.High, 'high'), (OHLC.Low, 'low'), (OHLC.Close, 'close')):
+        bars_field = np.zeros(shape, dtype=np.float64)
+        bars_field[row_indexes, column_indexes] = allowed_bars[column].to_numpy()
+        bars[bar_type.value][ohlc.value] = bars_field
+
+    bars_volume = np.full(shape, DEFAULT_VOLUME, dtype=np.float64)
+    bars_volume[row_indexes, column_indexes] = allowed_bars['volume'].to_numpy()
+    bars[bar_type.value][OHLC.Volume.value] = bars_volume
+
+    bars_hour = np.zeros(shape, dtype=np.int64)
+    bars_hour[row_indexes, column_indexes] = allowed_bars['datetime'].dt.hour.to_numpy()
+    bars[bar_type.value][OHLC.Hour.value] = bars_hour
+
+    bars_minute = np.zeros(shape, dtype=np.int64)
+    bars_minute[row_indexes, column_indexes] = allowed_bars['datetime'].dt.minute.to_numpy()
+    bars[bar_type.value][OHLC.Minute.value] = bars_minute
+
+    bars_day_of_week = np.full(shape, DayOfWeek.Saturday.value, dtype=np.int64)
+    bars_day_of_week[row_indexes, column_indexes] = allowed_bars['trade_day'].to_numpy()
+    bars[bar_type.value][OHLC.DayOfWeek.value] = bars_day_of_week
+
+    day_of_week_lookup = {}
+    if indicator_reset == IndicatorReset.Daily:
+        for period_index in range(period_count):
+            day_of_week_lookup[period_index] = bars_day_of_week[period_index][0]
+
+    return period_lookup, period_offsets, period_lengths, day_of_week_lookup
+
+def fill_bar_ragged(bars, bar_type, allowed_bars, period_column, period_start_column, indicator_reset):
+    # Places every bar into one flat array per field with the periods back to back and no padding
+    # The minutes of period p start at period_offsets[p], the same index as in all_datetimes
+
+    grouped = allowed_bars.groupby(period_column)
+    row_indexes = grouped.ngroup().to_numpy()
+    column_indexes = grouped.cumcount().to_numpy()
+    period_starts = grouped[period_start_column].first()
+
+    period_lengths = grouped.size().to_numpy().astype(np.int64)
+    period_offsets = np.zeros(len(period_lengths), dtype=np.int64)
+    period_offsets[1:] = np.cumsum(period_lengths)[:-1]
+    period_count = len(period_lengths)
+    bar_indexes = period_offsets[row_indexes] + column_indexes
+    bar_count = len(bar_indexes)
+
+    period_lookup = {}
+    for period_index, period_start in enumerate(period_starts):
+        period_lookup[period_start] = period_index
+
+    bars_datetime = np.empty(bar_count, dtype=np.int64)
+    bars_datetime[bar_indexes] = to_epoch_minutes(allowed_bars['datetime'])
+    bars[bar_type.value][OHLC.DateTime.value] = RaggedPeriods(bars_datetime, period_offsets, period_lengths)
+
+    for ohlc, column in ((OHLC.Open, 'open'), (OHLC.High, 'high'), (OHLC.Low, 'low'), (OHLC.Close, 'close'),
+                         (OHLC.Volume, 'volume')):
+        bars_field = np.empty(bar_count, dtype=np.float64)
+        bars_field[bar_indexes] = allowed_bars[column].to_numpy()
+        bars[bar_type.value][ohlc.value] = RaggedPeriods(bars_field, period_offsets, period_lengths)
+
+    bars_hour = np.empty(bar_count, dtype=np.int64)
+    bars_hour[bar_indexes] = allowed_bars['datetime'].dt.hour.to_numpy()
+    bars[bar_type.value][OHLC.Hour.value] = RaggedPeriods(bars_hour, period_offsets, period_lengths)
+
+    bars_minute = np.empty(bar_count, dtype=np.int64)
+    bars_minute[bar_indexes] = allowed_bars['datetime'].dt.minute.to_numpy()
+    bars[bar_type.value][OHLC.Minute.value] = RaggedPeriods(bars_minute, period_offsets, period_lengths)
+
+    bars_day_of_week = np.empty(bar_count, dtype=np.int64)
+    bars_day_of_week[bar_indexes] = allowed_bars['trade_day'].to_numpy()
+    bars[bar_type.value][OHLC.DayOfWeek.value] = RaggedPeriods(bars_day_of_week, period_offsets, period_lengths)
+
+    day_of_week_lookup = {}
+    if indicator_reset == IndicatorReset.Daily:
+        for period_index in range(period_count):
+            day_of_week_lookup[period_index] = bars_day_of_week[period_offsets[period_index]]
+
+    return period_lookup, period_offsets, period_lengths, day_of_week_lookup
+
 def get_bars(host, user, password, market, start, end, bar_length):
 
     try:
@@ -760,21 +900,22 @@ if __name__ == "__main__":
    
     for bar_type in BarTypes:
         bar_length = bartype_minutes[bar_type].value
-        period_count = bars.shape[2]
+        period_count = get_period_count(bars)
 
         for period_index in range(period_count):
         
             bar_data = {
-                    'datetime': bars[bar_type.value][OHLC.DateTime.value][period_index],
+                    'datetime': from_epoch_minutes(bars[bar_type.value][OHLC.DateTime.value][period_index]),
                     'open': bars[bar_type.value][OHLC.Open.value][period_index],
                     'high': bars[bar_type.value][OHLC.High.value][period_index],
                     'low': bars[bar_type.value][OHLC.Low.value][period_index],
                     'close': bars[bar_type.value][OHLC.Close.value][period_index],
                     'volume': bars[bar_type.value][OHLC.Volume.value][period_index],
                     'hour': bars[bar_type.value][OHLC.Hour.value][period_index],
+                    'minute': bars[bar_type.value][OHLC.Minute.value][period_index],
                     'day': bars[bar_type.value][OHLC.DayOfWeek.value][period_index],
                     }
-            bar_data_df = pd.DataFrame(bar_data, index=bars[bar_type.value][OHLC.DateTime.value][period_index])
+            bar_data_df = pd.DataFrame(bar_data, index=bar_data['datetime'])
 
             filename = f'{verbose_path}/bar_data.{bar_length}.{market}.{indicator_reset}.{period_index}.csv'
             bar_data_df.to_csv(filename, mode='w', index=True)
@@ -0,0 +1,190 @@
+import os
+import json
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from constants import BarTypes, OHLC, IndicatorReset, BarLayout
+from database_reference import get_database_data, get_holidays, get_bars_layout, get_period_count
+from trade_timing import create_all_exits, create_allowed_entries, create_next_exits, calculate_period_week_ids
+from first_passage import create_first_passage_tables
+import settings
+
+# A dataset store keeps the matrix layout bars, exits and entry masks of one market on disk, one .npy file per field
+# Every process maps the files read only so they share one copy in the page cache and only touch the periods they use
+DATASET_STORE_MANIFEST = 'manifest.json'
+# Key of a shared dataset layout that points at a dataset store instead of shared memory segments
+DATASET_STORE_LAYOUT_KEY = 'dataset_store'
+
+# Bar fields of BarTypes.Minute1 by their file name in the store
+dataset_store_bar_fields = {
+    'datetime': OHLC.DateTime,
+    'open': OHLC.Open,
+    'high': OHLC.High,
+    'low': OHLC.Low,
+    'close': OHLC.Close,
+    'volume': OHLC.Volume,
+    'hour': OHLC.Hour,
+    'minute': OHLC.Minute,
+    'day_of_week': OHLC.DayOfWeek,
+}
+
+# Stores opened by this process, the arrays stay mapped until the process exits
+opened_dataset_stores = {}
+
+
+def get_dataset_store_path(market, indicator_reset, start=None, end=None):
+    if start is None:
+        start = settings.start
+    if end is None:
+        end = settings.end
+    return f'{settings.dataset_store_path}/{market}.{indicator_reset.name}.{start}.{end}'
+
+
+def write_dataset_store(store_path, market, indicator_reset, bars, period_lookup, period_offsets, period_lengths,
+                        all_datetimes, all_closes, timed_exits, allowed_entry_sessions, allowed_entry_days,
+                        next_exits=None, first_passage_tables=None):
+    # Fields are written to a temporary directory that is renamed into place once complete, so a process never maps
+    # a partly written store. An existing store has to be removed first as other processes may still map its files
+    if get_bars_layout(bars) != BarLayout.Matrix:
+        raise Exception(f'Dataset store for {market} needs bars loaded with BarLayout.Matrix')
+    if os.path.exists(store_path):
+        raise Exception(f'Dataset store {store_path} already exists')
+
+    bars_datetime = bars[BarTypes.Minute1.value][OHLC.DateTime.value]
+    period_count = get_period_count(bars)
+    if next_exits is None:
+        next_exits = create_next_exits(timed_exits)
+    if first_passage_tables is None:
+        first_passage_tables = create_first_passage_tables(bars[BarTypes.Minute1.value][OHLC.High.value],
+                                                           bars[BarTypes.Minute1.value][OHLC.Low.value])
+    high_tables, low_tables = first_passage_tables
+
+    period_starts = np.empty(period_count, dtype='datetime64[ns]')
+    for period_start, period_index in period_lookup.items():
+        period_starts[period_index] = pd.Timestamp(period_start).to_datetime64()
+
+    # The datetime matrix holds epoch minutes so every bar field is stored as it is
+    store_arrays = {field: bars[BarTypes.Minute1.value][ohlc.value] for field, ohlc in dataset_store_bar_fields.items()}
+    all_datetimes = np.asarray(all_datetimes)
+    store_arrays.update({
+        'timed_exits': timed_exits,
+        'next_exits': next_exits,
+        'allowed_entry_sessions': allowed_entry_sessions,
+        'allowed_entry_days': allowed_entry_days,
+        'high_tables': high_tables,
+        'low_tables': low_tables,
+        'period_offsets': np.asarray(period_offsets, dtype=np.int64),
+        'period_lengths': np.asarray(period_lengths, dtype=np.int64),
+        'period_week_ids': calculate_period_week_ids(bars_datetime, period_count),
+        'period_starts': period_starts,
+        'all_datetimes': all_datetimes,
+        'all_closes': np.asarray(all_closes, dtype=np.float64),
+    })
+
+    temporary_path = f'{store_path}.tmp'
+    if os.path.exists(temporary_path):
+        shutil.rmtree(temporary_path)
+    os.makedirs(temporary_path)
+
+    for field, array in store_arrays.items():
+        if array.dtype == object:
+            raise Exception(f'Dataset store field {field} must be numeric')
+        np.save(f'{temporary_path}/{field}.npy', np.ascontiguousarray(array))
+
+    manifest = {
+        'market': market,
+        'indicator_reset': indicator_reset.name,
+        'period_count': period_count,
+        'bar_count': len(all_datetimes),
+        'fields': list(store_arrays),
+    }
+    with open(f'{temporary_path}/{DATASET_STORE_MANIFEST}', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+
+    os.rename(temporary_path, store_path)
+
+
+def open_dataset_store(store_path):
+    # Maps every field of the store read only, once per process
+    if store_path in opened_dataset_stores:
+        return opened_dataset_stores[store_path]
+
+    manifest_filename = f'{store_path}/{DATASET_STORE_MANIFEST}'
+    if not os.path.exists(manifest_filename):
+        raise Exception(f'Dataset store {store_path} does not exist, build it with write_dataset_store')
+    with open(manifest_filename) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    # np.asarray drops the memmap subclass so the compiled functions see plain read only arrays on the same pages
+    dataset = {}
+    for field in manifest['fields']:
+        dataset[field] = np.asarray(np.load(f'{store_path}/{field}.npy', mmap_mode='r'))
+    dataset['manifest'] = manifest
+
+    opened_dataset_stores[store_path] = dataset
+
+    return dataset
+
+
+def load_dataset_store(store_path):
+    # Same bars, periods and datetimes as get_database_data with BarLayout.Matrix followed by the exits, entry masks,
+    # next exits and first passage tables, every array mapped from the store rather than loaded
+    dataset = open_dataset_store(store_path)
+    if dataset['datetime'].dtype != np.int64 or 'minute' not in dataset:
+        raise Exception(f'Dataset store {store_path} was written before the bars held epoch minutes, rebuild it')
+    indicator_reset = IndicatorReset[dataset['manifest']['indicator_reset']]
+
+    bars = np.empty((len(BarTypes), len(OHLC)), dtype=object)
+    for field, ohlc in dataset_store_bar_fields.items():
+        bars[BarTypes.Minute1.value][ohlc.value] = dataset[field]
+
+    period_lookup = {}
+    for period_index, period_start in enumerate(dataset['period_starts']):
+        period_lookup[pd.Timestamp(period_start)] = period_index
+
+    day_of_week_lookup = {}
+    if indicator_reset == IndicatorReset.Daily:
+        for period_index, day_of_week in enumerate(dataset['day_of_week'][:, 0]):
+            day_of_week_lookup[period_index] = day_of_week
+
+    return (bars, period_lookup, dataset['period_offsets'], dataset['period_lengths'], dataset['all_datetimes'],
+            dataset['all_closes'], day_of_week_lookup, dataset['timed_exits'], dataset['allowed_entry_sessions'],
+            dataset['allowed_entry_days'], dataset['next_exits'], (dataset['high_tables'], dataset['low_tables']))
+
+
+def create_dataset_store_layout(store_path):
+    # Used in place of a shared dataset layout, attach_shared_dataset maps the store in each worker
+    return {DATASET_STORE_LAYOUT_KEY: store_path}
+
+
+def is_dataset_store_layout(shared_dataset_layout):
+    return DATASET_STORE_LAYOUT_KEY in shared_dataset_layout
+
+
+def build_dataset_store(market, indicator_reset, start=None, end=None):
+    if start is None:
+        start = settings.start
+    if end is None:
+        end = settings.end
+
+    holidays_df = get_holidays(settings.host, settings.strategies_database, settings.user, settings.password)
+    bars, period_lookup, period_offsets, period_lengths, all_datetimes, all_closes, day_of_week_lookup = get_database_data(
+        settings.host, settings.user, settings.password, market, start, end, "all", holidays_df, indicator_reset,
+        BarLayout.Matrix)
+    timed_exits = create_all_exits(settings.host, settings.strategies_database, settings.user, settings.password, bars,
+                                   market, period_lookup, indicator_reset)
+    allowed_entry_sessions, allowed_entry_days = create_allowed_entries(bars, indicator_reset)
+
+    store_path = get_dataset_store_path(market, indicator_reset, start, end)
+    write_dataset_store(store_path, market, indicator_reset, bars, period_lookup, period_offsets, period_lengths,
+                        all_datetimes, all_closes, timed_exits, allowed_entry_sessions, allowed_entry_days)
+    print(f'Dataset store for {market} written to {store_path}')
+
+    return store_path
+
+
+if __name__ == "__main__":
+    for market in settings.markets:
+        build_dataset_store(market, settings.requirements['indicator_reset'])
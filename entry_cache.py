@@ -0,0 +1,109 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from enum import Enum
+
+import numpy as np
+
+import settings
+
+# Strategy keys that decide the entries. Exit parameters like stoploss and profit_target are left out so
+# strategies that only differ in them share the cached entries
+ENTRY_STRATEGY_KEYS = ['indicators', 'session', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+                       'indicator_reset', 'max_trade_length']
+
+# Packed entries by key, oldest used first
+entry_cache = OrderedDict()
+entry_cache_statistics = {'hits': 0, 'misses': 0, 'evictions': 0}
+# Strategies evaluated on threads share the cache
+entry_cache_lock = threading.Lock()
+# First passage tables and next exits of the loaded datasets, oldest used first, so strategies backtested without them
+# share one build per dataset instead of building them for the whole history each time
+# Keyed by the ids of the arrays they were built from, which are kept with them so the ids can not be reused
+dataset_lookup_cache = OrderedDict()
+
+
+def encode_entry_value(value):
+    # Enums and numpy scalars are stored by value so equal strategies hash the same however they were loaded
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Can not encode {type(value)} in an entry cache key')
+
+
+def create_entry_cache_key(strategy, market, all_datetimes):
+    # The first and last minute and the minute count tell apart histories loaded for different dates
+    dataset_key = (market, len(all_datetimes), str(all_datetimes[0]), str(all_datetimes[-1])) if len(all_datetimes) > 0 \
+        else (market, 0)
+
+    entry_strategy = {key: strategy.get(key, None) for key in ENTRY_STRATEGY_KEYS}
+    entry_json = json.dumps(entry_strategy, sort_keys=True, default=encode_entry_value)
+    entry_hash = hashlib.blake2b(entry_json.encode('utf-8'), digest_size=16).hexdigest()
+
+    return dataset_key, entry_hash
+
+
+def get_cached_entries(entry_cache_key):
+    with entry_cache_lock:
+        packed_entries = entry_cache.get(entry_cache_key, None)
+        if packed_entries is None:
+            entry_cache_statistics['misses'] += 1
+            return None
+
+        entry_cache.move_to_end(entry_cache_key)
+        entry_cache_statistics['hits'] += 1
+        return packed_entries
+
+
+def store_cached_entries(entry_cache_key, packed_entries):
+    if settings.entry_cache_size <= 0:
+        return
+
+    with entry_cache_lock:
+        entry_cache[entry_cache_key] = packed_entries
+        entry_cache.move_to_end(entry_cache_key)
+        while len(entry_cache) > settings.entry_cache_size:
+            entry_cache.popitem(last=False)
+            entry_cache_statistics['evictions'] += 1
+
+
+def get_dataset_lookup(lookup_name, source_arrays, create_lookup):
+    # Returns create_lookup(*source_arrays), built once while source_arrays are the same objects
+    dataset_lookup_key = (lookup_name,) + tuple(id(source_array) for source_array in source_arrays)
+    with entry_cache_lock:
+        cached_lookup = dataset_lookup_cache.get(dataset_lookup_key, None)
+        if cached_lookup is not None and all(cached_array is source_array for cached_array, source_array in
+                                             zip(cached_lookup[0], source_arrays)):
+            dataset_lookup_cache.move_to_end(dataset_lookup_key)
+            return cached_lookup[1]
+
+    # Built outside the lock so threads backtesting other datasets are not held up
+    dataset_lookup = create_lookup(*source_arrays)
+    if settings.dataset_lookup_cache_size <= 0:
+        return dataset_lookup
+
+    with entry_cache_lock:
+        dataset_lookup_cache[dataset_lookup_key] = (tuple(source_arrays), dataset_lookup)
+        dataset_lookup_cache.move_to_end(dataset_lookup_key)
+        while len(dataset_lookup_cache) > settings.dataset_lookup_cache_size:
+            dataset_lookup_cache.popitem(last=False)
+
+    return dataset_lookup
+
+
+def get_entry_cache_statistics():
+    with entry_cache_lock:
+        entry_cache_lookups = entry_cache_statistics['hits'] + entry_cache_statistics['misses']
+        hit_rate = entry_cache_statistics['hits'] / entry_cache_lookups if entry_cache_lookups > 0 else 0.0
+        return {**entry_cache_statistics, 'size': len(entry_cache), 'hit_rate': hit_rate}
+
+
+def clear_entry_cache():
+    # Must be called when the exits or entry masks of a market change without reloading different dates
+    with entry_cache_lock:
+        entry_cache.clear()
+        dataset_lookup_cache.clear()
+        for statistic in entry_cache_statistics:
+            entry_cache_statistics[statistic] = 0
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+from constants import START_DAY_TRADING_HOUR
+
+# Bar datetimes are kept as int64 minutes since 1970-01-01 so the hot loops compare integers, and the bar arrays stay
+# numeric so they can be put in shared memory or a dataset store. Timestamps are only made when results are reported
+MINUTES_PER_HOUR = 60
+MINUTES_PER_CALENDAR_DAY = 1440
+NANOSECONDS_PER_MINUTE = 60_000_000_000
+# 1970-01-01 was a Thursday
+EPOCH_WEEKDAY = 3
+
+
+def to_epoch_minutes(datetimes):
+    # Datetimes of bars are on the minute so this drops nothing
+    return np.asarray(datetimes).astype('datetime64[m]').astype(np.int64)
+
+
+def to_epoch_minute_ceiling(datetime):
+    # First minute at or after datetime, so bar >= start and bar < end select the same bars as Timestamps would
+    return -(-pd.Timestamp(datetime).value // NANOSECONDS_PER_MINUTE)
+
+
+def from_epoch_minutes(epoch_minutes):
+    return pd.DatetimeIndex(np.asarray(epoch_minutes, dtype=np.int64).astype('datetime64[m]').astype('datetime64[ns]'))
+
+
+def calculate_week_start_minutes(epoch_minutes):
+    # Same as trade_timing.get_start_of_week, the Sunday START_DAY_TRADING_HOUR at or before each minute
+    days = np.asarray(epoch_minutes, dtype=np.int64) // MINUTES_PER_CALENDAR_DAY
+    weekdays = (days + EPOCH_WEEKDAY) % 7
+    return (days - (weekdays + 1) % 7) * MINUTES_PER_CALENDAR_DAY + START_DAY_TRADING_HOUR * MINUTES_PER_HOUR
@@ -0,0 +1,126 @@
+import numpy as np
+from numba import njit
+
+from ragged_periods import is_period_ragged, unwrap_ragged_periods, get_period_values
+
+# Minutes summarised by each entry of the lowest level of a first passage table
+FIRST_PASSAGE_BLOCK_SIZE = 16
+
+
+def calculate_first_passage_levels(block_count):
+    # Number of doubling levels needed so the widest level covers every block
+    levels = 1
+    while (1 << levels) <= block_count:
+        levels += 1
+    return levels
+
+
+@njit(cache=True, nogil=True)
+def fill_first_passage_table(values, table, is_minimum):
+    # Level 0 holds the min or max of each block, level k the min or max of 2^k blocks starting at each block
+    # Blocks past the end of values, of periods shorter than the table, never reach a threshold
+    block_count = table.shape[1]
+    for block in range(block_count):
+        block_start = block * FIRST_PASSAGE_BLOCK_SIZE
+        if block_start >= len(values):
+            table[0, block] = np.inf if is_minimum else -np.inf
+            continue
+        block_end = min(block_start + FIRST_PASSAGE_BLOCK_SIZE, len(values))
+        extreme = values[block_start]
+        for index in range(block_start + 1, block_end):
+            if is_minimum:
+                if values[index] < extreme:
+                    extreme = values[index]
+            elif values[index] > extreme:
+                extreme = values[index]
+        table[0, block] = extreme
+
+    for level in range(1, table.shape[0]):
+        half_span = 1 << (level - 1)
+        for block in range(block_count):
+            extreme = table[level - 1, block]
+            if block + half_span < block_count:
+                other = table[level - 1, block + half_span]
+                if is_minimum:
+                    if other < extreme:
+                        extreme = other
+                elif other > extreme:
+                    extreme = other
+            table[level, block] = extreme
+
+
+@njit(cache=True, nogil=True)
+def fill_first_passage_tables(bars_high, bars_low, period_offsets, period_lengths, high_tables, low_tables):
+    for period_index in range(len(period_lengths)):
+        fill_first_passage_table(get_period_values(bars_high, period_offsets, period_lengths, period_index),
+                                 high_tables[period_index], False)
+        fill_first_passage_table(get_period_values(bars_low, period_offsets, period_lengths, period_index),
+                                 low_tables[period_index], True)
+
+
+def create_first_passage_tables(bars_high, bars_low):
+    # Builds the per period search structure over highs and lows of bars loaded with BarLayout.Matrix or Ragged
+    # The tables only depend on the bars so they can be built once per market and shared by every strategy
+    # Tables of ragged periods are sized by the longest period
+    if is_period_ragged(bars_high):
+        period_offsets = bars_high.period_offsets
+        period_lengths = bars_high.period_lengths
+        period_count = len(period_lengths)
+        period_length = int(period_lengths.max()) if period_count > 0 else 0
+    else:
+        period_count, period_length = bars_high.shape
+        period_offsets = np.zeros(period_count, dtype=np.int64)
+        period_lengths = np.full(period_count, period_length, dtype=np.int64)
+    block_count = max(1, (period_length + FIRST_PASSAGE_BLOCK_SIZE - 1) // FIRST_PASSAGE_BLOCK_SIZE)
+    levels = calculate_first_passage_levels(block_count)
+
+    high_tables = np.empty((period_count, levels, block_count), dtype=np.float64)
+    low_tables = np.empty((period_count, levels, block_count), dtype=np.float64)
+    if period_length > 0:
+        fill_first_passage_tables(unwrap_ragged_periods(bars_high), unwrap_ragged_periods(bars_low),
+                                  period_offsets, period_lengths, high_tables, low_tables)
+
+    return high_tables, low_tables
+
+
+@njit(cache=True, nogil=True)
+def has_passed(value, threshold, is_below):
+    if is_below:
+        return value <= threshold
+    return value >= threshold
+
+
+@njit(cache=True, nogil=True)
+def find_first_passage(values, table, start, end, threshold, is_below):
+    # Finds the first index in start to end inclusive where values is at or below the threshold when is_below is set,
+    # otherwise at or above. table is the max table when searching above and the min table when searching below
+    # Returns -1 if the threshold is never reached
+    if start > end:
+        return -1
+
+    # Scan the rest of the block holding start
+    first_block = start // FIRST_PASSAGE_BLOCK_SIZE
+    first_block_end = min(end, (first_block + 1) * FIRST_PASSAGE_BLOCK_SIZE - 1)
+    for index in range(start, first_block_end + 1):
+        if has_passed(values[index], threshold, is_below):
+            return index
+
+    block = first_block + 1
+    last_block = end // FIRST_PASSAGE_BLOCK_SIZE
+    if block > last_block:
+        return -1
+
+    # Skip whole blocks before the last block in doubling spans that never reach the threshold
+    for level in range(table.shape[0] - 1, -1, -1):
+        span = 1 << level
+        if block + span <= last_block and not has_passed(table[level, block], threshold, is_below):
+            block += span
+
+    # The block now either reaches the threshold or is the last block which may only be partly in range
+    block_start = block * FIRST_PASSAGE_BLOCK_SIZE
+    block_end = min(end, block_start + FIRST_PASSAGE_BLOCK_SIZE - 1)
+    for index in range(block_start, block_end + 1):
+        if has_passed(values[index], threshold, is_below):
+            return index
+
+    return -1
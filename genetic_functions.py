@@ -4,7 +4,7 @@ import math
 import time
 
 from constants import BarMinutes, IndicatorReset, BarTypes, OHLC
-from database_reference import get_database_data, get_holidays
+from database_reference import get_database_data, get_holidays, get_period_count
 from indicator_registry import indicator_registry, indicator_options, update_indicator_registry_lookbacks
 import settings
 
@@ -317,7 +317,8 @@ if __name__ == "__main__":
     
     holidays_df = get_holidays(settings.host, settings.strategies_database, settings.user, settings.password)
     test_bars, period_lookup, period_offsets, period_lengths, all_datetimes, all_closes, day_of_week_lookup = get_database_data(
-            settings.host, settings.user, settings.password, market, start, end, "test", holidays_df, indicator_reset)
+            settings.host, settings.user, settings.password, market, start, end, "test", holidays_df, indicator_reset,
+            settings.bar_layout)
     
     update_indicator_registry_lookbacks(indicator_reset)
 
@@ -335,7 +336,7 @@ if __name__ == "__main__":
             long_signal_count = 0
             short_signal_count = 0
 
-            period_count = test_bars.shape[2]
+            period_count = get_period_count(test_bars)
 
             start_indicator_generation_time = time.time()                
             for period_index in range(period_count):                
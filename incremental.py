@@ -5,7 +5,7 @@ from datetime import datetime
 
 from constants import IndicatorReset, enum_decoder, enum_encoder
 from database_strategies import update_strategy_json, get_last_scores, delete_strategy_returns, delete_strategy_trades, get_latest_config
-from database_reference import get_holidays
+from database_reference import get_holidays, get_period_count
 from market_reference import market_slippage, market_contract_size
 from strategy_scoring import write_strategy, create_optimisation_dates, fetch_market_data
 from strategy_ga import import_python_file
@@ -32,7 +32,7 @@ def run_strategy_incremental(overwrite_all_scores, market, strategy_id, strategy
 
     slippage = market_slippage[market] / 200
     contract_size = market_contract_size[market]
-    all_period_count = all_bars.shape[2]
+    all_period_count = get_period_count(all_bars)
     
     start = last_score_date
     if overwrite_all_scores:
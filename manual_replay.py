@@ -1,13 +1,15 @@
 import pandas as pd
+import numpy as np
 import json
 import multiprocessing
 
-from constants import IndicatorReset, enum_decoder, BarTypes, OHLC
+from constants import IndicatorReset, enum_decoder, BarTypes, OHLC, ReturnBucket
 from scores import run_strategy
 from database_reference import get_database_data, get_holidays
 from database_strategies import get_strategy, get_strategy_returns, get_strategy_trades
 from trade_timing import create_all_exits, create_allowed_entries
 from market_reference import market_slippage, market_contract_size
+from strategy_returns import create_return_bucket_offsets, aggregate_bucket_returns, fill_empty_bucket_returns
 import settings 
 
 def calculate_strategies_for_market(market, market_strategies, strategy_jsons):
@@ -57,10 +59,10 @@ def calculate_strategies_for_market(market, market_strategies, strategy_jsons):
         trade_df.to_csv(trades_filename, mode='w', index=False)
         print(f"Trades written to {trades_filename}")
 
-        returns_series = pd.Series(returns_array, index=all_datetimes)
-
-        hourly_returns = returns_series.resample('1h').sum()
-        cumulative_hourly_returns = hourly_returns.cumsum()
+        hour_starts, hour_datetimes = create_return_bucket_offsets(all_datetimes, ReturnBucket.Hour)
+        hourly_returns, hour_datetimes = fill_empty_bucket_returns(
+            aggregate_bucket_returns(returns_array, hour_starts), hour_datetimes, np.timedelta64(1, 'h'))
+        cumulative_hourly_returns = pd.Series(np.cumsum(hourly_returns), index=hour_datetimes)
 
         custom_headers = [f'Strategy_{strategy_id}']
         hourly_returns_filename = f'{settings.write_all_path}/strategy_{strategy_id}.returns.csv'
@@ -83,10 +85,10 @@ def write_strategies_for_market(market, market_strategies):
         strategy_trades.to_excel(trades_filename)
         print(f"Trades written to {trades_filename}")
 
-        returns_series = pd.Series(strategy_returns, index=all_datetimes)
-
-        hourly_returns = returns_series.resample('1h').sum()
-        cumulative_hourly_returns = hourly_returns.cumsum()
+        hour_starts, hour_datetimes = create_return_bucket_offsets(all_datetimes, ReturnBucket.Hour)
+        hourly_returns, hour_datetimes = fill_empty_bucket_returns(
+            aggregate_bucket_returns(strategy_returns, hour_starts), hour_datetimes, np.timedelta64(1, 'h'))
+        cumulative_hourly_returns = pd.Series(np.cumsum(hourly_returns), index=hour_datetimes)
 
         custom_headers = [f'Strategy_{strategy_id}']
         hourly_returns_filename = f'{settings.write_all_path}/strategy_{strategy_id}.returns.csv'
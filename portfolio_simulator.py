@@ -0,0 +1,189 @@
+import numpy as np
+from numba import njit
+
+from market_reference import market_contract_size
+from epoch_minutes import to_epoch_minutes, from_epoch_minutes
+from strategy_returns import TRADE_SPAN_START, TRADE_SPAN_END, TRADE_SPAN_DIRECTION, TRADE_SPAN_ENTRY_PRICE, \
+    TRADE_SPAN_EXIT_PRICE
+import settings
+
+# Simulates a portfolio of strategies across markets from their trade spans, see strategy_returns, on one minute clock
+# shared by the markets. Positions are sized by the weighting of each strategy in contracts and capped by the leverage
+# limits, without materialising the minute returns of any strategy
+
+# Columns of the integer and price arrays of the spans of every strategy of a portfolio
+# Minute indexes are into the closes of every market placed back to back, see create_portfolio_markets
+PORTFOLIO_SPAN_START = 0
+PORTFOLIO_SPAN_END = 1
+PORTFOLIO_SPAN_DIRECTION = 2
+PORTFOLIO_SPAN_MARKET = 3
+PORTFOLIO_SPAN_INDEX_COLUMNS = 4
+
+PORTFOLIO_SPAN_ENTRY_PRICE = 0
+PORTFOLIO_SPAN_EXIT_PRICE = 1
+# Weighting times the contract size of the market, so units times a price is a notional value
+PORTFOLIO_SPAN_UNITS = 2
+PORTFOLIO_SPAN_PRICE_COLUMNS = 3
+
+
+def create_portfolio_markets(market_datetimes, market_closes):
+    # market_datetimes and market_closes map each market to the all_datetimes and all_closes of get_database_data
+    # The clock is every minute any market has a bar, and each minute of a market is given its index on the clock
+    markets = list(market_datetimes.keys())
+    market_minutes = [to_epoch_minutes(market_datetimes[market]) for market in markets]
+    clock_minutes = np.unique(np.concatenate(market_minutes)) if len(markets) > 0 else np.zeros(0, dtype=np.int64)
+
+    market_offsets = np.zeros(len(markets) + 1, dtype=np.int64)
+    market_offsets[1:] = np.cumsum([len(minutes) for minutes in market_minutes])
+
+    return {
+        'markets': markets,
+        'market_indexes': {market: market_index for market_index, market in enumerate(markets)},
+        'market_offsets': market_offsets,
+        'clock_minutes': clock_minutes,
+        'clock_indexes': np.concatenate([np.searchsorted(clock_minutes, minutes) for minutes in market_minutes])
+        if len(markets) > 0 else np.zeros(0, dtype=np.int64),
+        'all_closes': np.concatenate([np.asarray(market_closes[market], dtype=np.float64) for market in markets])
+        if len(markets) > 0 else np.zeros(0, dtype=np.float64),
+    }
+
+
+def create_portfolio_spans(portfolio_markets, portfolio_strategies):
+    # portfolio_strategies is a list of dicts with the market, the weighting in contracts and the trade_spans of a
+    # strategy, as backtest_report['trade_spans'] of run_strategy gives them
+    # Returns the spans of every strategy back to back and the offset of each strategy's spans
+    strategy_span_counts = [len(strategy['trade_spans'][0]) for strategy in portfolio_strategies]
+    strategy_offsets = np.zeros(len(portfolio_strategies) + 1, dtype=np.int64)
+    strategy_offsets[1:] = np.cumsum(strategy_span_counts)
+
+    span_indices = np.zeros((strategy_offsets[-1], PORTFOLIO_SPAN_INDEX_COLUMNS), dtype=np.int64)
+    span_prices = np.zeros((strategy_offsets[-1], PORTFOLIO_SPAN_PRICE_COLUMNS), dtype=np.float64)
+    for strategy_index, strategy in enumerate(portfolio_strategies):
+        market = strategy['market']
+        if market not in portfolio_markets['market_indexes']:
+            raise Exception(f'Portfolio strategy {strategy_index} trades {market} which has no bars in the portfolio')
+        market_index = portfolio_markets['market_indexes'][market]
+        market_offset = portfolio_markets['market_offsets'][market_index]
+        strategy_span_indices, strategy_span_prices = strategy['trade_spans']
+
+        spans = slice(strategy_offsets[strategy_index], strategy_offsets[strategy_index + 1])
+        span_indices[spans, PORTFOLIO_SPAN_START] = strategy_span_indices[:, TRADE_SPAN_START] + market_offset
+        span_indices[spans, PORTFOLIO_SPAN_END] = strategy_span_indices[:, TRADE_SPAN_END] + market_offset
+        span_indices[spans, PORTFOLIO_SPAN_DIRECTION] = strategy_span_indices[:, TRADE_SPAN_DIRECTION]
+        span_indices[spans, PORTFOLIO_SPAN_MARKET] = market_index
+        span_prices[spans, PORTFOLIO_SPAN_ENTRY_PRICE] = strategy_span_prices[:, TRADE_SPAN_ENTRY_PRICE]
+        span_prices[spans, PORTFOLIO_SPAN_EXIT_PRICE] = strategy_span_prices[:, TRADE_SPAN_EXIT_PRICE]
+        span_prices[spans, PORTFOLIO_SPAN_UNITS] = strategy['weighting'] * market_contract_size[market]
+
+    return span_indices, span_prices, strategy_offsets
+
+
+@njit(cache=True, nogil=True)
+def simulate_portfolio_spans(span_indices, span_prices, all_closes, clock_indexes, entry_order, exit_order,
+                             market_leverage_limits, global_leverage_limit, account_size,
+                             span_scales, span_exposures, portfolio_returns, exposure_changes):
+    # Takes the spans in the order they enter on the clock, spans entering on the same minute in portfolio order
+    # A span holds its leverage from the minute after its entry bar up to its exit bar, so the spans whose exit bar is
+    # at or before an entry bar have released their leverage by the time that entry is sized
+    # An entry is scaled down to the leverage left under its market's limit and the global limit, and skipped with a
+    # scale of 0 when none is left. The scale is kept for the life of the span
+    # Leverage is gross, so long and short spans in one market add up rather than net off
+    market_leverages = np.zeros(len(market_leverage_limits), dtype=np.float64)
+    global_leverage = 0.0
+    exit_position = 0
+
+    for entry_position in range(len(entry_order)):
+        span = entry_order[entry_position]
+        start = span_indices[span, PORTFOLIO_SPAN_START]
+        end = span_indices[span, PORTFOLIO_SPAN_END]
+        market = span_indices[span, PORTFOLIO_SPAN_MARKET]
+        entry_clock = clock_indexes[start]
+
+        while exit_position < len(exit_order):
+            exit_span = exit_order[exit_position]
+            if clock_indexes[span_indices[exit_span, PORTFOLIO_SPAN_END]] > entry_clock:
+                break
+            exit_market = span_indices[exit_span, PORTFOLIO_SPAN_MARKET]
+            market_leverages[exit_market] = max(0.0, market_leverages[exit_market] - span_exposures[exit_span])
+            global_leverage = max(0.0, global_leverage - span_exposures[exit_span])
+            exit_position += 1
+
+        entry_price = span_prices[span, PORTFOLIO_SPAN_ENTRY_PRICE]
+        exit_price = span_prices[span, PORTFOLIO_SPAN_EXIT_PRICE]
+        units = span_prices[span, PORTFOLIO_SPAN_UNITS]
+        leverage = units * entry_price / account_size
+        if leverage <= 0.0:
+            continue
+
+        remaining_leverage = min(market_leverage_limits[market] - market_leverages[market],
+                                 global_leverage_limit - global_leverage)
+        scale = 1.0
+        if leverage > remaining_leverage:
+            scale = max(0.0, remaining_leverage) / leverage
+        if scale <= 0.0:
+            continue
+
+        exposure = leverage * scale
+        span_scales[span] = scale
+        span_exposures[span] = exposure
+        market_leverages[market] += exposure
+        global_leverage += exposure
+
+        # Same minute returns as fill_trade_span_returns, as a return on the account rather than on the entry price
+        account_units = scale * units * span_indices[span, PORTFOLIO_SPAN_DIRECTION] / account_size
+        for index in range(start + 1, end + 1):
+            portfolio_returns[clock_indexes[index]] += (all_closes[index] - all_closes[index - 1]) * account_units
+        portfolio_returns[clock_indexes[start + 1]] -= (entry_price - all_closes[start]) * account_units
+        portfolio_returns[clock_indexes[end]] -= (all_closes[end] - exit_price) * account_units
+
+        exposure_changes[market, clock_indexes[start + 1]] += exposure
+        exposure_changes[market, clock_indexes[end] + 1] -= exposure
+
+
+def get_market_leverage_limits(markets, global_leverage_limit, market_leverage_limits):
+    # Markets without a limit of their own are only held to the global limit
+    return np.array([market_leverage_limits.get(market, global_leverage_limit) for market in markets], dtype=np.float64)
+
+
+def simulate_portfolio(portfolio_markets, portfolio_strategies,
+                       account_size=None, global_leverage_limit=None, market_leverage_limits=None):
+    # Returns the minute returns of the portfolio on the account, the leverage held in each market and in total at every
+    # minute of the clock, and the scale each strategy's spans were entered with, 1 for uncapped and 0 for skipped
+    # account_size, global_leverage_limit and market_leverage_limits of None follow settings
+    if account_size is None:
+        account_size = settings.account_size
+    if global_leverage_limit is None:
+        global_leverage_limit = settings.global_leverage_limit
+    if market_leverage_limits is None:
+        market_leverage_limits = settings.market_leverage_limit
+
+    span_indices, span_prices, strategy_offsets = create_portfolio_spans(portfolio_markets, portfolio_strategies)
+    clock_indexes = portfolio_markets['clock_indexes']
+    clock_length = len(portfolio_markets['clock_minutes'])
+    market_count = len(portfolio_markets['markets'])
+
+    # Stable sorts keep spans that enter or exit on the same minute in portfolio order
+    entry_order = np.argsort(clock_indexes[span_indices[:, PORTFOLIO_SPAN_START]], kind='stable')
+    exit_order = np.argsort(clock_indexes[span_indices[:, PORTFOLIO_SPAN_END]], kind='stable')
+
+    span_scales = np.zeros(len(span_indices), dtype=np.float64)
+    span_exposures = np.zeros(len(span_indices), dtype=np.float64)
+    portfolio_returns = np.zeros(clock_length, dtype=np.float64)
+    exposure_changes = np.zeros((market_count, clock_length + 1), dtype=np.float64)
+    simulate_portfolio_spans(span_indices, span_prices, portfolio_markets['all_closes'], clock_indexes,
+                             entry_order, exit_order,
+                             get_market_leverage_limits(portfolio_markets['markets'], global_leverage_limit,
+                                                        market_leverage_limits),
+                             float(global_leverage_limit), float(account_size),
+                             span_scales, span_exposures, portfolio_returns, exposure_changes)
+
+    market_exposures = np.cumsum(exposure_changes[:, :clock_length], axis=1)
+    gross_exposures = market_exposures.sum(axis=0)
+    strategy_span_scales = [span_scales[strategy_offsets[strategy_index]:strategy_offsets[strategy_index + 1]]
+                            for strategy_index in range(len(portfolio_strategies))]
+
+    return portfolio_returns, gross_exposures, market_exposures, strategy_span_scales
+
+
+def get_portfolio_datetimes(portfolio_markets):
+    return from_epoch_minutes(portfolio_markets['clock_minutes'])
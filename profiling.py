@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+import settings
+
+# Phases of a backtest that time is counted against when settings.use_profiling is on
+# Masks: allowed entries from the sessions, days and timed exits
+PROFILE_PHASE_MASKS = 'masks'
+# Decisions: combining the indicator signals into entries
+PROFILE_PHASE_DECISIONS = 'decisions'
+# Trades: simulating the trades, which also writes the minute returns
+PROFILE_PHASE_TRADES = 'trades'
+# Returns: turning the simulated trades into trade returns, entry datetimes and signal counts
+PROFILE_PHASE_RETURNS = 'returns'
+# Trade frame: building the trade DataFrame
+PROFILE_PHASE_TRADE_FRAME = 'trade_frame'
+# Each indicator is counted by name, as indicator.<name>
+PROFILE_INDICATOR_PREFIX = 'indicator.'
+
+# Counters are calls, seconds and bytes allocated at the peak of each phase, summed over the calls
+PROFILE_COUNTER_CALLS = 0
+PROFILE_COUNTER_SECONDS = 1
+PROFILE_COUNTER_ALLOCATED = 2
+
+# Counters are per process, pool tasks hand theirs back with take_profile_counters for the parent to merge
+profile_counters = {}
+# Strategies evaluated on threads share the counters
+profile_lock = threading.Lock()
+
+
+def start_profile_phase():
+    # Returns what end_profile_phase needs, or None when profiling is off so a phase only costs this check
+    if not settings.use_profiling:
+        return None
+
+    allocated = 0
+    if settings.profile_allocations:
+        # The peak is reset for the whole process, so phases must not overlap, see check_profile_allocations_threads
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    return time.perf_counter(), allocated
+
+
+def end_profile_phase(phase_name, phase_start):
+    if phase_start is None:
+        return
+
+    start_time, start_allocated = phase_start
+    seconds = time.perf_counter() - start_time
+    allocated = 0
+    if settings.profile_allocations and tracemalloc.is_tracing():
+        allocated = max(0, tracemalloc.get_traced_memory()[1] - start_allocated)
+
+    with profile_lock:
+        counters = profile_counters.get(phase_name, None)
+        if counters is None:
+            counters = [0, 0.0, 0]
+            profile_counters[phase_name] = counters
+        counters[PROFILE_COUNTER_CALLS] += 1
+        counters[PROFILE_COUNTER_SECONDS] += seconds
+        counters[PROFILE_COUNTER_ALLOCATED] += allocated
+
+
+def check_profile_allocations_threads(thread_count):
+    # Phases of one thread never overlap, but phases on other threads would reset each other's peaks
+    if settings.use_profiling and settings.profile_allocations and thread_count > 1:
+        raise Exception(f'Allocations can not be profiled over {thread_count} threads, '
+                        f'turn off settings.profile_allocations or run on one thread')
+
+
+def get_indicator_phase(indicator_name):
+    return f'{PROFILE_INDICATOR_PREFIX}{indicator_name}'
+
+
+def get_profile_counters():
+    with profile_lock:
+        return {phase_name: {'calls': counters[PROFILE_COUNTER_CALLS],
+                             'seconds': counters[PROFILE_COUNTER_SECONDS],
+                             'allocated_bytes': counters[PROFILE_COUNTER_ALLOCATED]}
+                for phase_name, counters in profile_counters.items()}
+
+
+def reset_profile_counters():
+    with profile_lock:
+        profile_counters.clear()
+
+
+def take_profile_counters():
+    # Returns the counters so far and starts again from zero, so a pool task returns each count once
+    with profile_lock:
+        counters = {phase_name: list(counters) for phase_name, counters in profile_counters.items()}
+        profile_counters.clear()
+
+    return counters
+
+
+def merge_profile_counters(task_counters):
+    # Adds the counters taken by take_profile_counters in another process
+    with profile_lock:
+        for phase_name, counters in task_counters.items():
+            merged_counters = profile_counters.get(phase_name, None)
+            if merged_counters is None:
+                merged_counters = [0, 0.0, 0]
+                profile_counters[phase_name] = merged_counters
+            merged_counters[PROFILE_COUNTER_CALLS] += counters[PROFILE_COUNTER_CALLS]
+            merged_counters[PROFILE_COUNTER_SECONDS] += counters[PROFILE_COUNTER_SECONDS]
+            merged_counters[PROFILE_COUNTER_ALLOCATED] += counters[PROFILE_COUNTER_ALLOCATED]
+
+
+def write_profile_counters(filename, generation, reset=True):
+    # Appends a row per phase for the generation, slowest phase first, and by default starts the next
+    # generation from zero. Counters of pool tasks are included once they have been merged
+    phase_counters = get_profile_counters()
+    if reset:
+        reset_profile_counters()
+
+    profile_df = pd.DataFrame(
+        [{'generation': generation, 'phase': phase_name, **counters} for phase_name, counters in phase_counters.items()],
+        columns=['generation', 'phase', 'calls', 'seconds', 'allocated_bytes'])
+    profile_df = profile_df.sort_values('seconds', ascending=False)
+    profile_df.to_csv(filename, mode='a', index=False, header=not os.path.exists(filename))
+
+    return profile_df
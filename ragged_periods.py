@@ -0,0 +1,73 @@
+import numpy as np
+from numba.extending import overload
+
+
+class RaggedPeriods:
+    # Periods of one field stored back to back along the last axis of values without any padding, the minutes of
+    # period p are values[..., period_offsets[p]:period_offsets[p] + period_lengths[p]]
+    # Indexing by period gives the exact length view of the period, like a row of the matrix layout
+    # Indexing by (periods, minute indexes) gives the values at those minutes like the matrix layout does
+    def __init__(self, values, period_offsets, period_lengths):
+        self.values = values
+        self.period_offsets = np.asarray(period_offsets, dtype=np.int64)
+        self.period_lengths = np.asarray(period_lengths, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.period_lengths)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            period_indexes, minute_indexes = key
+            return self.values[..., self.period_offsets[period_indexes] + minute_indexes]
+
+        period_start = self.period_offsets[key]
+        return self.values[..., period_start:period_start + self.period_lengths[key]]
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    def with_values(self, values):
+        # Same periods over other values, such as a mask calculated from this field
+        return RaggedPeriods(values, self.period_offsets, self.period_lengths)
+
+
+def is_period_ragged(period_array):
+    return isinstance(period_array, RaggedPeriods)
+
+
+def create_ragged_periods(shape, dtype, period_offsets, period_lengths, fill_value=0):
+    # shape is the leading axes of each minute, the minutes of every period are added as the last axis
+    period_lengths = np.asarray(period_lengths, dtype=np.int64)
+    values = np.full(tuple(shape) + (int(period_lengths.sum()),), fill_value, dtype=dtype)
+    return RaggedPeriods(values, period_offsets, period_lengths)
+
+
+def unwrap_ragged_periods(period_array):
+    # The compiled functions take the flat values of ragged periods with the period offsets and lengths,
+    # and take a matrix as it is
+    if is_period_ragged(period_array):
+        return period_array.values
+    return period_array
+
+
+def get_period_values(period_values, period_offsets, period_lengths, period_index):
+    # Minutes of one period from a matrix row or from flat ragged values
+    if period_values.ndim == 1:
+        period_start = period_offsets[period_index]
+        return period_values[period_start:period_start + period_lengths[period_index]]
+    return period_values[period_index]
+
+
+@overload(get_period_values)
+def overload_get_period_values(period_values, period_offsets, period_lengths, period_index):
+    # Picked when compiling from the number of dimensions so the kernels run on either layout
+    if period_values.ndim == 1:
+        def get_ragged_period_values(period_values, period_offsets, period_lengths, period_index):
+            period_start = period_offsets[period_index]
+            return period_values[period_start:period_start + period_lengths[period_index]]
+        return get_ragged_period_values
+
+    def get_matrix_period_values(period_values, period_offsets, period_lengths, period_index):
+        return period_values[period_index]
+    return get_matrix_period_values
@@ -2,7 +2,7 @@ import datetime
 
 import pandas as pd
 from market_reference import market_slippage
-from constants import IndicatorReset, Session
+from constants import IndicatorReset, Session, BarLayout, DecisionCombiner
 
 markets = ['CL', 'ES', 'GC', 'NQ', 'EU']
 # markets = ['CL', 'ES', 'GC', 'EU']
@@ -93,6 +93,19 @@ market_limits = {}
 #     'max_trade_length': 150,
 # }
 
+# Successive halving of GA candidates, see evaluate_strategy_halving
+# Each stage backtests this fraction of the most recent periods and stops a candidate that can no longer pass
+halving_period_fractions = [0.125, 0.25, 0.5]
+# Requirements and limits checked after each stage with the slack given to the partial value
+# Bounds that hold for any history, like trade_count0 and tradable_weeks_rate0, need no slack
+halving_requirements = {
+    'tradable_weeks_rate0': 0.0,
+    'trade_count0': 0.0,
+}
+# Requirements only estimated from the recent periods, eg {'min_sharpes0': 0.5}, which can stop candidates that
+# would pass over the whole history so are off unless given here with their slack
+halving_estimates = {}
+
 underscore_multipliers = {
     'tradable_weeks_rate0': 1000000,
     'aart0': 1, # AAR Target is 0.1 so AART jumps from 0.1 to 1.0. This makes improving this score 0.1x as useful as the others
@@ -190,6 +203,42 @@ write_all_path = f'.'
 data_process_count = 8
 build_process_count = 8
 strategy_cache_size = 2000
+# Strategies whose entries are kept per process so offspring that only change exits skip calculate_entries
+use_entry_cache = True
+entry_cache_size = 500
+# Datasets whose first passage tables and next exits are kept for strategies backtested without them
+dataset_lookup_cache_size = 4
+# Simulate entries period by period, or in chunks of this many periods with a pool, instead of for the whole history
+stream_periods = False
+stream_period_chunk_size = 32
+# Threads used by run_strategies_threaded, 0 uses one per cpu
+backtest_thread_count = 0
+# Tasks per pool process when backtest work is split into chunks of periods or strategies
+pool_tasks_per_process = 4
+# BarLayout.Ragged drops the padding of short periods, shared datasets and dataset stores need BarLayout.Matrix
+bar_layout = BarLayout.Matrix
+# Backtest from memory mapped files written by dataset_store instead of loading the bars from the database
+# Processes and runs on the same host share the files in the page cache, build the stores with dataset_store.py
+use_dataset_store = False
+dataset_store_path = '/home/storage/Data/DatasetStore'
+# Count the time of each phase of run_strategy and of each indicator by name, see profiling
+# Allocations are traced with tracemalloc which slows the backtests down, so only turn them on when looking into memory
+use_profiling = False
+profile_allocations = False
+# Counters are appended per generation by run_population_pooled when it is given the generation
+profile_counters_filename = './profile_counters.csv'
+# Combiner of the indicator signals of strategies without a 'decision_combiner' of their own
+# With DecisionCombiner.Auto the interval combiner is used for periods where the signals change on at most this
+# fraction of the minutes
+decision_combiner = DecisionCombiner.Minute
+interval_decisions_max_density = 0.05
+# Synthetic history, repeats and layouts of benchmark_backtester, results are checked against the stored baseline
+# which is only written when benchmark_write_baseline is set. The checked in baseline is of 12 weeks
+benchmark_weeks = 12
+benchmark_repeats = 5
+benchmark_layouts = [BarLayout.Object, BarLayout.Matrix, BarLayout.Ragged]
+benchmark_baseline_path = './benchmark_baseline.npz'
+benchmark_write_baseline = False
 
 start_pd = pd.Timestamp(start)
 end_pd = pd.Timestamp(end)
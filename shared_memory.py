@@ -1,8 +1,10 @@
 import numpy as np
 
-from constants import Session, TRADING_DAY_COUNT
+from constants import Session, TRADING_DAY_COUNT, BarTypes, OHLC
 from multiprocessing import shared_memory, resource_tracker
 
+from ragged_periods import is_period_ragged
+from dataset_store import open_dataset_store, is_dataset_store_layout, DATASET_STORE_LAYOUT_KEY
 import settings
 
 NP_SHARED_NAME_BARS = 'shared_bars'
@@ -12,11 +14,16 @@ NP_SHARED_NAME_ALLOWED_SESSIONS = 'shared_allowed_sessions'
 NP_SHARED_NAME_DATETIMES = 'shared_datetimes'
 NP_SHARED_NAME_INDICATOR_CACHE = 'shared_indicator_cache'
 NP_SHARED_NAME_STRATEGY = 'shared_strategy'
+NP_SHARED_NAME_DATASET = 'shared_dataset'
+NP_SHARED_NAME_RESULTS = 'shared_results'
 
 # Global list to track shared memory references to help clean up
 shared_memory_refs = []
 shared_strategy_refs = {}
 
+# Datasets attached by this process, kept open until the process exits
+attached_shared_datasets = {}
+
 
 def handle_termination_signal(signum, frame):
     cleanup_shared_memory()
@@ -140,6 +147,85 @@ def create_shared_allowed_sessions(pid, market, allowed_sessions):
 
     return shared_allowed_sessions
 
+def create_shared_dataset(pid, market, tag, bars, timed_exits, allowed_entry_sessions, allowed_entry_days,
+                          next_exits=None, extra_arrays=None):
+    # Publishes the matrix layout bars and masks as plain numeric buffers, along with any extra_arrays by field name
+    # Returns the small layout descriptor that workers use to attach
+
+    dataset_arrays = {
+        'open': bars[BarTypes.Minute1.value][OHLC.Open.value],
+        'high': bars[BarTypes.Minute1.value][OHLC.High.value],
+        'low': bars[BarTypes.Minute1.value][OHLC.Low.value],
+        'close': bars[BarTypes.Minute1.value][OHLC.Close.value],
+        'volume': bars[BarTypes.Minute1.value][OHLC.Volume.value],
+        'timed_exits': timed_exits,
+        'allowed_entry_sessions': allowed_entry_sessions,
+        'allowed_entry_days': allowed_entry_days,
+    }
+    if next_exits is not None:
+        dataset_arrays['next_exits'] = next_exits
+    if extra_arrays is not None:
+        dataset_arrays.update(extra_arrays)
+
+    shared_dataset_layout = {}
+    for field, array in dataset_arrays.items():
+        if is_period_ragged(array) or array.dtype == object:
+            raise Exception(f'Shared dataset field {field} must be numeric, load the bars with BarLayout.Matrix')
+
+        name = f'{pid}_{NP_SHARED_NAME_DATASET}_{market}_{tag}_{field}'
+        create_shared_array(np.ascontiguousarray(array), name)
+        shared_dataset_layout[field] = (name, array.shape, array.dtype.str)
+
+    return shared_dataset_layout
+
+def attach_shared_dataset(shared_dataset_layout):
+    # Attaches once per process, later calls return the cached arrays without touching the segments
+    # A dataset store layout maps the store files instead so every worker pages from the same files
+    if is_dataset_store_layout(shared_dataset_layout):
+        return open_dataset_store(shared_dataset_layout[DATASET_STORE_LAYOUT_KEY])
+
+    dataset_key = tuple((field, name, shape) for field, (name, shape, dtype) in shared_dataset_layout.items())
+    if dataset_key in attached_shared_datasets:
+        return attached_shared_datasets[dataset_key][0]
+
+    dataset = {}
+    dataset_shared_memory = {}
+    for field, (name, shape, dtype) in shared_dataset_layout.items():
+        shm_data = shared_memory.SharedMemory(name=name)
+        dataset[field] = np.ndarray(shape, dtype=dtype, buffer=shm_data.buf)
+        dataset_shared_memory[name] = shm_data
+
+    attached_shared_datasets[dataset_key] = (dataset, dataset_shared_memory)
+
+    return dataset
+
+def detach_shared_datasets():
+    for dataset, dataset_shared_memory in attached_shared_datasets.values():
+        dataset.clear()
+        close_shared_data(dataset_shared_memory)
+    attached_shared_datasets.clear()
+
+def release_shared_dataset(shared_dataset_layout):
+    # The files of a dataset store outlive the run and are shared with other runs so they are never removed
+    if is_dataset_store_layout(shared_dataset_layout):
+        return
+    for name, shape, dtype in shared_dataset_layout.values():
+        release_shared_name(name)
+
+def create_shared_result_blocks(pid, tag, block_shapes):
+    # Allocates zeroed float64 blocks that workers write their results into, by field name
+    # The layout has the same form as a shared dataset so workers attach with attach_shared_dataset
+    shared_result_layout = {}
+    shared_result_blocks = {}
+    for field, shape in block_shapes.items():
+        name = f'{pid}_{NP_SHARED_NAME_RESULTS}_{tag}_{field}'
+        (shm, shared_array) = allocate_shared_array(shape, np.float64, name)
+        shared_array.fill(0.0)
+        shared_result_layout[field] = (name, shape, shared_array.dtype.str)
+        shared_result_blocks[field] = shared_array
+
+    return shared_result_layout, shared_result_blocks
+
 def create_shared_indicator_cache(pid, market, shape, dtype):
     shared_indicator_cache = {}
 
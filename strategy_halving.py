@@ -0,0 +1,192 @@
+import numpy as np
+
+from constants import IndicatorReset, WEEKS_PER_YEAR
+from backtester import calculate_all_entries, concatenate_packed_entries, simulate_trades, create_engine_buffers, \
+    calculate_period_week_ids, get_strategy_trade_settings, get_strategy_session_index, \
+    calculate_allowed_entry_day_indexes, is_engine_layout, ENGINE_STATE_FAIL
+from abort_rules import create_empty_abort_rules
+from entry_cache import create_entry_cache_key, get_cached_entries, store_cached_entries
+from first_passage import create_first_passage_tables
+from trade_timing import create_next_exits
+from ragged_periods import unwrap_ragged_periods
+from trade_statistics import PERIOD_STATISTIC_TRADE_COUNT, PERIOD_STATISTIC_WIN_SUM, PERIOD_STATISTIC_LOSS_SUM
+import settings
+
+
+def estimate_min_sharpes(stage, requirement, slack):
+    # The annualised sharpe of the weekly returns so far, which the earlier weeks can still raise or lower
+    return stage['sharpe'] + slack >= requirement
+
+
+def bound_tradable_weeks_rate(stage, requirement, slack):
+    # At best every week not yet backtested trades
+    if stage['total_weeks'] == 0:
+        return True
+    best_rate = (stage['traded_weeks'] + stage['remaining_weeks']) / stage['total_weeks']
+    return best_rate + slack >= requirement
+
+
+def bound_trade_count(stage, limit, slack):
+    # Trades only add up so the count so far is at most the count of the whole history
+    return stage['trade_count'] - slack <= limit
+
+
+# Requirement or limit name to the check of whether a candidate can still meet it after a stage
+# A bound that fails decides that the candidate can not pass over the whole history
+halving_bounds = {
+    'tradable_weeks_rate0': bound_tradable_weeks_rate,
+    'trade_count0': bound_trade_count,
+}
+# An estimate that fails only makes it likely, so they are checked only when given in settings.halving_estimates
+halving_estimates = {
+    'min_sharpes0': estimate_min_sharpes,
+}
+
+
+def calculate_halving_stage(period_statistics, period_week_ids, stage_start):
+    # Summarises the periods from stage_start to the end the way the requirement bounds need them
+    stage_statistics = period_statistics[stage_start:]
+    stage_weeks, week_indexes = np.unique(period_week_ids[stage_start:], return_inverse=True)
+    week_returns = np.bincount(week_indexes, minlength=len(stage_weeks),
+                               weights=stage_statistics[:, PERIOD_STATISTIC_WIN_SUM] +
+                               stage_statistics[:, PERIOD_STATISTIC_LOSS_SUM])
+    week_trade_counts = np.bincount(week_indexes, minlength=len(stage_weeks),
+                                    weights=stage_statistics[:, PERIOD_STATISTIC_TRADE_COUNT])
+
+    sharpe = 0.0
+    week_return_std = week_returns.std() if len(week_returns) > 0 else 0.0
+    if week_return_std > 0:
+        sharpe = float(week_returns.mean() / week_return_std * np.sqrt(WEEKS_PER_YEAR))
+
+    remaining_weeks = len(np.unique(period_week_ids[:stage_start]))
+    return {
+        'period_start': stage_start,
+        'trade_count': int(week_trade_counts.sum()),
+        'traded_weeks': int(np.count_nonzero(week_trade_counts)),
+        'remaining_weeks': remaining_weeks,
+        'total_weeks': len(np.unique(period_week_ids)),
+        'sharpe': sharpe,
+    }
+
+
+def evaluate_strategy_halving(strategy, market,
+                              bars_datetime, bars_open, bars_high, bars_low, bars_close, bars_volume,
+                              timed_exits, allowed_entry_days, allowed_entry_sessions,
+                              period_offsets, period_lengths, all_datetimes, slippage, period_count,
+                              given_requirements, given_limits,
+                              limit_trade_count=0,
+                              indicator_cache_lookup=None,
+                              first_passage_tables=None,
+                              next_exits=None,
+                              period_week_ids=None):
+    # Backtests a candidate on growing windows of the most recent periods, settings.halving_period_fractions, and
+    # stops as soon as one of settings.halving_requirements can no longer be met over the whole history, or one of
+    # settings.halving_estimates is estimated not to be met
+    # Returns can_pass, the name of the requirement that failed and a report of each stage. The report has the
+    # requirement as fail_requirement when the failure is decided and as estimated_fail_requirement when estimated
+    # A candidate that passes every stage leaves the entries of the whole history in the entry cache, so run_strategy
+    # only has to simulate its trades. period_week_ids can be made once per market with calculate_period_week_ids
+    if not is_engine_layout(bars_open, timed_exits):
+        raise Exception(f'Successive halving for {market} needs bars loaded with BarLayout.Matrix or Ragged')
+
+    if next_exits is None:
+        next_exits = create_next_exits(timed_exits)
+    if first_passage_tables is None:
+        first_passage_tables = create_first_passage_tables(bars_high, bars_low)
+    high_tables, low_tables = first_passage_tables
+    if period_week_ids is None:
+        period_week_ids = calculate_period_week_ids(bars_datetime, period_count)
+    period_offsets = np.asarray(period_offsets, dtype=np.int64)
+    period_lengths = np.asarray(period_lengths, dtype=np.int64)
+
+    take_every_signal, max_trade_length, one_trade_per_week, indicator_reset = get_strategy_trade_settings(strategy)
+    allowed_entry_session_index = get_strategy_session_index(strategy)
+    allowed_entry_day_indexes = calculate_allowed_entry_day_indexes(strategy)
+
+    # Entries of the periods from entry_start to the end, packed relative to entry_start
+    # entry_cache_key is only kept when the entries of the whole history still have to be stored
+    entry_cache_key = None
+    entry_start = period_count
+    packed_entries = None
+    if settings.use_entry_cache:
+        entry_cache_key = create_entry_cache_key(strategy, market, all_datetimes)
+        packed_entries = get_cached_entries(entry_cache_key)
+        if packed_entries is not None:
+            entry_start = 0
+            entry_cache_key = None
+
+    halving_report = {'stages': [], 'fail_requirement': None, 'estimated_fail_requirement': None}
+    returns_array = np.zeros(0, dtype=np.float64)
+    # Stages start part way through the history so the requirements are checked here rather than by abort rules
+    abort_rules, period_weeks_after = create_empty_abort_rules(period_count)
+    for period_fraction in settings.halving_period_fractions:
+        stage_start = max(0, period_count - int(np.ceil(period_count * period_fraction)))
+        if stage_start < entry_start:
+            stage_entries = calculate_all_entries(strategy, market,
+                                                  bars_open, bars_high, bars_low, bars_close, bars_volume,
+                                                  timed_exits, allowed_entry_days, allowed_entry_sessions,
+                                                  period_lengths, allowed_entry_session_index, allowed_entry_day_indexes,
+                                                  indicator_cache_lookup, None, None, 0, 0, period_count,
+                                                  None, next_exits, stage_start, entry_start)
+            packed_entries = stage_entries if packed_entries is None else \
+                concatenate_packed_entries([stage_entries, packed_entries])
+            entry_start = stage_start
+
+        # The engine indexes entries by period so place the packed entries after the periods without any
+        entry_offsets = np.zeros(period_count + 1, dtype=np.int64)
+        entry_offsets[entry_start:] = packed_entries[0]
+        period_signal_counts = np.zeros(period_count, dtype=np.int64)
+        period_signal_counts[entry_start:] = packed_entries[3]
+
+        engine_state, engine_extremes, trade_index_values, trade_price_values, period_values, period_statistics = \
+            create_engine_buffers(len(packed_entries[1]), period_count)
+        simulate_trades(unwrap_ragged_periods(bars_open), unwrap_ragged_periods(bars_high),
+                        unwrap_ragged_periods(bars_low), unwrap_ragged_periods(bars_close),
+                        unwrap_ragged_periods(next_exits), high_tables, low_tables,
+                        period_offsets, period_lengths, period_week_ids,
+                        entry_offsets, packed_entries[1], packed_entries[2], period_signal_counts,
+                        returns_array, max_trade_length, strategy['stoploss'], strategy['profit_target'],
+                        take_every_signal, one_trade_per_week, indicator_reset == IndicatorReset.Daily,
+                        limit_trade_count, slippage, stage_start, period_count, engine_state, engine_extremes,
+                        trade_index_values, trade_price_values, period_values, period_statistics,
+                        abort_rules, period_weeks_after)
+
+        stage = calculate_halving_stage(period_statistics, period_week_ids, stage_start)
+        halving_report['stages'].append(stage)
+
+        if engine_state[ENGINE_STATE_FAIL] == 1:
+            halving_report['fail_requirement'] = 'limit_trade_count'
+            return False, 'limit_trade_count', halving_report
+
+        for requirement_name, slack in settings.halving_requirements.items():
+            threshold = given_requirements.get(requirement_name, given_limits.get(requirement_name, None))
+            if threshold is None:
+                continue
+            if not halving_bounds[requirement_name](stage, threshold, slack):
+                halving_report['fail_requirement'] = requirement_name
+                return False, requirement_name, halving_report
+
+        for requirement_name, slack in settings.halving_estimates.items():
+            threshold = given_requirements.get(requirement_name, given_limits.get(requirement_name, None))
+            if threshold is None:
+                continue
+            if not halving_estimates[requirement_name](stage, threshold, slack):
+                halving_report['estimated_fail_requirement'] = requirement_name
+                return False, requirement_name, halving_report
+
+        del engine_state, engine_extremes, trade_index_values, trade_price_values, period_values, period_statistics
+
+    # Passed every stage so finish the entries for the full backtest
+    if entry_cache_key is not None:
+        if entry_start > 0:
+            stage_entries = calculate_all_entries(strategy, market,
+                                                  bars_open, bars_high, bars_low, bars_close, bars_volume,
+                                                  timed_exits, allowed_entry_days, allowed_entry_sessions,
+                                                  period_lengths, allowed_entry_session_index, allowed_entry_day_indexes,
+                                                  indicator_cache_lookup, None, None, 0, 0, period_count,
+                                                  None, next_exits, 0, entry_start)
+            packed_entries = stage_entries if packed_entries is None else \
+                concatenate_packed_entries([stage_entries, packed_entries])
+        store_cached_entries(entry_cache_key, packed_entries)
+
+    return True, None, halving_report
@@ -0,0 +1,156 @@
+import numpy as np
+from numba import njit
+
+from constants import ReturnBucket, IndicatorReset, START_DAY_TRADING_HOUR
+
+# Columns of the integer and price arrays describing the trade spans of a strategy
+# A trade span covers the minutes from the entry bar to the exit bar as indexes into all_datetimes and all_closes
+TRADE_SPAN_START = 0
+TRADE_SPAN_END = 1
+TRADE_SPAN_DIRECTION = 2
+TRADE_SPAN_INDEX_COLUMNS = 3
+
+TRADE_SPAN_ENTRY_PRICE = 0
+TRADE_SPAN_EXIT_PRICE = 1
+TRADE_SPAN_PRICE_COLUMNS = 2
+
+
+def create_trade_spans(trade_count):
+    span_indices = np.zeros((trade_count, TRADE_SPAN_INDEX_COLUMNS), dtype=np.int64)
+    span_prices = np.zeros((trade_count, TRADE_SPAN_PRICE_COLUMNS), dtype=np.float64)
+    return span_indices, span_prices
+
+
+@njit(cache=True, nogil=True)
+def fill_trade_span_returns(span_indices, span_prices, all_closes, returns_array):
+    # Adds the minute returns of every span into returns_array the same way calculate_trade does
+    for span_index in range(len(span_indices)):
+        start = span_indices[span_index, TRADE_SPAN_START]
+        end = span_indices[span_index, TRADE_SPAN_END]
+        direction = span_indices[span_index, TRADE_SPAN_DIRECTION]
+        entry_price = span_prices[span_index, TRADE_SPAN_ENTRY_PRICE]
+        exit_price = span_prices[span_index, TRADE_SPAN_EXIT_PRICE]
+
+        # Close to close for all minutes of the trade
+        for index in range(start + 1, end + 1):
+            returns_array[index] += (all_closes[index] - all_closes[index - 1]) * direction / entry_price
+        # Adjust the first minute's return by the difference of the previous close and the entry price
+        returns_array[start + 1] -= (entry_price - all_closes[start]) * direction / entry_price
+        # Adjust the last minute's return by the difference of the close and the exit price
+        returns_array[end] -= (all_closes[end] - exit_price) * direction / entry_price
+
+
+def create_trade_span_returns(span_indices, span_prices, all_closes):
+    # Materialises the dense minute returns of a strategy from its trade spans
+    returns_array = np.zeros(len(all_closes), dtype=np.float64)
+    fill_trade_span_returns(span_indices, span_prices, all_closes, returns_array)
+    return returns_array
+
+
+@njit(cache=True, nogil=True)
+def fill_trade_span_bucket_returns(span_indices, span_prices, all_closes, bucket_starts, bucket_returns):
+    # The close to close returns of a span telescope, so each bucket a span touches costs one difference of closes
+    bucket_count = len(bucket_starts)
+    for span_index in range(len(span_indices)):
+        start = span_indices[span_index, TRADE_SPAN_START]
+        end = span_indices[span_index, TRADE_SPAN_END]
+        direction = span_indices[span_index, TRADE_SPAN_DIRECTION]
+        entry_price = span_prices[span_index, TRADE_SPAN_ENTRY_PRICE]
+        exit_price = span_prices[span_index, TRADE_SPAN_EXIT_PRICE]
+
+        # Buckets holding the first and last minutes with a return
+        first_bucket = np.searchsorted(bucket_starts, start + 1, side='right') - 1
+        last_bucket = np.searchsorted(bucket_starts, end, side='right') - 1
+
+        bucket = first_bucket
+        minute = start + 1
+        while minute <= end:
+            bucket_end = end
+            if bucket + 1 < bucket_count and bucket_starts[bucket + 1] - 1 < end:
+                bucket_end = bucket_starts[bucket + 1] - 1
+            bucket_returns[bucket] += (all_closes[bucket_end] - all_closes[minute - 1]) * direction / entry_price
+            minute = bucket_end + 1
+            bucket += 1
+
+        bucket_returns[first_bucket] -= (entry_price - all_closes[start]) * direction / entry_price
+        bucket_returns[last_bucket] -= (all_closes[end] - exit_price) * direction / entry_price
+
+
+def create_trade_span_bucket_returns(span_indices, span_prices, all_closes, bucket_starts):
+    # Sums the returns of a strategy into buckets such as hours, days or weeks without materialising minute returns
+    # bucket_starts are the sorted indexes into all_closes where each bucket begins, starting with 0
+    bucket_returns = np.zeros(len(bucket_starts), dtype=np.float64)
+    fill_trade_span_bucket_returns(span_indices, span_prices, all_closes,
+                                   np.asarray(bucket_starts, dtype=np.int64), bucket_returns)
+    return bucket_returns
+
+
+def calculate_bucket_keys(all_datetimes, return_bucket):
+    # A key per minute that only changes where a new bucket starts
+    if return_bucket == ReturnBucket.Hour:
+        return all_datetimes.astype('datetime64[h]')
+    if return_bucket == ReturnBucket.TradingDay:
+        # Same days as day_start in get_database_data, bars from 18:00 belong to the next trading day
+        return (all_datetimes - np.timedelta64(START_DAY_TRADING_HOUR + 1, 'h')).astype('datetime64[D]')
+    if return_bucket == ReturnBucket.Week:
+        # Same weeks as week_start in get_database_data, starting on Sunday at 17:00
+        # Day 0 of datetime64 is a Thursday so adding 4 days lines the weeks up with Sundays
+        trading_days = (all_datetimes - np.timedelta64(START_DAY_TRADING_HOUR, 'h')).astype('datetime64[D]')
+        return (trading_days.astype(np.int64) + 4) // 7
+    raise Exception(f'Unknown return bucket {return_bucket}')
+
+
+def calculate_bucket_datetimes(bucket_keys, return_bucket):
+    # Labels each bucket by the time it starts
+    if return_bucket == ReturnBucket.Hour:
+        return bucket_keys.astype('datetime64[ns]')
+    if return_bucket == ReturnBucket.TradingDay:
+        return bucket_keys.astype('datetime64[ns]') + np.timedelta64(START_DAY_TRADING_HOUR + 1, 'h')
+    week_starts = (bucket_keys * 7 - 4).astype('datetime64[D]')
+    return week_starts.astype('datetime64[ns]') + np.timedelta64(START_DAY_TRADING_HOUR, 'h')
+
+
+def create_return_bucket_offsets(all_datetimes, return_bucket, period_offsets=None, indicator_reset=None):
+    # Finds the index into all_datetimes where each bucket begins, for aggregate_bucket_returns
+    # and create_trade_span_bucket_returns, with the datetime each bucket starts at
+    # When the buckets are the periods of indicator_reset they are taken from period_offsets
+    all_datetimes = np.asarray(all_datetimes, dtype='datetime64[ns]')
+    if len(all_datetimes) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype='datetime64[ns]')
+
+    if period_offsets is not None and \
+            ((return_bucket == ReturnBucket.TradingDay and indicator_reset == IndicatorReset.Daily) or
+             (return_bucket == ReturnBucket.Week and indicator_reset == IndicatorReset.Weekly)):
+        bucket_starts = np.asarray(period_offsets, dtype=np.int64)
+        bucket_starts = bucket_starts[bucket_starts < len(all_datetimes)]
+        bucket_keys = calculate_bucket_keys(all_datetimes[bucket_starts], return_bucket)
+        return bucket_starts, calculate_bucket_datetimes(bucket_keys, return_bucket)
+
+    bucket_keys = calculate_bucket_keys(all_datetimes, return_bucket)
+    bucket_starts = np.concatenate((np.zeros(1, dtype=np.int64),
+                                    np.flatnonzero(bucket_keys[1:] != bucket_keys[:-1]) + 1))
+
+    return bucket_starts, calculate_bucket_datetimes(bucket_keys[bucket_starts], return_bucket)
+
+
+def aggregate_bucket_returns(returns, bucket_starts):
+    # Sums minute returns into the buckets starting at bucket_starts in one pass
+    # returns can be one strategy's returns or a block with a row per strategy
+    returns = np.asarray(returns, dtype=np.float64)
+    if len(bucket_starts) == 0:
+        return np.zeros(returns.shape[:-1] + (0,), dtype=np.float64)
+
+    return np.add.reduceat(returns, bucket_starts, axis=-1)
+
+
+def fill_empty_bucket_returns(bucket_returns, bucket_datetimes, bucket_width):
+    # Spreads the returns over every bucket_width step from the first to the last bucket, with 0 returns for steps
+    # with no minutes, the same buckets pandas resample makes
+    if len(bucket_datetimes) == 0:
+        return bucket_returns, bucket_datetimes
+
+    calendar_datetimes = np.arange(bucket_datetimes[0], bucket_datetimes[-1] + bucket_width, bucket_width)
+    calendar_returns = np.zeros(bucket_returns.shape[:-1] + (len(calendar_datetimes),), dtype=np.float64)
+    calendar_returns[..., (bucket_datetimes - bucket_datetimes[0]) // bucket_width] = bucket_returns
+
+    return calendar_returns, calendar_datetimes
@@ -0,0 +1,168 @@
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+
+from constants import enum_encoder, DECISON_LONG, DECISON_SHORT, DECISON_FLAT
+from epoch_minutes import from_epoch_minutes
+import settings
+
+# A strategy trace keeps the allowed entries, the long and short signal of every indicator and the entry decisions of
+# every minute the strategy was backtested over, in one file that each period is appended to as it is calculated
+# The file is a header followed by a block per period. A block holds the period index and its minute count, then its
+# columns one after the other: the bar datetimes as epoch minutes, the decisions as int8 and every boolean column
+# bit-packed. Blocks are sized from their minute count so a reader can find any period without reading the others
+STRATEGY_TRACE_MAGIC = b'STRACE01'
+STRATEGY_TRACE_ALIGNMENT = 8
+STRATEGY_TRACE_BLOCK_HEADER = np.dtype([('period_index', np.int64), ('minute_count', np.int64)])
+
+STRATEGY_TRACE_ALLOWED_ENTRY = 'Allowed Entry'
+STRATEGY_TRACE_DECISION = 'Entry Decision'
+
+
+def get_strategy_trace_filename():
+    return f'{settings.write_all_path}/strategy.trace'
+
+
+def get_padded_size(size):
+    return -(-size // STRATEGY_TRACE_ALIGNMENT) * STRATEGY_TRACE_ALIGNMENT
+
+
+def get_strategy_trace_columns(strategy):
+    # Boolean columns in the order they are packed in each block
+    columns = [STRATEGY_TRACE_ALLOWED_ENTRY]
+    for indicator_name, params in strategy['indicators']:
+        columns.append(f'{indicator_name},{params}.Long')
+    for indicator_name, params in strategy['indicators']:
+        columns.append(f'{indicator_name},{params}.Short')
+    return columns
+
+
+def get_strategy_trace_block_size(minute_count, bool_column_count):
+    return STRATEGY_TRACE_BLOCK_HEADER.itemsize + get_padded_size(
+        minute_count * 8 + minute_count + bool_column_count * ((minute_count + 7) // 8))
+
+
+def open_strategy_trace(filename, strategy, bars_datetime):
+    # Starts a trace of the strategy, replacing any trace in filename
+    # bars_datetime are the epoch minutes of the bars by period that each appended period takes its datetimes from
+    columns = get_strategy_trace_columns(strategy)
+    header = json.dumps({'columns': columns, 'strategy': strategy}, cls=enum_encoder).encode('utf-8')
+    header = header + b' ' * (get_padded_size(len(header)) - len(header))
+
+    trace_file = open(filename, 'wb')
+    trace_file.write(STRATEGY_TRACE_MAGIC)
+    trace_file.write(np.int64(len(header)).tobytes())
+    trace_file.write(header)
+
+    return {
+        'filename': filename,
+        'file': trace_file,
+        'columns': columns,
+        'bars_datetime': bars_datetime,
+        # Periods are appended from whichever thread calculates them
+        'lock': threading.Lock(),
+    }
+
+
+def append_strategy_trace(strategy_trace, period_index, period_length, allowed_entries, long_signals, short_signals,
+                          decisions):
+    # Appends the first period_length minutes of a period, long_signals and short_signals have a row per indicator
+    bool_columns = np.empty((len(strategy_trace['columns']), period_length), dtype=bool)
+    indicator_count = len(long_signals)
+    bool_columns[0] = allowed_entries[:period_length]
+    bool_columns[1:1 + indicator_count] = long_signals[:, :period_length]
+    bool_columns[1 + indicator_count:] = short_signals[:, :period_length]
+
+    block_header = np.zeros(1, dtype=STRATEGY_TRACE_BLOCK_HEADER)
+    block_header['period_index'] = period_index
+    block_header['minute_count'] = period_length
+    block_parts = [
+        block_header.tobytes(),
+        np.ascontiguousarray(strategy_trace['bars_datetime'][period_index][:period_length], dtype=np.int64).tobytes(),
+        np.asarray(decisions[:period_length], dtype=np.int8).tobytes(),
+        np.packbits(bool_columns, axis=1).tobytes(),
+    ]
+    block_size = sum(len(block_part) for block_part in block_parts)
+    block_parts.append(b'\0' * (get_strategy_trace_block_size(period_length, len(bool_columns)) - block_size))
+
+    with strategy_trace['lock']:
+        strategy_trace['file'].write(b''.join(block_parts))
+
+
+def close_strategy_trace(strategy_trace):
+    strategy_trace['file'].close()
+
+
+def load_strategy_trace(filename):
+    # Maps the trace and finds the block of every period from the block headers, the columns are only read when
+    # read_strategy_trace_periods asks for their periods
+    trace_values = np.memmap(filename, dtype=np.uint8, mode='r')
+    if trace_values[:len(STRATEGY_TRACE_MAGIC)].tobytes() != STRATEGY_TRACE_MAGIC:
+        raise Exception(f'{filename} is not a strategy trace')
+
+    header_length = int(trace_values[len(STRATEGY_TRACE_MAGIC):len(STRATEGY_TRACE_MAGIC) + 8].view(np.int64)[0])
+    block_start = len(STRATEGY_TRACE_MAGIC) + 8
+    header = json.loads(trace_values[block_start:block_start + header_length].tobytes())
+    block_start += header_length
+
+    bool_column_count = len(header['columns'])
+    period_blocks = {}
+    while block_start + STRATEGY_TRACE_BLOCK_HEADER.itemsize <= len(trace_values):
+        block_header = trace_values[block_start:block_start + STRATEGY_TRACE_BLOCK_HEADER.itemsize].view(
+            STRATEGY_TRACE_BLOCK_HEADER)[0]
+        minute_count = int(block_header['minute_count'])
+        period_blocks[int(block_header['period_index'])] = (block_start, minute_count)
+        block_start += get_strategy_trace_block_size(minute_count, bool_column_count)
+
+    return {
+        'filename': filename,
+        'values': trace_values,
+        'columns': header['columns'],
+        'strategy': header['strategy'],
+        'period_blocks': period_blocks,
+    }
+
+
+def read_strategy_trace_period(loaded_trace, period_index):
+    # Returns the datetimes, decisions and boolean columns of one period
+    block_start, minute_count = loaded_trace['period_blocks'][period_index]
+    trace_values = loaded_trace['values']
+
+    column_start = block_start + STRATEGY_TRACE_BLOCK_HEADER.itemsize
+    datetimes = trace_values[column_start:column_start + minute_count * 8].view(np.int64)
+    column_start += minute_count * 8
+    decisions = trace_values[column_start:column_start + minute_count].view(np.int8)
+    column_start += minute_count
+    packed_size = (minute_count + 7) // 8
+    packed_columns = trace_values[column_start:column_start + packed_size * len(loaded_trace['columns'])]
+    bool_columns = np.unpackbits(packed_columns.reshape(len(loaded_trace['columns']), packed_size),
+                                 axis=1, count=minute_count).astype(bool)
+
+    return datetimes, decisions, bool_columns
+
+
+def read_strategy_trace_periods(loaded_trace, period_indexes=None):
+    # The traced minutes of the periods as a DataFrame of datetime, period, Allowed Entry, the Long column of every
+    # indicator, then the Short column of every indicator, and the Entry Decision as Long, Flat or Short
+    # Unlike the old trace CSVs there are no bar or Parameter columns, the bars can be joined on datetime and the
+    # parameters are in loaded_trace['strategy']
+    # period_indexes of None reads every period in the trace
+    if period_indexes is None:
+        period_indexes = sorted(loaded_trace['period_blocks'].keys())
+
+    period_dfs = []
+    for period_index in period_indexes:
+        datetimes, decisions, bool_columns = read_strategy_trace_period(loaded_trace, period_index)
+        period_df = pd.DataFrame(dict(zip(loaded_trace['columns'], bool_columns)))
+        period_df.insert(0, 'datetime', from_epoch_minutes(datetimes))
+        period_df.insert(1, 'period', period_index)
+        period_df[STRATEGY_TRACE_DECISION] = pd.Series(decisions).replace(
+            {DECISON_LONG: 'Long', DECISON_FLAT: 'Flat', DECISON_SHORT: 'Short'})
+        period_dfs.append(period_df)
+
+    if len(period_dfs) == 0:
+        return pd.DataFrame(columns=['datetime', 'period'] + loaded_trace['columns'] + [STRATEGY_TRACE_DECISION])
+
+    return pd.concat(period_dfs, ignore_index=True)
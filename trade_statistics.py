@@ -0,0 +1,65 @@
+import numpy as np
+from numba import njit
+
+# Columns of the per period trade statistics accumulated by the trade engine
+# Each row only covers the trades of its period, sum rows over a range of periods to score that range
+PERIOD_STATISTIC_TRADE_COUNT = 0
+PERIOD_STATISTIC_WIN_COUNT = 1
+PERIOD_STATISTIC_WIN_SUM = 2
+PERIOD_STATISTIC_LOSS_SUM = 3
+PERIOD_STATISTIC_RETURN_SQUARE_SUM = 4
+PERIOD_STATISTIC_PROFIT_TARGET_COUNT = 5
+PERIOD_STATISTIC_STOPLOSS_COUNT = 6
+PERIOD_STATISTIC_WORST_TRADE = 7
+PERIOD_STATISTIC_COLUMNS = 8
+
+
+def create_period_statistics(period_count):
+    return np.zeros((period_count, PERIOD_STATISTIC_COLUMNS), dtype=np.float64)
+
+
+@njit(cache=True, nogil=True)
+def add_period_statistic(period_statistic, trade_return, is_profit_target, is_stoploss):
+    # Adds one trade to the statistics row of its period, the worst trade is never above 0 like worst_loss
+    period_statistic[PERIOD_STATISTIC_TRADE_COUNT] += 1
+    if trade_return > 0:
+        period_statistic[PERIOD_STATISTIC_WIN_COUNT] += 1
+        period_statistic[PERIOD_STATISTIC_WIN_SUM] += trade_return
+    else:
+        period_statistic[PERIOD_STATISTIC_LOSS_SUM] += trade_return
+    period_statistic[PERIOD_STATISTIC_RETURN_SQUARE_SUM] += trade_return * trade_return
+    period_statistic[PERIOD_STATISTIC_PROFIT_TARGET_COUNT] += is_profit_target
+    period_statistic[PERIOD_STATISTIC_STOPLOSS_COUNT] += is_stoploss
+    if trade_return < period_statistic[PERIOD_STATISTIC_WORST_TRADE]:
+        period_statistic[PERIOD_STATISTIC_WORST_TRADE] = trade_return
+
+
+def summarise_period_statistics(period_statistics, period_start=0, period_end=None):
+    # Scores the trades of periods period_start to period_end from their accumulated statistics
+    period_statistics = period_statistics[period_start:period_end]
+    totals = period_statistics.sum(axis=0)
+
+    trade_count = int(totals[PERIOD_STATISTIC_TRADE_COUNT])
+    win_count = int(totals[PERIOD_STATISTIC_WIN_COUNT])
+    loss_count = trade_count - win_count
+    win_sum = float(totals[PERIOD_STATISTIC_WIN_SUM])
+    loss_sum = float(totals[PERIOD_STATISTIC_LOSS_SUM])
+    total_return = win_sum + loss_sum
+
+    mean_return = total_return / trade_count if trade_count > 0 else 0.0
+    return_variance = float(totals[PERIOD_STATISTIC_RETURN_SQUARE_SUM]) / trade_count - mean_return * mean_return \
+        if trade_count > 0 else 0.0
+
+    return {
+        'trade_count': trade_count,
+        'win_count': win_count,
+        'win_rate': win_count / trade_count if trade_count > 0 else 0.0,
+        'average_win': win_sum / win_count if win_count > 0 else 0.0,
+        'average_loss': loss_sum / loss_count if loss_count > 0 else 0.0,
+        'total_return': total_return,
+        'mean_return': mean_return,
+        'return_std': float(np.sqrt(max(return_variance, 0.0))),
+        'profit_target_count': int(totals[PERIOD_STATISTIC_PROFIT_TARGET_COUNT]),
+        'stoploss_count': int(totals[PERIOD_STATISTIC_STOPLOSS_COUNT]),
+        'worst_trade': float(period_statistics[:, PERIOD_STATISTIC_WORST_TRADE].min()) if len(period_statistics) > 0 else 0.0,
+    }
@@ -5,37 +5,80 @@ from constants import BarTypes, Session, OHLC, DayOfWeek, TRADING_DAY_COUNT, MIN
                     DAILY_EXIT_HOURS_START, DAILY_EXIT_HOURS_END, \
                     DAILY_EXIT_HOURS_ASIA_FINAL_HOUR, DAILY_EXIT_HOURS_LONDON_FINAL_HOUR, DAILY_EXIT_HOURS_US_FINAL_HOUR, DAILY_EXIT_MINUTES_END_SESSION, \
                     DAILY_ENTRY_HOURS_ASIA_START, DAILY_ENTRY_HOURS_ASIA_END, DAILY_ENTRY_HOURS_LONDON_START, DAILY_ENTRY_HOURS_LONDON_END, \
-                    DAILY_ENTRY_HOURS_US_START, DAILY_ENTRY_HOURS_US_END, DAILY_ENTRY_MINUTES_START_SESSION
-from database_reference import get_database_data, get_risk_events, get_holidays, get_historical_circuit_breakers
+                    DAILY_ENTRY_HOURS_US_START, DAILY_ENTRY_HOURS_US_END, DAILY_ENTRY_MINUTES_START_SESSION, BarLayout, NO_NEXT_EXIT
+from database_reference import get_database_data, get_risk_events, get_holidays, get_historical_circuit_breakers, \
+                    get_bars_layout, get_period_count
+from ragged_periods import is_period_ragged
+from epoch_minutes import calculate_week_start_minutes, to_epoch_minute_ceiling, from_epoch_minutes, \
+                    NANOSECONDS_PER_MINUTE
 
 def get_start_of_week(datetime):
     start_week = datetime - pd.Timedelta(days=(datetime.weekday() + 1) % 7, hours=datetime.hour - 17)
     start_week = start_week.replace(minute=0, second=0, microsecond=0)
     return start_week
 
-def create_before_timed_entries(exit_period, before_time_exits_minutes):
+def calculate_period_week_ids(bars_datetime, period_count):
+    # Start of the trading week of each period as an integer so it can be compared inside the trade engine
+    # The ids are the nanoseconds of get_start_of_week worked out from the epoch minutes of the first bars
+    period_start_minutes = np.array([bars_datetime[period_index][0] for period_index in range(period_count)],
+                                    dtype=np.int64)
 
-    before_timed_entries = np.ones(len(exit_period), dtype=bool)
+    return calculate_week_start_minutes(period_start_minutes) * NANOSECONDS_PER_MINUTE
 
-    true_indices = np.where(exit_period)[0]
+def create_before_timed_entries(next_exit_period, before_time_exits_minutes):
 
-    for idx in true_indices:
-        start_idx = max(0, idx - before_time_exits_minutes)
-        before_timed_entries[start_idx:idx+1] = False
+    # Entries are not allowed when the next timed exit is within before_time_exits_minutes
+    minutes_to_next_exit = next_exit_period - np.arange(len(next_exit_period), dtype=np.int64)
+    before_timed_entries = minutes_to_next_exit > before_time_exits_minutes
 
-    del true_indices
+    del minutes_to_next_exit
 
     return before_timed_entries
 
+def create_period_next_exits(exit_period):
+    # Index of the first timed exit at or after each minute, NO_NEXT_EXIT when there is none left in the period
+    exit_indices = np.where(exit_period, np.arange(exit_period.shape[-1], dtype=np.int32), np.int32(NO_NEXT_EXIT))
+    next_exits = np.minimum.accumulate(exit_indices[..., ::-1], axis=-1)[..., ::-1]
+
+    del exit_indices
+
+    return np.ascontiguousarray(next_exits)
+
+def create_next_exits(all_exits):
+    # Timed exits are fixed per market and reset type so the next exit lookup is built once next to them
+    if is_period_ragged(all_exits):
+        # Next exits stay relative to the start of their period like the other layouts
+        next_exits = all_exits.with_values(np.empty(len(all_exits.values), dtype=np.int32))
+        for period_index in range(len(all_exits)):
+            next_exits[period_index][:] = create_period_next_exits(all_exits[period_index])
+        return next_exits
+
+    if all_exits.dtype != object:
+        return create_period_next_exits(all_exits)
+
+    next_exits = np.empty(len(all_exits), dtype=object)
+    for period_index in range(len(all_exits)):
+        next_exits[period_index] = create_period_next_exits(all_exits[period_index])
+
+    return next_exits
+
 def create_allowed_entries(bars, indicator_reset):
     
-    period_count = bars.shape[2]
-    allowed_entry_sessions = np.empty((period_count, len(Session)), dtype=object)
-    allowed_entry_days = np.empty((period_count, TRADING_DAY_COUNT), dtype=object)
+    period_count = get_period_count(bars)
 
     allowed_days = create_allowed_days(bars, indicator_reset)
     allowed_sessions = create_session_entries(bars)
 
+    if get_bars_layout(bars) == BarLayout.Matrix:
+        # Keep the masks as contiguous (period_count, Session/Day, period_length) boolean arrays
+        return allowed_sessions, np.ascontiguousarray(allowed_days[:, :TRADING_DAY_COUNT])
+    if get_bars_layout(bars) == BarLayout.Ragged:
+        # Already ragged (Session/Day, bar_count) boolean arrays
+        return allowed_sessions, allowed_days
+
+    allowed_entry_sessions = np.empty((period_count, len(Session)), dtype=object)
+    allowed_entry_days = np.empty((period_count, TRADING_DAY_COUNT), dtype=object)
+
     for period_index in range(period_count):
         allowed_entry_sessions[period_index][Session.All.value] = allowed_sessions[period_index][Session.All.value]
         allowed_entry_sessions[period_index][Session.Asia.value] = allowed_sessions[period_index][Session.Asia.value]
@@ -52,7 +95,13 @@ def create_allowed_entries(bars, indicator_reset):
 
 def create_allowed_days(bars, indicator_reset):
 
-    period_count = bars.shape[2]
+    if get_bars_layout(bars) == BarLayout.Ragged:
+        # Only the trading days are kept, the same days create_allowed_entries keeps for the other layouts
+        bars_day_of_week = bars[BarTypes.Minute1.value][OHLC.DayOfWeek.value]
+        return bars_day_of_week.with_values(
+            np.stack([bars_day_of_week.values == day_index for day_index in range(TRADING_DAY_COUNT)]))
+
+    period_count = get_period_count(bars)
 
     minutes_in_period = None
     if indicator_reset == IndicatorReset.Daily:
@@ -71,39 +120,49 @@ def create_allowed_days(bars, indicator_reset):
         
     return allowed_days
 
+def calculate_session_entries(hours, minutes):
+    # Sessions of every minute from the precomputed hour and minute of each bar, for bars of any shape
+    # The sessions are added as the second to last axis, so (period_count, Session, period_length) for a matrix
+    # Using or for All and Asia because they span different days
+    session_entries = np.stack([
+        np.logical_or(hours >= DAILY_ENTRY_HOURS_ASIA_START, hours < DAILY_ENTRY_HOURS_US_END),
+        np.logical_or(hours >= DAILY_ENTRY_HOURS_ASIA_START, hours < DAILY_ENTRY_HOURS_ASIA_END),
+        np.logical_and(hours >= DAILY_ENTRY_HOURS_LONDON_START, hours < DAILY_ENTRY_HOURS_LONDON_END),
+        np.logical_and(hours >= DAILY_ENTRY_HOURS_US_START, hours < DAILY_ENTRY_HOURS_US_END),
+    ], axis=-2)
+
+    # No entries in the last minutes of a session or the first minutes of Asia
+    # The hours differ so at most one of these checks matches a minute
+    asia_end = (hours == DAILY_EXIT_HOURS_ASIA_FINAL_HOUR) & (minutes >= DAILY_EXIT_MINUTES_END_SESSION)
+    london_end = (hours == DAILY_EXIT_HOURS_LONDON_FINAL_HOUR) & (minutes >= DAILY_EXIT_MINUTES_END_SESSION)
+    us_end = (hours == DAILY_EXIT_HOURS_US_FINAL_HOUR) & (minutes >= DAILY_EXIT_MINUTES_END_SESSION)
+    asia_start = (hours == DAILY_ENTRY_HOURS_ASIA_START) & (minutes < DAILY_ENTRY_MINUTES_START_SESSION)
+
+    session_entries[..., Session.Asia.value, :] &= ~(asia_end | asia_start)
+    session_entries[..., Session.London.value, :] &= ~london_end
+    session_entries[..., Session.US.value, :] &= ~us_end
+    session_entries[..., Session.All.value, :] &= ~(us_end | asia_start)
+
+    return session_entries
+
 def create_session_entries(bars):
 
-    period_count = bars.shape[2]
+    bars_hour = bars[BarTypes.Minute1.value][OHLC.Hour.value]
+    bars_minute = bars[BarTypes.Minute1.value][OHLC.Minute.value]
+
+    if get_bars_layout(bars) == BarLayout.Ragged:
+        # (Session, bar_count) over the bars of every period at once
+        return bars_hour.with_values(calculate_session_entries(bars_hour.values, bars_minute.values))
+    if get_bars_layout(bars) == BarLayout.Matrix:
+        return calculate_session_entries(bars_hour, bars_minute)
+
+    period_count = get_period_count(bars)
     session_entries = np.empty((period_count, len(Session)), dtype=object)
 
     for period_index in range(period_count):
-        
-        # Using or because this spans different days for All and Asia 
-        session_entries[period_index][Session.All.value] = np.logical_or(
-                                        bars[BarTypes.Minute1.value][OHLC.Hour.value][period_index] >= DAILY_ENTRY_HOURS_ASIA_START, 
-                                        bars[BarTypes.Minute1.value][OHLC.Hour.value][period_index] < DAILY_ENTRY_HOURS_US_END)                
-        session_entries[period_index][Session.Asia.value] = np.logical_or(
-                                        bars[BarTypes.Minute1.value][OHLC.Hour.value][period_index] >= DAILY_ENTRY_HOURS_ASIA_START, 
-                                        bars[BarTypes.Minute1.value][OHLC.Hour.value][period_index] < DAILY_ENTRY_HOURS_ASIA_END)
-        session_entries[period_index][Session.London.value] = np.logical_and(
-                                        bars[BarTypes.Minute1.value][OHLC.Hour.value][period_index] >= DAILY_ENTRY_HOURS_LONDON_START, 
-                                        bars[BarTypes.Minute1.value][OHLC.Hour.value][period_index] < DAILY_ENTRY_HOURS_LONDON_END)
-        session_entries[period_index][Session.US.value] = np.logical_and(
-                                        bars[BarTypes.Minute1.value][OHLC.Hour.value][period_index] >= DAILY_ENTRY_HOURS_US_START, 
-                                        bars[BarTypes.Minute1.value][OHLC.Hour.value][period_index] < DAILY_ENTRY_HOURS_US_END)
-        
-        for index in range(len(bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index])):
-            datetime = bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index][index]
-            if datetime.hour == DAILY_EXIT_HOURS_ASIA_FINAL_HOUR and datetime.minute >= DAILY_EXIT_MINUTES_END_SESSION:
-                session_entries[period_index][Session.Asia.value][index] = False
-            elif datetime.hour == DAILY_EXIT_HOURS_LONDON_FINAL_HOUR and datetime.minute >= DAILY_EXIT_MINUTES_END_SESSION:
-                session_entries[period_index][Session.London.value][index] = False
-            elif datetime.hour == DAILY_EXIT_HOURS_US_FINAL_HOUR and datetime.minute >= DAILY_EXIT_MINUTES_END_SESSION:
-                session_entries[period_index][Session.US.value][index] = False
-                session_entries[period_index][Session.All.value][index] = False
-            elif datetime.hour == DAILY_ENTRY_HOURS_ASIA_START and datetime.minute < DAILY_ENTRY_MINUTES_START_SESSION:
-                session_entries[period_index][Session.Asia.value][index] = False
-                session_entries[period_index][Session.All.value][index] = False
+        period_session_entries = calculate_session_entries(bars_hour[period_index], bars_minute[period_index])
+        for session in Session:
+            session_entries[period_index][session.value] = period_session_entries[session.value]
         
     return session_entries
 
@@ -119,7 +178,15 @@ def create_all_exits(host, database, user, password, bars, market, period_lookup
 
 def create_end_of_day_exits(bars):    
 
-    period_count = bars.shape[2]
+    if get_bars_layout(bars) == BarLayout.Matrix:
+        bars_hour = bars[BarTypes.Minute1.value][OHLC.Hour.value]
+        return np.logical_or(bars_hour == DAILY_EXIT_HOURS_START, bars_hour == DAILY_EXIT_HOURS_END)
+    if get_bars_layout(bars) == BarLayout.Ragged:
+        bars_hour = bars[BarTypes.Minute1.value][OHLC.Hour.value]
+        return bars_hour.with_values(np.logical_or(bars_hour.values == DAILY_EXIT_HOURS_START,
+                                                   bars_hour.values == DAILY_EXIT_HOURS_END))
+
+    period_count = get_period_count(bars)
     exits_end_day = np.empty(period_count, dtype=object)
 
     for period_index in range(period_count):
@@ -131,6 +198,10 @@ def create_end_of_day_exits(bars):
 
     return exits_end_day
 
+def create_timed_exit_mask(period_datetimes, start, end):
+    # Minutes of the period from start up to but not including end, compared as epoch minutes
+    return (period_datetimes >= to_epoch_minute_ceiling(start)) & (period_datetimes < to_epoch_minute_ceiling(end))
+
 def add_week_start(dataframe):
     dataframe['week_start'] = dataframe['start'].apply(
             lambda dt: dt - pd.Timedelta(days=(dt.weekday() + 1) % 7, hours=dt.hour - 17))
@@ -155,6 +226,25 @@ def get_period_frequency(indicator_reset):
         return 'W'
     return None
 
+def create_event_exits(bars, all_exits, period_lookup, indicator_reset, events_df):
+    # Timed exits over the minutes from the start up to the end of each event, events_df has start and end columns
+    if len(events_df) == 0:
+        return
+
+    add_period_start(events_df, indicator_reset)
+    period_frequency = get_period_frequency(indicator_reset)
+
+    period_events = {}
+    for period_start, period_index in period_lookup.items():
+        period_df = events_df[events_df['period'] == period_start.to_period(period_frequency)]
+        period_events[period_index] = period_df
+
+    for period_index in range(len(all_exits)):
+        if period_index in period_events:
+            for start, end in zip(period_events[period_index]['start'], period_events[period_index]['end']):
+                mask = create_timed_exit_mask(bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index], start, end)
+                all_exits[period_index][mask] = True
+
 def create_risk_events_exits(host, database, user, password, market, bars, all_exits, period_lookup, indicator_reset, verbose = False, verbose_path = '.'):
 
     risk_events_df = get_risk_events(host, database, user, password, market)
@@ -167,19 +257,7 @@ def create_risk_events_exits(host, database, user, password, market, bars, all_e
         risk_events_df.to_csv(filename, mode='w', index=False)
         print(f"Risk Events written to {filename}")
 
-    add_period_start(risk_events_df, indicator_reset)
-    period_frequency = get_period_frequency(indicator_reset)
-    
-    period_risk_events = {}
-    for period_start, period_index in period_lookup.items():
-        period_df = risk_events_df[risk_events_df['period'] == period_start.to_period(period_frequency)]
-        period_risk_events[period_index] = period_df
-
-    for period_index in range(len(all_exits)):
-        if period_index in period_risk_events:
-            for _, (event_code, start, end, adjusted_start, period) in period_risk_events[period_index].iterrows():            
-                mask = (bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index] >= start) & (bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index] < end)
-                all_exits[period_index][mask] = True
+    create_event_exits(bars, all_exits, period_lookup, indicator_reset, risk_events_df)
 
 def create_holidays_exits(host, database, user, password, bars, all_exits, period_lookup, indicator_reset, verbose = False, verbose_path = '.'):
     holidays_df = get_holidays(host, database, user, password)
@@ -189,19 +267,7 @@ def create_holidays_exits(host, database, user, password, bars, all_exits, perio
         holidays_df.to_csv(filename, mode='w', index=False)
         print(f"Holidays written to {filename}")
 
-    add_period_start(holidays_df, indicator_reset)
-    period_frequency = get_period_frequency(indicator_reset)
-
-    period_holidays = {}
-    for period_start, period_index in period_lookup.items():
-        period_df = holidays_df[holidays_df['period'] == period_start.to_period(period_frequency)]
-        period_holidays[period_index] = period_df
-
-    for period_index in range(len(all_exits)):
-        if period_index in period_holidays:
-            for _, (event_code, start, end, adjusted_start, period) in period_holidays[period_index].iterrows():        
-                mask = (bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index] >= start) & (bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index] < end)
-                all_exits[period_index][mask] = True
+    create_event_exits(bars, all_exits, period_lookup, indicator_reset, holidays_df)
 
 def create_circuit_breaker_exits(host, user, password, market, bars, all_exits, period_lookup, indicator_reset, verbose = False, verbose_path = '.'):
     circuit_breakers_df = get_historical_circuit_breakers(host, user, password)
@@ -211,32 +277,29 @@ def create_circuit_breaker_exits(host, user, password, market, bars, all_exits,
         circuit_breakers_df.to_csv(filename, mode='w', index=False)
         print(f"Circuit breakers written to {filename}") 
 
-    add_period_start(circuit_breakers_df, indicator_reset)
-    period_frequency = get_period_frequency(indicator_reset)
+    market_circuit_breakers_df = circuit_breakers_df[circuit_breakers_df['market'] == market].copy()
+    create_event_exits(bars, all_exits, period_lookup, indicator_reset, market_circuit_breakers_df)
 
-    period_circuit_breakers = {}
-    for period_start, period_index in period_lookup.items():
-        period_df = circuit_breakers_df[circuit_breakers_df['period'] == period_start.to_period(period_frequency)]
-        period_circuit_breakers[period_index] = period_df   
+def create_session_end_exits(bars, all_exits):
+    bars_hour = bars[BarTypes.Minute1.value][OHLC.Hour.value]
+    bars_minute = bars[BarTypes.Minute1.value][OHLC.Minute.value]
 
-    for period_index in range(len(all_exits)):
-        if period_index in period_circuit_breakers:
-            for _, (circuit_breaker_market, start, end, adjusted_start, period) in period_circuit_breakers[period_index].iterrows():        
-                if market == circuit_breaker_market:
-                    mask = (bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index] >= start) & (bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index] < end)
-                    all_exits[period_index][mask] = True
+    if get_bars_layout(bars) == BarLayout.Ragged:
+        all_exits.values[calculate_session_end_exits(bars_hour.values, bars_minute.values)] = True
+        return
+    if get_bars_layout(bars) == BarLayout.Matrix:
+        all_exits[calculate_session_end_exits(bars_hour, bars_minute)] = True
+        return
 
-def create_session_end_exits(bars, all_exits):
-    period_count = bars.shape[2]    
+    period_count = get_period_count(bars)
     for period_index in range(period_count):
-        for index in range(len(bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index])):
-            datetime = bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index][index]        
-            if datetime.hour == DAILY_EXIT_HOURS_ASIA_FINAL_HOUR and datetime.minute >= DAILY_EXIT_MINUTES_END_SESSION:
-                all_exits[period_index][index] = True
-            elif datetime.hour == DAILY_EXIT_HOURS_LONDON_FINAL_HOUR and datetime.minute >= DAILY_EXIT_MINUTES_END_SESSION:
-                all_exits[period_index][index] = True
-            elif datetime.hour == DAILY_EXIT_HOURS_US_FINAL_HOUR and datetime.minute >= DAILY_EXIT_MINUTES_END_SESSION:
-                all_exits[period_index][index] = True
+        all_exits[period_index][calculate_session_end_exits(bars_hour[period_index], bars_minute[period_index])] = True
+
+def calculate_session_end_exits(hours, minutes):
+    # Exit in the last minutes of each session
+    return (minutes >= DAILY_EXIT_MINUTES_END_SESSION) & (
+        (hours == DAILY_EXIT_HOURS_ASIA_FINAL_HOUR) | (hours == DAILY_EXIT_HOURS_LONDON_FINAL_HOUR) |
+        (hours == DAILY_EXIT_HOURS_US_FINAL_HOUR))
 
 if __name__ == "__main__":
 
@@ -266,7 +329,7 @@ if __name__ == "__main__":
 
     for period_index in range(len(all_exits)):
 
-        datetimes = bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index]
+        datetimes = from_epoch_minutes(bars[BarTypes.Minute1.value][OHLC.DateTime.value][period_index])
 
         df_exits = pd.DataFrame({
             'datetime': datetimes,